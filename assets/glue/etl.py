@@ -1,5 +1,9 @@
 import sys
 import os
+import json
+import time
+import uuid
+import boto3
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
@@ -22,6 +26,9 @@ load_data = glueContext.create_dynamic_frame.from_options(format_options={"quote
 
 # Convert the dynamic frame to a data frame
 df = load_data.toDF()
+
+# With the job bookmark enabled, runs without new input files process no rows
+new_data = not df.rdd.isEmpty()
 print(df.dtypes)
 df.show()
 
@@ -46,6 +53,13 @@ write_data.setFormat("glueparquet", compression="snappy")
 write_data.writeFrame(schema_update)
 job.commit()
 
+# Publish a new version of the data set after new data was committed. The athena lambda includes the version in its
+# result cache keys, so cached query results are invalidated as soon as the new data can be queried.
+if new_data:
+    data_version = {"Version": f"{int(time.time())}-{uuid.uuid4().hex[:8]}", "JobName": args['JOB_NAME'], "CommittedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    boto3.client('s3').put_object(Bucket=bucket_name, Key="data-proc-version.json", Body=json.dumps(data_version), ContentType="application/json")
+    print(f"Published data version {data_version['Version']}")
+
 ### This is a AWS Glue Studio example 
 ### Generated with the visual ETL console.
 # # Load the data set from Amazon S3
@@ -1,91 +1,2555 @@
+import base64
 import boto3
-from time import sleep
+from botocore.exceptions import ClientError
+import csv
+import io
+import json
+import math
 import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha256
 
-# Initialize the Athena client
+# DuckDB is optional, without it every query runs on Athena
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# NumPy is optional, without it result summaries are computed in pure Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Initialize the Athena, Glue and S3 clients
 athena_client = boto3.client('athena')
+glue_client = boto3.client('glue')
+s3_client = boto3.client('s3')
+
+# Polling configuration for the Athena query lifecycle. The first poll happens almost immediately so that cheap
+# queries return in tens of milliseconds, later polls back off exponentially with jitter.
+POLL_INITIAL_DELAY_SECONDS = 0.05
+POLL_MAX_DELAY_SECONDS = 2.0
+POLL_BACKOFF_FACTOR = 2.0
+# Fraction of the queue/engine time reported by Athena used as a lower bound for the next poll delay
+POLL_HINT_FRACTION = 0.2
+# Time reserved at the end of the invocation to stop the query and return a response to the agent
+DEADLINE_SAFETY_MARGIN_SECONDS = 3.0
+
+TERMINAL_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+# Budgets for the result set returned to the agent. Bedrock rejects action group responses larger than 25kB, so
+# reading stops at whichever budget is reached first and the response carries a continuation marker instead.
+MAX_RESULT_ROWS = int(os.environ.get('ATHENA_MAX_RESULT_ROWS', '1000'))
+MAX_RESULT_BYTES = int(os.environ.get('ATHENA_MAX_RESULT_BYTES', '20000'))
+# GetQueryResults returns at most 1000 rows per call
+RESULT_PAGE_SIZE = 1000
+
+# Reads that want more rows than this beyond the first page stream the CSV result object Athena writes to S3 with
+# ranged GETs instead of paging through GetQueryResults. Continuation tokens of streamed reads hold a byte offset.
+RESULT_STREAM_THRESHOLD_ROWS = int(os.environ.get('ATHENA_RESULT_STREAM_THRESHOLD_ROWS', '2000'))
+RESULT_STREAM_CHUNK_BYTES = 8 * 1024 * 1024
+RESULT_STREAM_TOKEN_PREFIX = 's3-offset:'
+# Athena quotes every value of the result CSV and leaves NULL values empty. QUOTE_NOTNULL tells them apart, before
+# Python 3.12 empty strings are read as NULL as well.
+RESULT_CSV_QUOTING = getattr(csv, 'QUOTE_NOTNULL', csv.QUOTE_MINIMAL)
+
+# Asynchronous execution. /athenaQuery returns the QueryExecutionId instead of the rows when the query was requested
+# asynchronously, when earlier runs of the same statement took longer than ASYNC_AFTER_SECONDS, or when the query is
+# still running after that time. The agent collects the result later through /athenaStatus and /athenaFetch.
+ASYNC_ENABLED = os.environ.get('ATHENA_ASYNC_ENABLED', 'true').lower() == 'true'
+ASYNC_AFTER_SECONDS = float(os.environ.get('ATHENA_ASYNC_AFTER_SECONDS', '20'))
+QUERY_DURATION_HISTORY_SIZE = 256
+
+# Upper bound for the statements of one /athenaBatchQuery request. BatchGetQueryExecution accepts up to 50 ids.
+MAX_BATCH_QUERIES = int(os.environ.get('ATHENA_MAX_BATCH_QUERIES', '10'))
+
+# Encodings for the rows returned to the agent. All of them replace Athena's verbose
+# {'Data': [{'VarCharValue': ...}]} row structure with a typed header and plain values.
+RESULT_FORMATS = ('compact', 'csv', 'markdown')
+DEFAULT_RESULT_FORMAT = os.environ.get('ATHENA_RESULT_FORMAT', 'compact')
+# Rough number of characters per model token, used to report the token savings of an encoding
+CHARS_PER_TOKEN = 4
+
+INTEGER_TYPES = ('tinyint', 'smallint', 'integer', 'int', 'bigint')
+FLOAT_TYPES = ('float', 'real', 'double', 'decimal')
+
+# Summarize mode returns a statistical profile per column instead of the rows. The profile covers many more rows than
+# a response could carry.
+SUMMARY_MAX_ROWS = int(os.environ.get('ATHENA_SUMMARY_MAX_ROWS', '100000'))
+SUMMARY_MAX_BYTES = int(os.environ.get('ATHENA_SUMMARY_MAX_BYTES', str(64 * 1024 * 1024)))
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+SUMMARY_TOP_K = 5
+
+# Result cache in front of Athena. The in-process LRU tier survives warm invocations of this container, the S3 tier
+# in the athena destination bucket is shared by all containers. Both expire entries after the same TTL,
+# ATHENA_RESULT_CACHE_TTL_SECONDS for entries keyed by a data version and ATHENA_UNVERSIONED_RESULT_CACHE_TTL_SECONDS
+# for the others. Unset, they are six hours and one hour.
+RESULT_CACHE_ENABLED = os.environ.get('ATHENA_RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('ATHENA_RESULT_CACHE_MAX_ENTRIES', '128'))
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get('ATHENA_RESULT_CACHE_TTL_SECONDS', '21600'))
+RESULT_CACHE_PREFIX = 'result-cache/'
+
+# Version of the processed data set, published by the Glue etl job as a marker object in the data bucket after every
+# run that committed new data. It is part of the result cache keys and tags the statements sent to Athena, so cached
+# results never outlive the data they were computed from and can be kept for hours. Without a marker the caches fall
+# back to the shorter unversioned lifetimes.
+DATA_VERSION_KEY = 'data-proc-version.json'
+DATA_VERSION_CHECK_INTERVAL_SECONDS = int(os.environ.get('ATHENA_DATA_VERSION_CHECK_INTERVAL_SECONDS', '30'))
+RESULT_REUSE_MAX_AGE_MINUTES = int(os.environ.get('ATHENA_RESULT_REUSE_MAX_AGE_MINUTES', '1440'))
+UNVERSIONED_RESULT_CACHE_TTL_SECONDS = int(os.environ.get('ATHENA_UNVERSIONED_RESULT_CACHE_TTL_SECONDS', '3600'))
+UNVERSIONED_RESULT_REUSE_MAX_AGE_MINUTES = 60
+
+# Only the results of statements that do not modify anything are cached
+READ_ONLY_STATEMENTS = ('select', 'with', 'show', 'describe', 'values')
+
+SQL_TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<identifier>"(?:[^"]|"")*")
+  | (?P<word>\w+)
+  | (?P<space>\s+)
+  | (?P<symbol>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Approximate mode rewrites exact aggregates to their approximate Athena functions and optionally samples the
+# data_proc table with TABLESAMPLE BERNOULLI, scaling counts and sums back up. Documented error of the functions used.
+APPROX_DEFAULT_SAMPLE_PERCENT = float(os.environ.get('ATHENA_APPROX_SAMPLE_PERCENT', '10'))
+APPROX_DISTINCT_STANDARD_ERROR = 0.023
+APPROX_PERCENTILE_RANK_ERROR = 0.01
+SAMPLE_SCALED_FUNCTIONS = ('count', 'sum')
+# Keywords that can follow a table reference, anything else after the table name is its alias
+TABLE_REFERENCE_END = (
+    'where', 'group', 'order', 'limit', 'join', 'inner', 'left', 'right', 'full', 'cross', 'natural', 'on', 'using',
+    'union', 'except', 'intersect', 'having', 'window', 'offset', 'fetch', 'tablesample', ',', ')', ';',
+)
+
+# Embedded DuckDB fast path for small analytical queries. The processed parquet data set written by the Glue etl job is
+# mirrored to local storage and queried in process, falling back to Athena when the data set is too large or the
+# statement uses anything DuckDB does not understand.
+FAST_PATH_ENABLED = os.environ.get('ATHENA_FAST_PATH_ENABLED', 'true').lower() == 'true'
+FAST_PATH_MAX_DATA_BYTES = int(os.environ.get('ATHENA_FAST_PATH_MAX_DATA_BYTES', str(1024 * 1024 * 1024)))
+FAST_PATH_CACHE_DIR = os.environ.get('ATHENA_FAST_PATH_CACHE_DIR', '/tmp/data-proc')
+FAST_PATH_SYNC_INTERVAL_SECONDS = int(os.environ.get('ATHENA_FAST_PATH_SYNC_INTERVAL_SECONDS', '300'))
+# Time a request may spend on mirroring, at most half of the time it has left. A mirror that is not complete yet is
+# continued by the next requests, which run on Athena until it is.
+FAST_PATH_SYNC_MAX_SECONDS = float(os.environ.get('ATHENA_FAST_PATH_SYNC_MAX_SECONDS', '10'))
+GLUE_DATABASE = 'data_set_db'
+DATA_PROC_TABLE = 'data_proc'
+DATA_PROC_PREFIX = 'data-proc/'
+
+# DuckDB column types mapped to the names Athena reports in ColumnInfo
+DUCKDB_TYPES = {
+    'TINYINT': 'tinyint',
+    'SMALLINT': 'smallint',
+    'INTEGER': 'integer',
+    'BIGINT': 'bigint',
+    'HUGEINT': 'bigint',
+    'FLOAT': 'float',
+    'DOUBLE': 'double',
+    'DECIMAL': 'decimal',
+    'BOOLEAN': 'boolean',
+    'VARCHAR': 'varchar',
+    'DATE': 'date',
+    'TIMESTAMP': 'timestamp',
+}
+
+fast_path = {'connection': None, 'synced_at': 0.0, 'etags': {}, 'available': False, 'version': None}
+fast_path_lock = threading.Lock()
+
+# Query governor. Statements over data_proc are analyzed before they are started: unbounded row queries get a LIMIT
+# injected and queries that would scan more than GOVERNOR_MAX_SCAN_BYTES without a filter on the date partition key
+# are rejected with an error the agent can act on. In 'warn' mode the findings are only reported.
+GOVERNOR_MODE = os.environ.get('ATHENA_GOVERNOR_MODE', 'enforce').lower()
+GOVERNOR_DEFAULT_LIMIT = int(os.environ.get('ATHENA_GOVERNOR_DEFAULT_LIMIT', '1000'))
+GOVERNOR_MAX_SCAN_BYTES = int(os.environ.get('ATHENA_GOVERNOR_MAX_SCAN_BYTES', str(1024 * 1024 * 1024)))
+TABLE_STATS_TTL_SECONDS = int(os.environ.get('ATHENA_TABLE_STATS_TTL_SECONDS', '300'))
+PARTITION_KEY = 'date'
+# Keywords that end a WHERE clause
+WHERE_CLAUSE_END = ('group', 'order', 'having', 'limit', 'offset', 'fetch', 'window', 'union', 'intersect', 'except')
+
+AGGREGATE_FUNCTIONS = (
+    'count', 'count_if', 'sum', 'avg', 'min', 'max', 'min_by', 'max_by', 'arbitrary', 'stddev', 'stddev_samp',
+    'stddev_pop', 'variance', 'var_samp', 'var_pop', 'approx_distinct', 'approx_percentile', 'approx_most_frequent',
+    'bool_and', 'bool_or', 'every', 'array_agg', 'map_agg', 'histogram', 'corr', 'covar_pop', 'covar_samp', 'geometric_mean',
+)
+
+table_stats = {'listed_at': 0.0, 'partitions': {}, 'columns': [], 'version': None}
+table_stats_lock = threading.Lock()
+
+# Table definition and partition list of data_proc from the Glue Data Catalog, served by /schema without Athena. The
+# table version and update time are checked at most every SCHEMA_CHECK_INTERVAL_SECONDS and the cache is rebuilt when
+# either changes. The
+# etl job adds partitions without a new table version, so the partition list is also refreshed after
+# PARTITIONS_TTL_SECONDS, which matches the schedule of the etl job.
+SCHEMA_CHECK_INTERVAL_SECONDS = int(os.environ.get('ATHENA_SCHEMA_CHECK_INTERVAL_SECONDS', '60'))
+PARTITIONS_TTL_SECONDS = int(os.environ.get('ATHENA_PARTITIONS_TTL_SECONDS', '900'))
+
+table_metadata = {'checked_at': 0.0, 'loaded_at': 0.0, 'version': None, 'schema': None}
+table_metadata_lock = threading.Lock()
+
+# Per-invocation performance metrics, emitted as one CloudWatch Embedded Metric Format log line per invocation
+METRICS_NAMESPACE = os.environ.get('ATHENA_METRICS_NAMESPACE', 'BedrockAgent/AthenaAction')
+METRIC_UNITS = {
+    'HandlerLatency': 'Milliseconds',
+    'QueueTime': 'Milliseconds',
+    'EngineExecutionTime': 'Milliseconds',
+    'PlanningTime': 'Milliseconds',
+    'DataScannedInBytes': 'Bytes',
+    'EstimatedBytesScanned': 'Bytes',
+    'ResultReuseHit': 'Count',
+    'CacheHit': 'Count',
+    'FastPathHit': 'Count',
+    'PollCount': 'Count',
+    'SingleFlightAttach': 'Count',
+    'AdmissionWait': 'Count',
+    'AdmissionRejected': 'Count',
+    'AdmissionWaitTime': 'Milliseconds',
+    'ThrottleRetries': 'Count',
+    'RowsProfiled': 'Count',
+    'RowsExported': 'Count',
+    'RowsStreamed': 'Count',
+    'RowsReturned': 'Count',
+    'PayloadBytes': 'Bytes',
+}
+
+invocation_metrics = {}
+invocation_metrics_lock = threading.Lock()
+
+# Single-flight coalescing of identical queries. The first caller takes a lock record keyed by the query fingerprint
+# with a conditional write and owns the execution, later callers attach to its QueryExecutionId. The records live in
+# the DynamoDB table named by ATHENA_LOCK_TABLE, without it an in-process store coalesces within this container only.
+LOCK_TABLE = os.environ.get('ATHENA_LOCK_TABLE')
+LOCK_TTL_SECONDS = int(os.environ.get('ATHENA_LOCK_TTL_SECONDS', '120'))
+# How long a caller waits for the owner of a lock to publish the QueryExecutionId before running the query itself
+LOCK_ATTACH_WAIT_SECONDS = 2.0
+
+# Session scoped materialization. A query run with Materialize set is stored as a snappy compressed parquet table with
+# CTAS so that follow-up questions of the same session read the small result instead of the full data set. Follow-up
+# queries reference the latest result of their session as previous_result. Tables older than the TTL are dropped by the
+# scheduled cleanup invocation. The workgroup enforces its result location, so Athena places the table data below
+# tables/<query id>/ of that location, query-results/tables/ of the Athena bucket. The cleanup deletes the data at the
+# location the catalog records for the table.
+SESSION_TABLE_PREFIX = 'session_result_'
+SESSION_RESULT_TTL_SECONDS = int(os.environ.get('ATHENA_SESSION_RESULT_TTL_SECONDS', '7200'))
+SESSION_RESULT_PATTERN = re.compile(r'(?<![\w."])"?previous_result"?(?![\w"])', re.IGNORECASE)
+
+# Export mode writes large results with UNLOAD as parquet files below the exports prefix of the Athena bucket and
+# returns a manifest with presigned links instead of rows
+EXPORT_PREFIX = 'exports/'
+EXPORT_URL_EXPIRY_SECONDS = int(os.environ.get('ATHENA_EXPORT_URL_EXPIRY_SECONDS', '3600'))
+EXPORT_MAX_FILES = 100
+
+# Registry of parameterized query templates for the known question shapes, served by /namedQuery. The slot values are
+# passed to Athena prepared statements as execution parameters. KPI columns and aggregations are identifiers and can't
+# be parameters, they come from allowlists and every combination is prepared as its own statement on first use.
+PREPARED_STATEMENT_PREFIX = 'named_'
+TEMPLATE_KPIS = (
+    '4g_cell_availability', '4g_packet_cssr', '4g_volte_erab_success_rate', '4g_volte_erab_drop_rate', '4g_drop_packet',
+    '4g_volte_traffic', '4g_packet_data_traffic_gb', '4g_user_throughput_dl_mbps', '4g_utilization',
+)
+TEMPLATE_AGGREGATIONS = ('sum', 'avg', 'min', 'max')
+TEMPLATE_DATE_FORMAT = '%d %b %y'
+TEMPLATE_MAX_TOP_N = 100
+# slot -> (type, default). Empty strings disable the optional city and vendor filters, missing dates default to the
+# first and last date of the data set.
+TEMPLATE_SLOTS = {
+    'StartDate': ('date', None),
+    'EndDate': ('date', None),
+    'City': ('varchar', ''),
+    'Vendor': ('varchar', ''),
+    'TopN': ('integer', '10'),
+    'Threshold': ('double', None),
+}
+TEMPLATE_DATE_RANGE = """date_parse("date", '%d %b %y') BETWEEN date_parse(?, '%d %b %y') AND date_parse(?, '%d %b %y')"""
+QUERY_TEMPLATES = {
+    'kpi_by_city': {
+        'Sql': """SELECT "city", {aggregation}("{kpi}") AS "{aggregation}_{kpi}"
+FROM data_set_db.data_proc
+WHERE {date_range} AND (? = '' OR "vendor" = ?)
+GROUP BY "city"
+ORDER BY 2 DESC""",
+        'Parameters': ('StartDate', 'EndDate', 'Vendor', 'Vendor'),
+    },
+    'kpi_by_date': {
+        'Sql': """SELECT "date", {aggregation}("{kpi}") AS "{aggregation}_{kpi}"
+FROM data_set_db.data_proc
+WHERE {date_range} AND (? = '' OR "city" = ?) AND (? = '' OR "vendor" = ?)
+GROUP BY "date"
+ORDER BY date_parse("date", '%d %b %y')""",
+        'Parameters': ('StartDate', 'EndDate', 'City', 'City', 'Vendor', 'Vendor'),
+    },
+    'kpi_by_vendor': {
+        'Sql': """SELECT "vendor", {aggregation}("{kpi}") AS "{aggregation}_{kpi}"
+FROM data_set_db.data_proc
+WHERE {date_range} AND (? = '' OR "city" = ?)
+GROUP BY "vendor"
+ORDER BY 2 DESC""",
+        'Parameters': ('StartDate', 'EndDate', 'City', 'City'),
+    },
+    'top_cells_by_kpi': {
+        'Sql': """SELECT "4g_cell_name", "city", "vendor", "{aggregation}_{kpi}"
+FROM (
+    SELECT "4g_cell_name", "city", "vendor", {aggregation}("{kpi}") AS "{aggregation}_{kpi}",
+        row_number() OVER (ORDER BY {aggregation}("{kpi}") DESC) AS "rank"
+    FROM data_set_db.data_proc
+    WHERE {date_range} AND (? = '' OR "city" = ?) AND "{kpi}" IS NOT NULL
+    GROUP BY "4g_cell_name", "city", "vendor"
+)
+WHERE "rank" <= ?
+ORDER BY 4 DESC""",
+        'Parameters': ('StartDate', 'EndDate', 'City', 'City', 'TopN'),
+    },
+    'kpi_statistics': {
+        'Sql': """SELECT count("{kpi}") AS "count", min("{kpi}") AS "min", max("{kpi}") AS "max", avg("{kpi}") AS "avg",
+    stddev("{kpi}") AS "stddev", approx_percentile("{kpi}", 0.25) AS "p25", approx_percentile("{kpi}", 0.5) AS "median",
+    approx_percentile("{kpi}", 0.75) AS "p75"
+FROM data_set_db.data_proc
+WHERE {date_range} AND (? = '' OR "city" = ?) AND (? = '' OR "vendor" = ?)""",
+        'Parameters': ('StartDate', 'EndDate', 'City', 'City', 'Vendor', 'Vendor'),
+    },
+    'cells_above_threshold': {
+        'Sql': """SELECT "city", count(DISTINCT "4g_cell_name") AS "cells"
+FROM data_set_db.data_proc
+WHERE {date_range} AND (? = '' OR "city" = ?) AND "{kpi}" > ?
+GROUP BY "city"
+ORDER BY 2 DESC""",
+        'Parameters': ('StartDate', 'EndDate', 'City', 'City', 'Threshold'),
+    },
+    'cell_count_by_city': {
+        'Sql': """SELECT "city", count(DISTINCT "4g_cell_name") AS "cells"
+FROM data_set_db.data_proc
+WHERE {date_range} AND (? = '' OR "vendor" = ?)
+GROUP BY "city"
+ORDER BY 2 DESC""",
+        'Parameters': ('StartDate', 'EndDate', 'Vendor', 'Vendor'),
+    },
+}
+
+# Admission control for StartQueryExecution. Token buckets kept in the lock table are shared by all containers, one
+# limits the rate of query starts in the workgroup and one per agent session keeps a session from using up the whole
+# burst. Throttling errors from Athena are retried with jittered exponential backoff. A start that finds a bucket
+# empty waits for its token, at most ADMISSION_MAX_WAIT_SECONDS and half of the time the request has left, and is
+# rejected with 429 when the token would come later. Delayed and rejected starts are counted in the metrics.
+ADMISSION_RATE_PER_SECOND = float(os.environ.get('ATHENA_ADMISSION_RATE_PER_SECOND', '5'))
+ADMISSION_BURST = int(os.environ.get('ATHENA_ADMISSION_BURST', '20'))
+ADMISSION_SESSION_RATE_PER_SECOND = float(os.environ.get('ATHENA_ADMISSION_SESSION_RATE_PER_SECOND', '2'))
+ADMISSION_SESSION_BURST = int(os.environ.get('ATHENA_ADMISSION_SESSION_BURST', '10'))
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get('ATHENA_ADMISSION_MAX_WAIT_SECONDS', '10'))
+ADMISSION_MAX_WAIT_FRACTION = 0.5
+ADMISSION_KEY_PREFIX = 'admission#'
+# Bucket records are removed by the table TTL a day after their last use, a missing bucket starts full
+ADMISSION_RECORD_TTL_SECONDS = 86400
+START_MAX_RETRIES = int(os.environ.get('ATHENA_START_MAX_RETRIES', '5'))
+START_RETRY_BASE_SECONDS = 0.2
+START_RETRY_MAX_SECONDS = 5.0
+THROTTLING_ERRORS = ('TooManyRequestsException', 'ThrottlingException')
+
+# fingerprint -> total execution time in seconds of the last run, used to predict slow queries
+query_durations = OrderedDict()
+query_durations_lock = threading.Lock()
+
+data_version = {'checked_at': 0.0, 'version': None}
+data_version_lock = threading.Lock()
+
+# fingerprint -> (expires_at, result), ordered from least to most recently used
+result_cache = OrderedDict()
+result_cache_lock = threading.Lock()
+
+# Names of the prepared statements known to exist in the workgroup
+prepared_statements = set()
+prepared_statements_lock = threading.Lock()
+
+
+class QueryTimeoutError(Exception):
+    pass
+
+
+class QueryFailedError(Exception):
+    pass
+
+
+class QueryRejectedError(Exception):
+    pass
+
+
+class QueryThrottledError(Exception):
+    pass
+
+
+class QueryStillRunningError(Exception):
+
+    def __init__(self, execution_id, state):
+        super().__init__(f"Query {execution_id} is still {state}")
+        self.execution_id = execution_id
+        self.state = state
+
+
+def reset_metrics():
+    with invocation_metrics_lock:
+        invocation_metrics.clear()
+
+
+def add_metric(name, value):
+    # Values of the same metric add up, e.g. across the statements of a batch
+    with invocation_metrics_lock:
+        invocation_metrics[name] = invocation_metrics.get(name, 0) + value
 
-def handler(event, context):
-    print(event)
 
-    def athena_query_handler(event):
-        # Fetch parameters for the new fields
+def record_query_statistics(query_execution):
+    statistics = query_execution.get('Statistics', {})
+    add_metric('QueueTime', statistics.get('QueryQueueTimeInMillis', 0))
+    add_metric('EngineExecutionTime', statistics.get('EngineExecutionTimeInMillis', 0))
+    add_metric('PlanningTime', statistics.get('QueryPlanningTimeInMillis', 0))
+    add_metric('DataScannedInBytes', statistics.get('DataScannedInBytes', 0))
+    add_metric('ResultReuseHit', int(statistics.get('ResultReuseInformation', {}).get('ReusedPreviousResult', False)))
 
-        # Extracting the SQL query. THe bedrock function call will pass the query in the request body
-        query = event['requestBody']['content']['application/json']['properties'][0]['value']
 
-        print("the received QUERY:",  query)
-        
-        # Adding the athena destination s3 bucket we need for the boto athena client call
-        s3_output = 's3://' + os.environ["ATHENA_DEST_BUCKET"]
-        wg_name = os.environ["ATHENA_WORKGROUP"]
+def emit_metrics(action_group, api_path, response_code):
+    with invocation_metrics_lock:
+        values = dict(invocation_metrics)
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['ActionGroup', 'ApiPath']],
+                'Metrics': [{'Name': name, 'Unit': METRIC_UNITS.get(name, 'None')} for name in values],
+            }],
+        },
+        'ActionGroup': action_group or 'unknown',
+        'ApiPath': api_path or 'unknown',
+        'HttpStatusCode': response_code,
+    }
+    record.update(values)
+    # CloudWatch Logs extracts the metrics from log lines that hold a single EMF document
+    line = json.dumps(record)
+    print(line)
+    return line
+
 
-        # Execute the query and wait for completion
-        execution_id = execute_athena_query(query, s3_output, wg_name)
-        result = get_query_results(execution_id)
+class DynamoDbLockStore:
 
-        return result
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.client = boto3.client('dynamodb')
 
-    def execute_athena_query(query, s3_output, wg_name):
-        response = athena_client.start_query_execution(
-            QueryString=query,
-            ResultConfiguration={
-                'OutputLocation': s3_output,
+    def acquire(self, key, owner, ttl_seconds):
+        # Take the lock unless another owner holds it and it has not expired yet
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'LockKey': {'S': key},
+                    'Owner': {'S': owner},
+                    'ExpiresAt': {'N': str(now + ttl_seconds)},
                 },
-            WorkGroup=wg_name,
-            ResultReuseConfiguration={
-                'ResultReuseByAgeConfiguration': {
-                    'Enabled': True,
-                    'MaxAgeInMinutes': 60
+                ConditionExpression='attribute_not_exists(LockKey) OR ExpiresAt < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}},
+            )
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def set_execution_id(self, key, owner, execution_id):
+        self.client.update_item(
+            TableName=self.table_name,
+            Key={'LockKey': {'S': key}},
+            UpdateExpression='SET ExecutionId = :execution_id',
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={'#owner': 'Owner'},
+            ExpressionAttributeValues={':execution_id': {'S': execution_id}, ':owner': {'S': owner}},
+        )
+
+    def get(self, key):
+        # Returns the current lock record as {'Owner', 'ExecutionId', 'ExpiresAt'} or None
+        item = self.client.get_item(TableName=self.table_name, Key={'LockKey': {'S': key}}, ConsistentRead=True).get('Item')
+        if not item or int(item['ExpiresAt']['N']) < time.time():
+            return None
+        return {
+            'Owner': item['Owner']['S'],
+            'ExecutionId': item.get('ExecutionId', {}).get('S'),
+            'ExpiresAt': int(item['ExpiresAt']['N']),
+        }
+
+    def release(self, key, owner):
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={'LockKey': {'S': key}},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'Owner'},
+                ExpressionAttributeValues={':owner': {'S': owner}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+class LocalLockStore:
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key, owner, ttl_seconds):
+        now = time.time()
+        with self.lock:
+            record = self.records.get(key)
+            if record and record['ExpiresAt'] >= now:
+                return False
+            self.records[key] = {'Owner': owner, 'ExecutionId': None, 'ExpiresAt': now + ttl_seconds}
+            return True
+
+    def set_execution_id(self, key, owner, execution_id):
+        with self.lock:
+            record = self.records.get(key)
+            if record and record['Owner'] == owner:
+                record['ExecutionId'] = execution_id
+
+    def get(self, key):
+        with self.lock:
+            record = self.records.get(key)
+            if not record or record['ExpiresAt'] < time.time():
+                return None
+            return dict(record)
+
+    def release(self, key, owner):
+        with self.lock:
+            record = self.records.get(key)
+            if record and record['Owner'] == owner:
+                del self.records[key]
+
+
+lock_store = DynamoDbLockStore(LOCK_TABLE) if LOCK_TABLE else LocalLockStore()
+
+
+class DynamoDbTokenBucketStore:
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.client = boto3.client('dynamodb')
+
+    def take(self, key, rate_per_second, burst):
+        # Take a token from the bucket. Returns 0 when a token was taken, otherwise the seconds to wait before trying
+        # again. Updates of other containers in between are detected with the refill time of the record read.
+        now = time.time()
+        item = self.client.get_item(TableName=self.table_name, Key={'LockKey': {'S': key}}, ConsistentRead=True).get('Item')
+        tokens = float(burst)
+        condition = {'ConditionExpression': 'attribute_not_exists(LockKey)'}
+        if item:
+            refilled_at = item['RefilledAt']['N']
+            tokens = min(burst, float(item['Tokens']['N']) + max(now - float(refilled_at), 0) * rate_per_second)
+            condition = {
+                'ConditionExpression': 'RefilledAt = :refilled_at',
+                'ExpressionAttributeValues': {':refilled_at': {'N': refilled_at}},
+            }
+        if tokens < 1:
+            return (1 - tokens) / rate_per_second
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'LockKey': {'S': key},
+                    'Tokens': {'N': f"{tokens - 1:.6f}"},
+                    'RefilledAt': {'N': f"{now:.6f}"},
+                    'ExpiresAt': {'N': str(int(now) + ADMISSION_RECORD_TTL_SECONDS)},
+                },
+                **condition,
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # Another container took a token in the meantime, read the bucket again
+            return random.uniform(0.005, 0.05)
+        return 0
+
+
+class LocalTokenBucketStore:
+
+    def __init__(self):
+        # key -> (tokens, refilled_at)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate_per_second, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, refilled_at = self.buckets.get(key, (float(burst), now))
+            tokens = min(burst, tokens + (now - refilled_at) * rate_per_second)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / rate_per_second
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+
+
+token_bucket_store = DynamoDbTokenBucketStore(LOCK_TABLE) if LOCK_TABLE else LocalTokenBucketStore()
+
+
+def admit_query_start(session_id, deadline):
+    # Blocks until the session and the workgroup both have a token to start a query. The session token is taken
+    # first, so a caller that waits for the workgroup does not hold back other sessions.
+    start = time.monotonic()
+    wait_deadline = start + ADMISSION_MAX_WAIT_SECONDS
+    if deadline is not None:
+        # Leave the query the larger part of the time, waiting for a start must not use it up
+        wait_deadline = min(wait_deadline, start + (deadline - start) * ADMISSION_MAX_WAIT_FRACTION)
+
+    buckets = [(f"{ADMISSION_KEY_PREFIX}workgroup", ADMISSION_RATE_PER_SECOND, ADMISSION_BURST)]
+    if session_id:
+        digest = sha256(session_id.encode('utf-8')).hexdigest()[:16]
+        buckets.insert(0, (f"{ADMISSION_KEY_PREFIX}session#{digest}", ADMISSION_SESSION_RATE_PER_SECOND, ADMISSION_SESSION_BURST))
+
+    delayed = False
+    for key, rate_per_second, burst in buckets:
+        while True:
+            try:
+                wait = token_bucket_store.take(key, rate_per_second, burst)
+            except ClientError as e:
+                # Admission control must not take the action down with it
+                print(f"Failed to take an admission token from {key}, admitting the query: {e}")
+                break
+            if not wait:
+                break
+            if not delayed:
+                delayed = True
+                add_metric('AdmissionWait', 1)
+            remaining = wait_deadline - time.monotonic()
+            if wait > remaining:
+                add_metric('AdmissionRejected', 1)
+                add_metric('AdmissionWaitTime', (time.monotonic() - start) * 1000)
+                raise QueryThrottledError("Too many queries are starting, retry in a moment.")
+            print(f"Waiting {wait:.2f}s for an admission token from {key}")
+            time.sleep(wait)
+
+    add_metric('AdmissionWaitTime', (time.monotonic() - start) * 1000)
+
+
+def get_deadline(context):
+    # Derive a hard deadline on the monotonic clock from the time the Lambda runtime grants this invocation
+    if context is None:
+        return None
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000.0
+    return time.monotonic() + remaining_seconds - DEADLINE_SAFETY_MARGIN_SECONDS
+
+
+def next_poll_delay(attempt, query_execution):
+    # Exponential backoff, the exponent is capped to keep the float arithmetic bounded
+    delay = POLL_INITIAL_DELAY_SECONDS * (POLL_BACKOFF_FACTOR ** min(attempt, 16))
+
+    # Use the queue and engine times reported by Athena as hints. A query that has already been queued or running
+    # for several seconds is unlikely to complete within the next few milliseconds.
+    statistics = query_execution.get('Statistics', {})
+    if query_execution['Status']['State'] == 'QUEUED':
+        elapsed_millis = statistics.get('QueryQueueTimeInMillis', 0)
+    else:
+        elapsed_millis = statistics.get('EngineExecutionTimeInMillis', 0)
+    delay = max(delay, elapsed_millis / 1000.0 * POLL_HINT_FRACTION)
+    delay = min(delay, POLL_MAX_DELAY_SECONDS)
+
+    # Apply jitter so that concurrent invocations do not poll in lockstep
+    return random.uniform(delay / 2, delay)
+
+
+def stop_query(execution_id):
+    try:
+        athena_client.stop_query_execution(QueryExecutionId=execution_id)
+        print(f"Stopped query execution {execution_id}")
+    except Exception as e:
+        print(f"Failed to stop query execution {execution_id}: {e}")
+
+
+def record_query_duration(query_execution):
+    total_millis = query_execution.get('Statistics', {}).get('TotalExecutionTimeInMillis')
+    if total_millis is None or 'Query' not in query_execution:
+        return
+    fingerprint = query_fingerprint(query_execution['Query'])
+    with query_durations_lock:
+        query_durations[fingerprint] = total_millis / 1000.0
+        query_durations.move_to_end(fingerprint)
+        while len(query_durations) > QUERY_DURATION_HISTORY_SIZE:
+            query_durations.popitem(last=False)
+
+
+def predict_query_seconds(query):
+    # Expected run time based on the last run of the same statement, None if it has not been seen before
+    with query_durations_lock:
+        return query_durations.get(query_fingerprint(query))
+
+
+def wait_for_query(execution_id, deadline, detach=False):
+    # With detach the query keeps running at the deadline and QueryStillRunningError is raised, otherwise it is stopped
+    attempt = 0
+    while True:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']
+        add_metric('PollCount', 1)
+        state = query_execution['Status']['State']
+        if state in TERMINAL_STATES:
+            record_query_duration(query_execution)
+            record_query_statistics(query_execution)
+            return query_execution
+
+        delay = next_poll_delay(attempt, query_execution)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if detach:
+                    raise QueryStillRunningError(execution_id, state)
+                stop_query(execution_id)
+                raise QueryTimeoutError(
+                    f"Query {execution_id} did not complete in the time available and was cancelled. "
+                    "Add filters, e.g. on the date column, or aggregate the data to reduce the amount of data scanned."
+                )
+            delay = min(delay, remaining)
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_data_version():
+    # Returns the current version of the data set or None if the etl job has not published one
+    with data_version_lock:
+        if time.time() - data_version['checked_at'] < DATA_VERSION_CHECK_INTERVAL_SECONDS:
+            return data_version['version']
+
+        bucket = os.environ.get("DATA_BUCKET")
+        if bucket:
+            try:
+                marker = json.loads(s3_client.get_object(Bucket=bucket, Key=DATA_VERSION_KEY)['Body'].read())
+                if marker.get('Version') != data_version['version']:
+                    print(f"Data version changed from {data_version['version']} to {marker.get('Version')}")
+                data_version['version'] = marker.get('Version')
+            except s3_client.exceptions.NoSuchKey:
+                data_version['version'] = None
+            except Exception as e:
+                print(f"Failed to read the data version, keeping {data_version['version']}: {e}")
+        data_version['checked_at'] = time.time()
+        return data_version['version']
+
+
+def execute_athena_query(query, s3_output, wg_name, session_id=None, deadline=None):
+    admit_query_start(session_id, deadline)
+
+    # Athena only reuses the results of identical statements, the version comment keeps them from outliving the data
+    version = get_data_version()
+    max_age_minutes = UNVERSIONED_RESULT_REUSE_MAX_AGE_MINUTES
+    if version:
+        version_tag = re.sub(r'[^\w.:-]', '', version)
+        query = f"{query.rstrip().rstrip(';')}\n/* data-version: {version_tag} */"
+        max_age_minutes = RESULT_REUSE_MAX_AGE_MINUTES
+
+    attempt = 0
+    while True:
+        try:
+            response = athena_client.start_query_execution(
+                QueryString=query,
+                ResultConfiguration={
+                    'OutputLocation': s3_output,
+                    },
+                WorkGroup=wg_name,
+                ResultReuseConfiguration={
+                    'ResultReuseByAgeConfiguration': {
+                        'Enabled': True,
+                        'MaxAgeInMinutes': max_age_minutes
+                        }
                     }
-                }
+            )
+            return response['QueryExecutionId']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                raise
+            # Full jitter backoff, bounded by the retry budget and the invocation deadline
+            delay = random.uniform(0, min(START_RETRY_MAX_SECONDS, START_RETRY_BASE_SECONDS * (2 ** attempt)))
+            if attempt >= START_MAX_RETRIES or (deadline is not None and time.monotonic() + delay >= deadline):
+                raise QueryThrottledError("Athena is throttling new queries, retry in a moment.")
+            print(f"Query start throttled ({e.response['Error']['Code']}), retrying in {delay:.2f}s")
+            add_metric('ThrottleRetries', 1)
+            time.sleep(delay)
+            attempt += 1
+
+
+def tokenize_sql(query):
+    # Split the statement into tokens, dropping comments and whitespace. Keywords and identifiers are lowercased as
+    # Athena treats them case insensitively, string literals keep their case.
+    tokens = []
+    for match in SQL_TOKEN_PATTERN.finditer(query):
+        kind = match.lastgroup
+        if kind in ('comment', 'space'):
+            continue
+        token = match.group()
+        tokens.append(token if kind == 'string' else token.lower())
+    while tokens and tokens[-1] == ';':
+        tokens.pop()
+    return tokens
+
+
+def is_literal(token):
+    return token.startswith("'") or token.replace('.', '', 1).isdigit()
+
+
+def sort_in_lists(tokens):
+    # Sort the literals of IN (...) lists so that the order the values are listed in does not change the fingerprint
+    normalized = []
+    index = 0
+    while index < len(tokens):
+        normalized.append(tokens[index])
+        if tokens[index] == 'in' and index + 1 < len(tokens) and tokens[index + 1] == '(':
+            end = tokens.index(')', index + 1) if ')' in tokens[index + 1:] else -1
+            items = tokens[index + 2:end:2]
+            separators = tokens[index + 3:end:2]
+            if end > 0 and items and all(is_literal(item) for item in items) and all(sep == ',' for sep in separators):
+                normalized.append('(')
+                for position, item in enumerate(sorted(items)):
+                    if position:
+                        normalized.append(',')
+                    normalized.append(item)
+                normalized.append(')')
+                index = end
+        index += 1
+    return normalized
+
+
+def query_fingerprint(query):
+    # Whitespace, comment, case and literal order insensitive fingerprint of a SQL statement
+    normalized = ' '.join(sort_in_lists(tokenize_sql(query)))
+    return sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def is_read_only(query):
+    tokens = tokenize_sql(query)
+    if len(tokens) > 1 and tokens[0] == 'execute' and tokens[1].startswith(PREPARED_STATEMENT_PREFIX):
+        # The statements of the template registry are all SELECT queries
+        return ';' not in tokens
+    return bool(tokens) and tokens[0] in READ_ONLY_STATEMENTS and ';' not in tokens
+
+
+def get_cached_result(fingerprint):
+    # Returns (result, tier) or (None, None) on a miss
+    now = time.time()
+    with result_cache_lock:
+        entry = result_cache.get(fingerprint)
+        if entry is not None:
+            if entry[0] > now:
+                result_cache.move_to_end(fingerprint)
+                return entry[1], 'memory'
+            del result_cache[fingerprint]
+
+    try:
+        response = s3_client.get_object(Bucket=os.environ["ATHENA_DEST_BUCKET"], Key=f"{RESULT_CACHE_PREFIX}{fingerprint}.json")
+        entry = json.loads(response['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    except Exception as e:
+        print(f"Failed to read cached result {fingerprint}: {e}")
+        return None, None
+
+    if entry['ExpiresAt'] <= now:
+        return None, None
+    store_in_memory_cache(fingerprint, entry['ExpiresAt'], entry['Result'])
+    return entry['Result'], 's3'
+
+
+def store_in_memory_cache(fingerprint, expires_at, result):
+    with result_cache_lock:
+        result_cache[fingerprint] = (expires_at, result)
+        result_cache.move_to_end(fingerprint)
+        while len(result_cache) > RESULT_CACHE_MAX_ENTRIES:
+            result_cache.popitem(last=False)
+
+
+def put_cached_result(fingerprint, result):
+    ttl_seconds = RESULT_CACHE_TTL_SECONDS if get_data_version() else UNVERSIONED_RESULT_CACHE_TTL_SECONDS
+    expires_at = time.time() + ttl_seconds
+    store_in_memory_cache(fingerprint, expires_at, result)
+    try:
+        s3_client.put_object(
+            Bucket=os.environ["ATHENA_DEST_BUCKET"],
+            Key=f"{RESULT_CACHE_PREFIX}{fingerprint}.json",
+            Body=json.dumps({'ExpiresAt': expires_at, 'Result': result}).encode('utf-8'),
+            ContentType='application/json',
+        )
+    except Exception as e:
+        print(f"Failed to write cached result {fingerprint}: {e}")
+
+
+def encode_continuation_token(execution_id, next_token, offset):
+    # The marker points at the page that holds the first row not returned yet, and at that row within the page
+    marker = {'QueryExecutionId': execution_id, 'NextToken': next_token, 'Offset': offset}
+    return base64.urlsafe_b64encode(json.dumps(marker).encode('utf-8')).decode('ascii')
+
+
+def decode_continuation_token(continuation_token):
+    try:
+        marker = json.loads(base64.urlsafe_b64decode(continuation_token.encode('ascii')))
+        return marker['QueryExecutionId'], marker['NextToken'], marker['Offset']
+    except Exception:
+        raise ValueError("Invalid ContinuationToken, pass the token exactly as returned by a previous response")
+
+
+def iter_result_pages(execution_id, starting_token=None):
+    # Lazily yields (page_token, page) tuples, where page_token is the token that was used to fetch the page
+    pagination_config = {'PageSize': RESULT_PAGE_SIZE}
+    if starting_token:
+        pagination_config['StartingToken'] = starting_token
+
+    paginator = athena_client.get_paginator('get_query_results')
+    page_token = starting_token
+    for page in paginator.paginate(QueryExecutionId=execution_id, PaginationConfig=pagination_config):
+        yield page_token, page
+        page_token = page.get('NextToken')
+
+
+def extract_values(row):
+    # Athena omits VarCharValue for NULL values
+    return [datum.get('VarCharValue') for datum in row['Data']]
+
+
+def iter_result_object_lines(bucket, key, start, position):
+    # Lazily yields the lines of the result object from the byte offset start, fetched with ranged GETs. position['end']
+    # is kept at the offset after the last line yielded.
+    offset = start
+    pending = b''
+    size = None
+    while size is None or offset < size:
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + RESULT_STREAM_CHUNK_BYTES - 1}")
+        chunk = response['Body'].read()
+        size = int(response['ContentRange'].rsplit('/', 1)[1])
+        offset += len(chunk)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            # Multi byte UTF-8 characters never contain a newline byte, so lines can be decoded one at a time
+            position['end'] += len(line) + 1
+            yield line.decode('utf-8') + '\n'
+    if pending:
+        position['end'] += len(pending)
+        yield pending.decode('utf-8')
+
+
+def stream_result_object(execution_id, column_info, start, skip, rows, result_bytes, max_rows, max_bytes):
+    # Continue a result from the CSV object Athena wrote, at the byte offset start after skipping skip records
+    query_execution = athena_client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']
+    bucket, key = re.match(r's3://([^/]+)/(.+)', query_execution['ResultConfiguration']['OutputLocation']).groups()
+    print(f"Streaming the result of {execution_id} from s3://{bucket}/{key} at byte {start}")
+
+    position = {'end': start}
+    record_start = start
+    continuation_token = None
+    empty_as_null = RESULT_CSV_QUOTING == csv.QUOTE_MINIMAL
+    for values in csv.reader(iter_result_object_lines(bucket, key, start, position), quoting=RESULT_CSV_QUOTING):
+        if skip:
+            skip -= 1
+            record_start = position['end']
+            continue
+        if empty_as_null:
+            values = [value if value != '' else None for value in values]
+        row_bytes = len(json.dumps(values))
+        if len(rows) >= max_rows or result_bytes + row_bytes > max_bytes:
+            continuation_token = encode_continuation_token(execution_id, f"{RESULT_STREAM_TOKEN_PREFIX}{record_start}", 0)
+            break
+        rows.append(values)
+        result_bytes += row_bytes
+        record_start = position['end']
+
+    add_metric('RowsStreamed', len(rows))
+    return {
+        'ColumnInfo': column_info,
+        'Rows': rows,
+        'Truncated': continuation_token is not None,
+        'ContinuationToken': continuation_token,
+    }
+
+
+def read_query_results(execution_id, starting_token=None, offset=0, max_rows=MAX_RESULT_ROWS, max_bytes=MAX_RESULT_BYTES):
+    if starting_token and starting_token.startswith(RESULT_STREAM_TOKEN_PREFIX):
+        # The column types are only available from GetQueryResults
+        result_set = athena_client.get_query_results(QueryExecutionId=execution_id, MaxResults=1)['ResultSet']
+        column_info = result_set.get('ResultSetMetadata', {}).get('ColumnInfo', [])
+        start = int(starting_token[len(RESULT_STREAM_TOKEN_PREFIX):])
+        return stream_result_object(execution_id, column_info, start, 0, [], 0, max_rows, max_bytes)
+
+    rows = []
+    column_info = []
+    result_bytes = 0
+    continuation_token = None
+    # Records of the pages read so far, the header record included
+    records_read = 0
+
+    for page_token, page in iter_result_pages(execution_id, starting_token):
+        page_rows = page['ResultSet'].get('Rows', [])
+        if not column_info:
+            column_info = page['ResultSet'].get('ResultSetMetadata', {}).get('ColumnInfo', [])
+            # The first row of a SELECT result repeats the column names, the typed header replaces it
+            column_names = [column['Name'] for column in column_info]
+            if page_token is None and offset == 0 and page_rows and extract_values(page_rows[0]) == column_names:
+                offset = 1
+        for index in range(offset, len(page_rows)):
+            values = extract_values(page_rows[index])
+            row_bytes = len(json.dumps(values))
+            if len(rows) >= max_rows or result_bytes + row_bytes > max_bytes:
+                continuation_token = encode_continuation_token(execution_id, page_token, index)
+                break
+            rows.append(values)
+            result_bytes += row_bytes
+        records_read += len(page_rows)
+        offset = 0
+        if continuation_token:
+            # Stop here so that the remaining pages are never fetched
+            break
+
+        # Large reads that start in the first page of a SELECT result continue from the CSV object, skipping the
+        # records of that page
+        if (page.get('NextToken') and page_token is None and max_rows - len(rows) > RESULT_STREAM_THRESHOLD_ROWS
+                and page_rows and extract_values(page_rows[0]) == column_names):
+            return stream_result_object(execution_id, column_info, 0, records_read, rows, result_bytes,
+                                        max_rows, max_bytes)
+
+    return {
+        'ColumnInfo': column_info,
+        'Rows': rows,
+        'Truncated': continuation_token is not None,
+        'ContinuationToken': continuation_token,
+    }
+
+
+def get_query_results(execution_id, deadline, detach=False):
+    query_execution = wait_for_query(execution_id, deadline, detach)
+    status = query_execution['Status']['State']
+
+    if status == 'SUCCEEDED':
+        return read_query_results(execution_id)
+    else:
+        reason = query_execution['Status'].get('StateChangeReason', '')
+        raise QueryFailedError(f"Query failed with status '{status}': {reason}")
+
+
+def get_request_property(event, name, default=None):
+    # The bedrock function call passes the request body as a list of named properties
+    properties = event.get('requestBody', {}).get('content', {}).get('application/json', {}).get('properties', [])
+    for prop in properties:
+        if prop.get('name') == name:
+            return prop.get('value')
+    return default
+
+
+def convert_value(value, column_type):
+    if value is None:
+        return None
+    try:
+        if column_type in INTEGER_TYPES:
+            return int(value)
+        if column_type in FLOAT_TYPES:
+            number = float(value)
+            # NaN and Infinity are not valid JSON, keep them as text
+            return number if math.isfinite(number) else value
+        if column_type == 'boolean':
+            return value == 'true'
+    except ValueError:
+        pass
+    return value
+
+
+def encode_result_rows(column_info, rows, result_format):
+    # The typed header lists each column as name:type, e.g. "city:varchar"
+    columns = [f"{column['Name']}:{column['Type']}" for column in column_info]
+    column_names = [column['Name'] for column in column_info]
+
+    if result_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(column_names)
+        writer.writerows(['' if value is None else value for value in row] for row in rows)
+        return {'Columns': columns, 'Table': buffer.getvalue()}
+
+    if result_format == 'markdown':
+        def cell(value):
+            return '' if value is None else str(value).replace('|', '\\|')
+        lines = ['| ' + ' | '.join(column_names) + ' |', '|' + '---|' * len(column_names)]
+        lines.extend('| ' + ' | '.join(cell(value) for value in row) + ' |' for row in rows)
+        return {'Columns': columns, 'Table': '\n'.join(lines)}
+
+    column_types = [column['Type'] for column in column_info]
+    typed_rows = [[convert_value(value, column_type) for value, column_type in zip(row, column_types)] for row in rows]
+    return {'Columns': columns, 'Rows': typed_rows}
+
+
+def measure_encoding(column_info, rows, encoded):
+    # Compare the encoded payload with the ResultSet structure GetQueryResults would have returned for the same rows
+    raw = {
+        'Rows': [{'Data': [{} if value is None else {'VarCharValue': value} for value in row]} for row in rows],
+        'ResultSetMetadata': {'ColumnInfo': column_info},
+    }
+    raw_bytes = len(json.dumps(raw))
+    encoded_bytes = len(json.dumps(encoded))
+    saved_bytes = max(raw_bytes - encoded_bytes, 0)
+    return {
+        'RawBytes': raw_bytes,
+        'EncodedBytes': encoded_bytes,
+        'SavedBytes': saved_bytes,
+        'EstimatedTokensSaved': saved_bytes // CHARS_PER_TOKEN,
+    }
+
+
+def get_result_format(event):
+    result_format = (get_request_property(event, 'Format') or DEFAULT_RESULT_FORMAT).lower()
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Unsupported Format '{result_format}', use one of: {', '.join(RESULT_FORMATS)}")
+    return result_format
+
+
+def sync_local_data(deadline=None):
+    # Mirror the parquet files of the data set to local storage. Returns False when the data set is too large for the
+    # fast path and None when the sync budget ran out before the mirror was complete. Only objects whose ETag changed
+    # since the last sync are downloaded again.
+    sync_deadline = time.monotonic() + FAST_PATH_SYNC_MAX_SECONDS
+    if deadline is not None:
+        sync_deadline = min(sync_deadline, time.monotonic() + (deadline - time.monotonic()) / 2)
+    bucket = os.environ.get("DATA_BUCKET")
+    if not bucket:
+        return False
+
+    objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=DATA_PROC_PREFIX):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.parquet'):
+                objects[obj['Key']] = obj
+
+    total_bytes = sum(obj['Size'] for obj in objects.values())
+    if not objects or total_bytes > FAST_PATH_MAX_DATA_BYTES:
+        print(f"Fast path disabled for {len(objects)} objects with {total_bytes} bytes")
+        return False
+
+    etags = fast_path['etags']
+    for key, obj in objects.items():
+        local_path = os.path.join(FAST_PATH_CACHE_DIR, key[len(DATA_PROC_PREFIX):])
+        if etags.get(key) != obj['ETag'] or not os.path.exists(local_path):
+            if time.monotonic() >= sync_deadline:
+                print("Fast path sync budget exhausted, the mirror is continued by the next request")
+                return None
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            s3_client.download_file(bucket, key, local_path)
+            etags[key] = obj['ETag']
+
+    # Remove files that the etl job no longer lists, e.g. after a partition was rewritten
+    for key in list(etags):
+        if key not in objects:
+            local_path = os.path.join(FAST_PATH_CACHE_DIR, key[len(DATA_PROC_PREFIX):])
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            del etags[key]
+
+    return True
+
+
+def create_fast_path_connection():
+    connection = duckdb.connect()
+    connection.execute(f"CREATE SCHEMA IF NOT EXISTS {GLUE_DATABASE}")
+    # Athena truncates integer division, DuckDB returns a double unless told otherwise
+    connection.execute("SET GLOBAL integer_division = true")
+    # The agent's SQL runs on this connection. It may only read the mirror, not local files, other databases or
+    # extensions, and it can't change that. Replacing the data_proc view on later syncs is still allowed.
+    connection.execute(f"SET allowed_directories = ['{FAST_PATH_CACHE_DIR}']")
+    connection.execute("SET enable_external_access = false")
+    connection.execute("SET lock_configuration = true")
+    return connection
+
+
+def get_fast_path_connection(deadline=None):
+    # Returns a DuckDB connection with the data set registered as data_set_db.data_proc, or None if unavailable
+    version = get_data_version()
+    with fast_path_lock:
+        # A new data version is synced right away, its results are cached under the new version
+        if time.time() - fast_path['synced_at'] < FAST_PATH_SYNC_INTERVAL_SECONDS and fast_path['version'] == version:
+            return fast_path['connection'] if fast_path['available'] else None
+
+        fast_path['synced_at'] = time.time()
+        fast_path['version'] = version
+        try:
+            available = sync_local_data(deadline)
+        except Exception as e:
+            print(f"Failed to sync the fast path data set: {e}")
+            available = False
+        if available is None:
+            # Continue the mirror with the next request
+            fast_path['synced_at'] = 0.0
+        fast_path['available'] = bool(available)
+        if not fast_path['available']:
+            return None
+
+        if fast_path['connection'] is None:
+            fast_path['connection'] = create_fast_path_connection()
+
+        # The date partition key is a string in the Glue catalog, keep it that way instead of inferring a DATE
+        parquet_glob = os.path.join(FAST_PATH_CACHE_DIR, '**', '*.parquet')
+        fast_path['connection'].execute(
+            f"CREATE OR REPLACE VIEW {GLUE_DATABASE}.{DATA_PROC_TABLE} AS SELECT * FROM read_parquet("
+            f"'{parquet_glob}', hive_partitioning = true, hive_types = {{'date': VARCHAR}})"
         )
-        return response['QueryExecutionId']
+        return fast_path['connection']
+
 
-    def check_query_status(execution_id):
-        response = athena_client.get_query_execution(QueryExecutionId=execution_id)
-        return response['QueryExecution']['Status']['State']
+def to_athena_value(value):
+    # Render values the way Athena renders VarCharValue
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
 
-    def get_query_results(execution_id):
+
+def run_fast_path_query(query, deadline, max_rows=MAX_RESULT_ROWS, max_bytes=MAX_RESULT_BYTES):
+    # Returns a result in the same shape as read_query_results, or None if the query has to run on Athena
+    if not FAST_PATH_ENABLED or duckdb is None:
+        return None
+    tokens = tokenize_sql(query)
+    if not tokens or tokens[0] not in ('select', 'with') or DATA_PROC_TABLE not in (t.strip('"') for t in tokens):
+        return None
+
+    connection = get_fast_path_connection(deadline)
+    if connection is None:
+        return None
+
+    # Tables of the default Athena catalog are addressed without the catalog name in DuckDB
+    local_query = re.sub(r'"?awsdatacatalog"?\.', '', query, flags=re.IGNORECASE).rstrip().rstrip(';')
+    # The search path is per cursor and can still be set under the locked configuration
+    cursor = connection.cursor()
+    cursor.execute(f"SET search_path = '{GLUE_DATABASE},main'")
+    timer = None
+    if deadline is not None:
+        timer = threading.Timer(max(deadline - time.monotonic(), 0), cursor.interrupt)
+        timer.start()
+    try:
+        cursor.execute(local_query)
+        column_info = [{'Name': name, 'Type': DUCKDB_TYPES.get(str(column_type).split('(')[0], str(column_type).lower())}
+                       for name, column_type, *_ in cursor.description]
+        rows = []
+        result_bytes = 0
         while True:
-            status = check_query_status(execution_id)
-            if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+            batch = cursor.fetchmany(RESULT_PAGE_SIZE)
+            if not batch:
                 break
-            sleep(1)  # Polling interval
+            for record in batch:
+                values = [to_athena_value(value) for value in record]
+                result_bytes += len(json.dumps(values))
+                rows.append(values)
+                if len(rows) > max_rows or result_bytes > max_bytes:
+                    # Only Athena results can be continued, run large results there
+                    print("Fast path result exceeds the response budget, falling back to Athena")
+                    return None
+    except Exception as e:
+        if deadline is not None and time.monotonic() >= deadline:
+            raise QueryTimeoutError("The query did not complete in the time available and was cancelled.")
+        print(f"Fast path cannot run the query, falling back to Athena: {e}")
+        return None
+    finally:
+        if timer is not None:
+            timer.cancel()
+        cursor.close()
+
+    return {'ColumnInfo': column_info, 'Rows': rows, 'Truncated': False, 'ContinuationToken': None}
+
+
+def load_table_schema(table):
+    partitions = []
+    paginator = glue_client.get_paginator('get_partitions')
+    for page in paginator.paginate(DatabaseName=GLUE_DATABASE, TableName=DATA_PROC_TABLE):
+        partitions.extend(partition['Values'][0] for partition in page['Partitions'] if partition.get('Values'))
+
+    return {
+        'Database': GLUE_DATABASE,
+        'Table': DATA_PROC_TABLE,
+        'Columns': [f"{column['Name']}:{column['Type']}" for column in table['StorageDescriptor']['Columns']],
+        'PartitionKeys': [f"{key['Name']}:{key['Type']}" for key in table.get('PartitionKeys', [])],
+        'Partitions': sorted(partitions),
+        'VersionId': table.get('VersionId'),
+    }
+
+
+def get_table_metadata():
+    with table_metadata_lock:
+        now = time.time()
+        if table_metadata['schema'] is not None and now - table_metadata['checked_at'] < SCHEMA_CHECK_INTERVAL_SECONDS:
+            return table_metadata['schema']
+
+        table = glue_client.get_table(DatabaseName=GLUE_DATABASE, Name=DATA_PROC_TABLE)['Table']
+        table_metadata['checked_at'] = now
+        version = (table.get('VersionId'), table.get('UpdateTime'))
+        if (table_metadata['schema'] is None or version != table_metadata['version']
+                or now - table_metadata['loaded_at'] >= PARTITIONS_TTL_SECONDS):
+            print(f"Loading the schema of {GLUE_DATABASE}.{DATA_PROC_TABLE} version {version[0]} updated at {version[1]}")
+            table_metadata.update(schema=load_table_schema(table), version=version, loaded_at=now)
+        return table_metadata['schema']
+
+
+def get_table_stats():
+    # Returns ({partition value: bytes}, [data column names]) of the data_proc table, refreshed every few minutes
+    version = get_data_version()
+    with table_stats_lock:
+        if time.time() - table_stats['listed_at'] < TABLE_STATS_TTL_SECONDS and table_stats['version'] == version:
+            return table_stats['partitions'], table_stats['columns']
+
+        partitions = {}
+        bucket = os.environ.get("DATA_BUCKET")
+        if bucket:
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=DATA_PROC_PREFIX):
+                for obj in page.get('Contents', []):
+                    match = re.search(rf'/{PARTITION_KEY}=([^/]+)/', obj['Key'])
+                    if match:
+                        partitions[match.group(1)] = partitions.get(match.group(1), 0) + obj['Size']
+
+        columns = [column.split(':')[0] for column in get_table_metadata()['Columns']]
+
+        table_stats.update(listed_at=time.time(), partitions=partitions, columns=columns, version=version)
+        return partitions, columns
+
+
+def token_depths(tokens):
+    # Parenthesis nesting depth of every token
+    depths = []
+    depth = 0
+    for token in tokens:
+        if token == ')':
+            depth -= 1
+        depths.append(depth)
+        if token == '(':
+            depth += 1
+    return depths
+
 
-        if status == 'SUCCEEDED':
-            return athena_client.get_query_results(QueryExecutionId=execution_id)
+def unquote(token):
+    return token[1:-1] if len(token) > 1 and token[0] == token[-1] and token[0] in '"\'' else token
+
+
+def select_partitions(tokens, partitions):
+    # Evaluate the comparisons of the partition key with literals against the known partition values. Returns the
+    # partition values the statement can read and whether any comparison was understood.
+    selected = set(partitions)
+    constrained = False
+    for index, token in enumerate(tokens[:-2]):
+        # Skip casts such as CAST(x AS date)
+        if unquote(token) != PARTITION_KEY or (index > 0 and tokens[index - 1] == 'as'):
+            continue
+        operator, position = tokens[index + 1], index + 2
+        if operator in ('<', '>', '!') and tokens[position] in ('=', '>'):
+            operator += tokens[position]
+            position += 1
+        if position >= len(tokens):
+            continue
+
+        if operator in ('=', '<', '<=', '>', '>=') and is_literal(tokens[position]):
+            value = unquote(tokens[position])
+            compare = {
+                '=': lambda partition: partition == value,
+                '<': lambda partition: partition < value,
+                '<=': lambda partition: partition <= value,
+                '>': lambda partition: partition > value,
+                '>=': lambda partition: partition >= value,
+            }[operator]
+        elif operator == 'between' and position + 2 < len(tokens) and is_literal(tokens[position]) and is_literal(tokens[position + 2]):
+            low, high = unquote(tokens[position]), unquote(tokens[position + 2])
+            compare = lambda partition: low <= partition <= high
+        elif operator == 'in' and tokens[position] == '(':
+            end = tokens.index(')', position) if ')' in tokens[position:] else len(tokens)
+            values = {unquote(item) for item in tokens[position + 1:end] if is_literal(item)}
+            compare = lambda partition: partition in values
         else:
-            raise Exception(f"Query failed with status '{status}'")
+            continue
 
-    action_group = event.get('actionGroup')
-    api_path = event.get('apiPath')
+        selected = {partition for partition in selected if compare(partition)}
+        constrained = True
+    return selected, constrained
 
-    print("api_path: ", api_path)
 
-    result = ''
-    response_code = 200
+def where_clause_tokens(tokens, depths):
+    # Tokens of the WHERE clauses of the statement, a clause ends at the next clause keyword of its query or at the
+    # parenthesis closing the subquery it is in
+    clause_tokens = []
+    for start, token in enumerate(tokens):
+        if token != 'where':
+            continue
+        depth = depths[start]
+        for index in range(start + 1, len(tokens)):
+            if depths[index] < depth or (depths[index] == depth and tokens[index] in WHERE_CLAUSE_END):
+                break
+            clause_tokens.append(tokens[index])
+    return clause_tokens
+
+
+def analyze_query(tokens, partitions, columns):
+    depths = token_depths(tokens)
+    top_level = [token for token, depth in zip(tokens, depths) if depth == 0]
+
+    # The final SELECT of the statement decides the shape of the result, earlier ones belong to WITH clauses
+    last_select = max((index for index, token in enumerate(tokens) if token == 'select' and depths[index] == 0), default=0)
+    select_list = []
+    for token, depth in zip(tokens[last_select + 1:], depths[last_select + 1:]):
+        if depth == 0 and token == 'from':
+            break
+        select_list.append(token)
+
+    aggregated = 'group' in top_level or any(
+        token in AGGREGATE_FUNCTIONS and following == '(' for token, following in zip(select_list, select_list[1:] + ['']))
+    if 'over' in select_list:
+        aggregated = 'group' in top_level
+    select_star = any(token == '*' and previous in ('select', 'distinct', 'all', '.') for previous, token in zip(tokens, tokens[1:]))
 
+    # Only a predicate on the partition key limits the partitions read, a reference in ORDER BY or the select list does not
+    where_tokens = where_clause_tokens(tokens, depths)
+    has_date_filter = any(unquote(token) == PARTITION_KEY and previous != 'as'
+                          for previous, token in zip([''] + where_tokens, where_tokens))
+    selected, constrained = select_partitions(tokens, partitions)
+    if not constrained:
+        selected = set(partitions)
 
-    if api_path == '/athenaQuery':
-        result = athena_query_handler(event)
+    # Parquet is columnar, only the referenced data columns are read from the selected partitions
+    if select_star or not columns:
+        projected_fraction = 1.0
     else:
-        response_code = 404
-        result = {"error": f"Unrecognized api path: {action_group}::{api_path}"}
+        referenced = {unquote(token) for token in tokens} & set(columns)
+        projected_fraction = max(len(referenced), 1) / len(columns)
 
-    response_body = {
-        'application/json': {
-            'body': result
-        }
+    return {
+        'HasLimit': 'limit' in top_level or 'fetch' in top_level,
+        'Aggregated': aggregated,
+        'SelectStar': select_star,
+        'HasDateFilter': has_date_filter,
+        'PartitionsScanned': len(selected),
+        'PartitionsTotal': len(partitions),
+        'EstimatedBytesScanned': int(sum(partitions[partition] for partition in selected) * projected_fraction),
+    }
+
+
+def split_sql(query):
+    # Tokens of the statement with their original text, whitespace included, so that a rewrite can be joined back
+    return [[match.lastgroup, match.group()] for match in SQL_TOKEN_PATTERN.finditer(query) if match.lastgroup != 'comment']
+
+
+def word_at(parts, words, position):
+    # Lowercased text of the non-whitespace token at position, empty past the end of the statement
+    return parts[words[position]][1].lower() if position < len(words) else ''
+
+
+def find_closing(parts, words, position):
+    # Position in words of the parenthesis closing the one at position
+    depth = 0
+    for index in range(position, len(words)):
+        token = parts[words[index]][1]
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+            if depth == 0:
+                return index
+    raise QueryRejectedError("The query has unbalanced parentheses.")
+
+
+def has_top_level_comma(parts, words, position):
+    # Whether the parenthesis at position holds several arguments
+    depth = 0
+    for index in range(position, find_closing(parts, words, position)):
+        token = parts[words[index]][1]
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif token == ',' and depth == 1:
+            return True
+    return False
+
+
+def rewrite_approximate_functions(parts, words, rewrites):
+    # count(DISTINCT x) -> approx_distinct(x), median(x) -> approx_percentile(x, 0.5) and
+    # percentile_cont(f) WITHIN GROUP (ORDER BY x) -> approx_percentile(x, f). count(DISTINCT a, b) is left alone,
+    # the second argument of approx_distinct is its maximum standard error and not a column.
+    lower = partial(word_at, parts, words)
+    for position in range(len(words)):
+        token = lower(position)
+        if token == 'count' and lower(position + 1) == '(' and lower(position + 2) == 'distinct':
+            if has_top_level_comma(parts, words, position + 1):
+                continue
+            parts[words[position]][1] = 'approx_distinct'
+            for index in range(words[position + 2], words[position + 3]):
+                parts[index][1] = ''
+            rewrites.add('count(DISTINCT) -> approx_distinct')
+        elif token == 'median' and lower(position + 1) == '(':
+            parts[words[position]][1] = 'approx_percentile'
+            closing = find_closing(parts, words, position + 1)
+            parts[words[closing]][1] = ', 0.5)'
+            rewrites.add('median -> approx_percentile')
+        elif token == 'percentile_cont' and lower(position + 1) == '(':
+            closing = find_closing(parts, words, position + 1)
+            if lower(closing + 1) != 'within' or lower(closing + 2) != 'group' or lower(closing + 4) != 'order':
+                continue
+            group_closing = find_closing(parts, words, closing + 3)
+            fraction = ''.join(part[1] for part in parts[words[position + 2]:words[closing]]).strip()
+            expression_end = group_closing
+            if lower(group_closing - 1) in ('asc', 'desc'):
+                expression_end -= 1
+                if lower(group_closing - 1) == 'desc':
+                    fraction = f"1 - {fraction}"
+            expression = ''.join(part[1] for part in parts[words[closing + 6]:words[expression_end]]).strip()
+            parts[words[position]][1] = f"approx_percentile({expression}, {fraction})"
+            for index in range(words[position] + 1, words[group_closing] + 1):
+                parts[index][1] = ''
+            rewrites.add('percentile_cont -> approx_percentile')
+
+
+def apply_table_sample(parts, words, sample_percent):
+    # Sample every reference of the data_proc table and scale counts and sums by the inverse of the sample rate.
+    # Returns False when the statement has several SELECTs, scaling nested aggregates would be wrong.
+    lower = partial(word_at, parts, words)
+    if sum(1 for position in range(len(words)) if lower(position) == 'select') != 1:
+        return False
+
+    factor = 100 / sample_percent
+    factor_text = str(int(factor)) if factor == int(factor) else repr(round(factor, 6))
+    for position in range(len(words)):
+        if unquote(lower(position)) != DATA_PROC_TABLE or lower(position + 1) == '.':
+            continue
+        end = position
+        if lower(end + 1) == 'as':
+            end += 2
+        elif end + 1 < len(words) and lower(end + 1) not in TABLE_REFERENCE_END:
+            end += 1
+        parts[words[end]][1] += f" TABLESAMPLE BERNOULLI ({sample_percent:g})"
+
+    scaled_end = -1
+    for position in range(len(words)):
+        # Aggregates nested in an aggregate that is already scaled, e.g. sum(count(*)) OVER (), are left alone
+        if position <= scaled_end or lower(position) not in SAMPLE_SCALED_FUNCTIONS or lower(position + 1) != '(':
+            continue
+        end = find_closing(parts, words, position + 1)
+        # Window and filter clauses belong to the aggregate, the factor goes after them
+        while lower(end + 1) in ('over', 'filter') and lower(end + 2) == '(':
+            end = find_closing(parts, words, end + 2)
+        # Parenthesize the scaled aggregate so the factor binds to it alone, e.g. in sum(a) / count(*)
+        parts[words[position]][1] = '(' + parts[words[position]][1]
+        parts[words[end]][1] += f" * {factor_text})"
+        scaled_end = end
+    return True
+
+
+def approximate_query(query, sample_percent=None):
+    # Returns the rewritten statement and a report of the approximations with their error bounds, None if the
+    # statement has nothing to approximate
+    parts = split_sql(query)
+    words = [index for index, (kind, _) in enumerate(parts) if kind != 'space']
+    rewrites = set()
+    rewrite_approximate_functions(parts, words, rewrites)
+
+    error_bounds = []
+    if 'count(DISTINCT) -> approx_distinct' in rewrites:
+        error_bounds.append(f"approx_distinct has a standard error of {APPROX_DISTINCT_STANDARD_ERROR:.1%}")
+    if rewrites - {'count(DISTINCT) -> approx_distinct'}:
+        error_bounds.append(f"approx_percentile values are within about {APPROX_PERCENTILE_RANK_ERROR:.0%} of the exact rank")
+
+    sampled = False
+    if sample_percent is not None and DATA_PROC_TABLE in (unquote(token) for token in tokenize_sql(query)):
+        sampled = apply_table_sample(parts, words, sample_percent)
+        if sampled:
+            fraction = sample_percent / 100
+            error_bounds.append(
+                f"Counts and sums are scaled up from a {sample_percent:g}% Bernoulli sample. A scaled count c has a "
+                f"95% confidence interval of about c +/- 1.96 * sqrt(c * {1 - fraction:g} / {fraction:g}); averages "
+                "and percentiles are unbiased, distinct counts are not scaled and underestimate. min and max only "
+                "see the sampled rows, they are biased towards the middle of the data and are not within this bound.")
+        else:
+            error_bounds.append("The query has nested SELECTs and was not sampled, only the aggregates were approximated.")
+
+    if not error_bounds:
+        return query, None
+    return ''.join(part[1] for part in parts), {
+        'Rewrites': sorted(rewrites),
+        'SamplePercent': sample_percent if sampled else None,
+        'ErrorBounds': error_bounds,
     }
 
-    action_response = {
-        'actionGroup': action_group,
-        'apiPath': api_path,
-        'httpMethod': event.get('httpMethod'),
-        'httpStatusCode': response_code,
-        'responseBody': response_body
+
+def plan_approximation(query, approximate, latency_budget_ms, sample_percent):
+    # Returns the statement to run and the approximation report. A latency budget switches to the approximate
+    # functions when the last run of the statement was slower or it has not been seen before, and samples as well
+    # when it is known to be slower.
+    if sample_percent is not None:
+        try:
+            sample_percent = float(sample_percent)
+        except ValueError:
+            raise ValueError(f"SamplePercent must be a number, got {sample_percent!r}")
+        if not 0 < sample_percent <= 100:
+            raise ValueError("SamplePercent must be greater than 0 and at most 100")
+        approximate = True
+
+    if latency_budget_ms is not None and not approximate:
+        try:
+            budget_seconds = float(latency_budget_ms) / 1000
+        except ValueError:
+            raise ValueError(f"LatencyBudgetMs must be a number, got {latency_budget_ms!r}")
+        predicted_seconds = predict_query_seconds(query)
+        if predicted_seconds is not None and predicted_seconds <= budget_seconds:
+            return query, None
+        approximate = True
+        if predicted_seconds is not None:
+            sample_percent = APPROX_DEFAULT_SAMPLE_PERCENT
+
+    if not approximate:
+        return query, None
+    query, report = approximate_query(query, sample_percent)
+    if report:
+        print("Approximated query: ", query, report)
+    return query, report
+
+
+def govern_query(query, default_limit=GOVERNOR_DEFAULT_LIMIT):
+    # Returns the statement to run, possibly with a LIMIT injected, and a report of the analysis
+    tokens = tokenize_sql(query)
+    if GOVERNOR_MODE == 'off' or DATA_PROC_TABLE not in (unquote(token) for token in tokens):
+        return query, None
+    if tokens[0] not in ('select', 'with'):
+        # Metadata statements such as DESCRIBE and SHOW COLUMNS scan no data
+        if is_read_only(query):
+            return query, None
+        raise QueryRejectedError(f"Only SELECT queries can run on {GLUE_DATABASE}.{DATA_PROC_TABLE}.")
+
+    try:
+        partitions, columns = get_table_stats()
+    except Exception as e:
+        print(f"Failed to read the table statistics, the query is not governed: {e}")
+        return query, None
+
+    report = analyze_query(tokens, partitions, columns)
+    add_metric('EstimatedBytesScanned', report['EstimatedBytesScanned'])
+    report['Warnings'] = []
+    if report['SelectStar']:
+        report['Warnings'].append("SELECT * reads every column, select only the columns needed to answer the question.")
+    if not report['HasDateFilter']:
+        report['Warnings'].append(
+            f"The query has no filter on the {PARTITION_KEY} column and reads all {report['PartitionsTotal']} partitions.")
+    print("Query governor report: ", report)
+
+    if GOVERNOR_MODE != 'enforce':
+        return query, report
+
+    if not report['HasDateFilter'] and report['EstimatedBytesScanned'] > GOVERNOR_MAX_SCAN_BYTES:
+        available = ', '.join(sorted(partitions))
+        raise QueryRejectedError(
+            f"The query would scan about {report['EstimatedBytesScanned'] / (1024 * 1024):.1f} MB across all "
+            f"{report['PartitionsTotal']} partitions. Add a filter on the {PARTITION_KEY} column, e.g. "
+            f"WHERE {PARTITION_KEY} = '{max(partitions)}', and select only the columns needed. Available dates: {available}"
+        )
+
+    if default_limit is not None and not report['HasLimit'] and not report['Aggregated']:
+        query = f"{query.rstrip().rstrip(';').rstrip()}\nLIMIT {default_limit}"
+        report['InjectedLimit'] = default_limit
+    return query, report
+
+
+def get_cache_fingerprint(query):
+    # Returns the result cache key of the query, or None if its result must not be cached
+    if RESULT_CACHE_ENABLED and is_read_only(query):
+        version = get_data_version()
+        if version:
+            return sha256(f"{version}:{query_fingerprint(query)}".encode('utf-8')).hexdigest()
+        return query_fingerprint(query)
+    return None
+
+
+def run_local_query(query, fingerprint, deadline, max_rows=MAX_RESULT_ROWS, max_bytes=MAX_RESULT_BYTES):
+    # Answer the query from the result cache or the fast path, returns (result, cache tier or None) and a None result
+    # when the query has to run on Athena
+    if fingerprint:
+        result, tier = get_cached_result(fingerprint)
+        if result is not None:
+            print(f"Result cache hit ({tier}) for fingerprint {fingerprint}")
+            add_metric('CacheHit', 1)
+            return result, tier
+
+    result = run_fast_path_query(query, deadline, max_rows, max_bytes)
+    if result is not None:
+        add_metric('FastPathHit', 1)
+        if fingerprint:
+            put_cached_result(fingerprint, result)
+    return result, None
+
+
+def start_or_attach(query, fingerprint, s3_output, wg_name, session_id=None, deadline=None):
+    # Returns (execution id, owner). The owner is None when the caller attached to the execution of another caller,
+    # otherwise the lock has to be released with release_query_lock once the query has completed.
+    if not fingerprint:
+        return execute_athena_query(query, s3_output, wg_name, session_id, deadline), None
+
+    owner = str(uuid.uuid4())
+    attach_deadline = time.monotonic() + LOCK_ATTACH_WAIT_SECONDS
+    while True:
+        try:
+            acquired = lock_store.acquire(fingerprint, owner, LOCK_TTL_SECONDS)
+        except Exception as e:
+            print(f"Failed to acquire the query lock, running the query without coalescing: {e}")
+            return execute_athena_query(query, s3_output, wg_name, session_id, deadline), None
+
+        if acquired:
+            try:
+                execution_id = execute_athena_query(query, s3_output, wg_name, session_id, deadline)
+            except Exception:
+                release_query_lock(fingerprint, owner)
+                raise
+            try:
+                lock_store.set_execution_id(fingerprint, owner, execution_id)
+            except Exception as e:
+                print(f"Failed to publish execution {execution_id} on the query lock: {e}")
+            return execution_id, owner
+
+        record = lock_store.get(fingerprint)
+        if record and record['ExecutionId']:
+            print(f"Attaching to query execution {record['ExecutionId']} started by another caller")
+            add_metric('SingleFlightAttach', 1)
+            return record['ExecutionId'], None
+        if time.monotonic() >= attach_deadline:
+            print("The owner of the query lock did not publish an execution, running the query without coalescing")
+            return execute_athena_query(query, s3_output, wg_name, session_id, deadline), None
+        # The owner is still starting the query, or has just released the lock
+        time.sleep(0.05)
+
+
+def release_query_lock(fingerprint, owner):
+    if owner:
+        try:
+            lock_store.release(fingerprint, owner)
+        except Exception as e:
+            print(f"Failed to release the query lock {fingerprint}: {e}")
+
+
+def run_query(query, s3_output, wg_name, deadline, run_async=False, session_id=None):
+    # Serve repeated read-only queries from the result cache, returns (result, cache tier or None). Raises
+    # QueryStillRunningError when the query continues asynchronously.
+    fingerprint = get_cache_fingerprint(query)
+    result, tier = run_local_query(query, fingerprint, deadline)
+    if result is not None:
+        return result, tier
+
+    execution_id, owner = start_or_attach(query, fingerprint, s3_output, wg_name, session_id, deadline)
+    try:
+        if ASYNC_ENABLED:
+            predicted_seconds = predict_query_seconds(query)
+            if run_async or (predicted_seconds is not None and predicted_seconds > ASYNC_AFTER_SECONDS):
+                raise QueryStillRunningError(execution_id, 'QUEUED')
+            wait_deadline = time.monotonic() + ASYNC_AFTER_SECONDS
+            if deadline is not None:
+                wait_deadline = min(wait_deadline, deadline)
+            result = get_query_results(execution_id, wait_deadline, detach=True)
+        else:
+            # Only the owner may stop a shared execution at the deadline
+            result = get_query_results(execution_id, deadline, detach=owner is None and fingerprint is not None)
+    except QueryStillRunningError:
+        # Keep the lock so that later callers attach to the running execution until the lock expires
+        raise
+    except Exception:
+        release_query_lock(fingerprint, owner)
+        raise
+
+    if fingerprint:
+        put_cached_result(fingerprint, result)
+    release_query_lock(fingerprint, owner)
+    return result, None
+
+
+def wait_for_queries(execution_ids, deadline, owned_ids):
+    # Poll several executions together with one BatchGetQueryExecution call per round. Executions of owned_ids still
+    # running at the deadline are stopped, the others are shared with another caller and keep running. Returns a dict
+    # of execution id to the last QueryExecution seen.
+    query_executions = {}
+    pending = list(execution_ids)
+    attempt = 0
+    while pending:
+        response = athena_client.batch_get_query_execution(QueryExecutionIds=pending)
+        add_metric('PollCount', 1)
+        for query_execution in response['QueryExecutions']:
+            query_executions[query_execution['QueryExecutionId']] = query_execution
+            if query_execution['Status']['State'] in TERMINAL_STATES:
+                record_query_duration(query_execution)
+                record_query_statistics(query_execution)
+        pending = [execution_id for execution_id in pending
+                   if execution_id not in query_executions
+                   or query_executions[execution_id]['Status']['State'] not in TERMINAL_STATES]
+        if not pending:
+            break
+
+        # The next round is due when the first of the pending queries is expected to make progress
+        delay = min((next_poll_delay(attempt, query_executions[execution_id])
+                     for execution_id in pending if execution_id in query_executions),
+                    default=POLL_INITIAL_DELAY_SECONDS)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for execution_id in pending:
+                    if execution_id in owned_ids:
+                        stop_query(execution_id)
+                break
+            delay = min(delay, remaining)
+
+        time.sleep(delay)
+        attempt += 1
+
+    return query_executions
+
+
+def split_statements(text):
+    # Split on the semicolons outside of string literals, quoted identifiers and comments
+    statements = ['']
+    for kind, token in split_sql(text):
+        if kind == 'symbol' and token == ';':
+            statements.append('')
+        else:
+            statements[-1] += token
+    return statements
+
+
+def parse_batch_queries(value):
+    # The agent passes the list either as a JSON array or as statements separated by semicolons
+    if not value:
+        raise ValueError("Queries must contain at least one SQL statement")
+    try:
+        queries = json.loads(value)
+    except ValueError:
+        queries = value
+    if isinstance(queries, str):
+        queries = split_statements(queries)
+    elif not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise ValueError("Queries must be a JSON array of SQL strings or SQL statements separated by semicolons")
+    queries = [query.strip() for query in queries if query.strip()]
+    if not queries:
+        raise ValueError("Queries must contain at least one SQL statement")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise ValueError(f"Queries contains {len(queries)} statements, send at most {MAX_BATCH_QUERIES} per request")
+    return queries
+
+
+def get_budget_fingerprint(fingerprint, max_bytes):
+    # Results are read up to a response budget, a result cached under the full budget must not be returned in a
+    # batch that only has a share of it
+    if fingerprint and max_bytes != MAX_RESULT_BYTES:
+        return sha256(f"{fingerprint}:{max_bytes}".encode('utf-8')).hexdigest()
+    return fingerprint
+
+
+def run_batch_queries(queries, s3_output, wg_name, deadline, session_id=None):
+    # Returns one (result, cache tier, error) tuple per query, in the order of the queries
+    # The response budget is shared by all statements of the batch
+    max_bytes = MAX_RESULT_BYTES // len(queries)
+    outcomes = [None] * len(queries)
+    queries = list(queries)
+
+    for index, query in enumerate(queries):
+        try:
+            queries[index], _ = govern_query(query)
+        except QueryRejectedError as e:
+            outcomes[index] = (None, None, str(e))
+    fingerprints = [get_budget_fingerprint(get_cache_fingerprint(query), max_bytes) for query in queries]
+
+    athena_indexes = []
+    for index, query in enumerate(queries):
+        if outcomes[index] is not None:
+            continue
+        try:
+            result, tier = run_local_query(query, fingerprints[index], deadline, max_bytes=max_bytes)
+        except QueryTimeoutError as e:
+            outcomes[index] = (None, None, str(e))
+            continue
+        if result is not None:
+            outcomes[index] = (result, tier, None)
+        else:
+            athena_indexes.append(index)
+
+    if not athena_indexes:
+        return outcomes
+
+    with ThreadPoolExecutor(max_workers=len(athena_indexes)) as executor:
+        # Start all remaining statements at once, identical statements share one execution
+        started = {}
+        owners = {}
+        futures = {index: executor.submit(start_or_attach, queries[index], fingerprints[index], s3_output, wg_name,
+                                          session_id, deadline)
+                   for index in athena_indexes}
+        for index, future in futures.items():
+            try:
+                started[index], owners[index] = future.result()
+            except Exception as e:
+                outcomes[index] = (None, None, f"Failed to start the query: {e}")
+
+        # Only the owner may stop a shared execution at the deadline
+        owned_ids = {execution_id for index, execution_id in started.items()
+                     if owners[index] is not None or fingerprints[index] is None}
+        query_executions = wait_for_queries(list(dict.fromkeys(started.values())), deadline, owned_ids)
+        for index in started:
+            release_query_lock(fingerprints[index], owners[index])
+
+        # Fetch the results of the successful statements concurrently
+        fetches = {}
+        for index, execution_id in started.items():
+            query_execution = query_executions.get(execution_id)
+            state = query_execution['Status']['State'] if query_execution else 'UNKNOWN'
+            if state == 'SUCCEEDED':
+                fetches[index] = executor.submit(read_query_results, execution_id, max_bytes=max_bytes)
+            elif state in ('FAILED', 'CANCELLED'):
+                reason = query_execution['Status'].get('StateChangeReason', '')
+                outcomes[index] = (None, None, f"Query failed with status '{state}': {reason}")
+            elif execution_id in owned_ids:
+                outcomes[index] = (None, None, f"Query {execution_id} did not complete in the time available and was cancelled.")
+            else:
+                outcomes[index] = (None, None, f"Query {execution_id} did not complete in the time available. It is shared "
+                                               "with another caller and keeps running, fetch the result with /athenaFetch.")
+
+        for index, future in fetches.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                outcomes[index] = (None, None, f"Failed to fetch the query results: {e}")
+                continue
+            if fingerprints[index]:
+                put_cached_result(fingerprints[index], result)
+            outcomes[index] = (result, None, None)
+
+    return outcomes
+
+
+def get_session_digest(session_id):
+    if not session_id:
+        raise ValueError("Materialized results require a sessionId")
+    return sha256(session_id.encode('utf-8')).hexdigest()[:16]
+
+
+def get_session_table_time(table_name):
+    # Table names end with their creation time in milliseconds
+    try:
+        return int(table_name.rsplit('_', 1)[1]) / 1000.0
+    except (IndexError, ValueError):
+        return None
+
+
+def get_latest_session_table(session_id):
+    # Looked up in the Glue Data Catalog because the result may have been materialized by another container
+    digest = get_session_digest(session_id)
+    cutoff = time.time() - SESSION_RESULT_TTL_SECONDS
+    latest = None
+    paginator = glue_client.get_paginator('get_tables')
+    for page in paginator.paginate(DatabaseName=GLUE_DATABASE, Expression=f"{SESSION_TABLE_PREFIX}{digest}_.*"):
+        for table in page['TableList']:
+            created = get_session_table_time(table['Name'])
+            if created is not None and created > cutoff and (latest is None or created > latest[0]):
+                latest = (created, table['Name'])
+    return latest[1] if latest else None
+
+
+def resolve_session_tables(query, session_id):
+    # Point references to previous_result at the latest materialized result of the session
+    if not query or not SESSION_RESULT_PATTERN.search(query):
+        return query
+    table = get_latest_session_table(session_id)
+    if table is None:
+        raise ValueError(
+            "There is no materialized result for this session. Run the query with Materialize set to true first.")
+    return SESSION_RESULT_PATTERN.sub(f"{GLUE_DATABASE}.{table}", query)
+
+
+def materialize_query(query, s3_output, wg_name, deadline, session_id):
+    # Store the result of the query as a session table with CTAS, returns the table name
+    digest = get_session_digest(session_id)
+    table = f"{SESSION_TABLE_PREFIX}{digest}_{int(time.time() * 1000)}"
+    # No external_location, Athena rejects it in workgroups that enforce the result location
+    statement = (
+        f"CREATE TABLE {GLUE_DATABASE}.{table}\n"
+        "WITH (format = 'PARQUET', write_compression = 'SNAPPY')\n"
+        f"AS {query.rstrip().rstrip(';')}"
+    )
+    execution_id = execute_athena_query(statement, s3_output, wg_name, session_id, deadline)
+    get_query_results(execution_id, deadline)
+    print(f"Materialized the query result as {GLUE_DATABASE}.{table}")
+    return table
+
+
+def get_output_rows(execution_id):
+    # Number of rows the query wrote according to Athena, None when the statistics aren't available
+    try:
+        statistics = athena_client.get_query_runtime_statistics(QueryExecutionId=execution_id)['QueryRuntimeStatistics']
+        return statistics.get('Rows', {}).get('OutputRows')
+    except ClientError as e:
+        print(f"Failed to get the runtime statistics of {execution_id}: {e}")
+        return None
+
+
+def build_export_body(location, execution_id):
+    # Manifest of the files written to location by the UNLOAD query execution_id
+    bucket, prefix = re.match(r's3://([^/]+)/(.+)', location).groups()
+    files = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        files.extend({'Key': item['Key'], 'Bytes': item['Size']} for item in page.get('Contents', []))
+    files.sort(key=lambda item: item['Key'])
+
+    listed = files[:EXPORT_MAX_FILES]
+    for item in listed:
+        item['Url'] = s3_client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': item['Key']}, ExpiresIn=EXPORT_URL_EXPIRY_SECONDS)
+
+    total_rows = get_output_rows(execution_id)
+    if total_rows is not None:
+        add_metric('RowsExported', total_rows)
+    return {
+        'Export': {
+            'Location': location,
+            'Format': 'PARQUET',
+            'FileCount': len(files),
+            'TotalBytes': sum(item['Bytes'] for item in files),
+            'TotalRows': total_rows,
+            'Files': listed,
+            'UrlExpiresInSeconds': EXPORT_URL_EXPIRY_SECONDS,
+        },
+        'Message': (
+            f"The result was exported as {len(files)} parquet files instead of being returned as rows. Share the "
+            "download links of the files with the user."
+        ),
     }
 
-    api_response = {'messageVersion': '1.0', 'response': action_response}
-    return api_response
\ No newline at end of file
+
+def get_export_location(query):
+    # Target of an UNLOAD statement, None for other statements
+    match = re.match(r"\s*unload\b.*\bto\s+'(s3://[^']+)'", query or '', re.IGNORECASE | re.DOTALL)
+    return match.group(1) if match else None
+
+
+def export_query(query, s3_output, wg_name, deadline, session_id):
+    # Write the result with UNLOAD at Athena's parallel write speed. Raises QueryStillRunningError when the export is
+    # still running at the deadline, /athenaFetch returns the manifest once it has finished.
+    location = f"{s3_output}/{EXPORT_PREFIX}{uuid.uuid4().hex}/"
+    statement = (
+        f"UNLOAD ({query.rstrip().rstrip(';')})\n"
+        f"TO '{location}'\n"
+        "WITH (format = 'PARQUET', compression = 'SNAPPY')"
+    )
+    execution_id = execute_athena_query(statement, s3_output, wg_name, session_id, deadline)
+    query_execution = wait_for_query(execution_id, deadline, detach=True)
+    status = query_execution['Status']
+    if status['State'] != 'SUCCEEDED':
+        raise QueryFailedError(f"Export failed with status '{status['State']}': {status.get('StateChangeReason', '')}")
+    return build_export_body(location, execution_id)
+
+
+def delete_s3_prefix(location):
+    # Delete the data of a session table at its catalog location, only locations in the Athena bucket are touched
+    match = re.match(r's3://([^/]+)/(.+)', location or '')
+    if not match or match.group(1) != os.environ["ATHENA_DEST_BUCKET"]:
+        print(f"Skipping the unexpected session table location {location}")
+        return
+    bucket, prefix = match.groups()
+    # Only the objects below the table directory, not those of tables whose name starts the same
+    prefix = prefix.rstrip('/') + '/'
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+
+def cleanup_session_results():
+    # Drop the session tables older than the TTL together with their data
+    cutoff = time.time() - SESSION_RESULT_TTL_SECONDS
+    dropped = []
+    paginator = glue_client.get_paginator('get_tables')
+    for page in paginator.paginate(DatabaseName=GLUE_DATABASE, Expression=f"{SESSION_TABLE_PREFIX}.*"):
+        for table in page['TableList']:
+            created = get_session_table_time(table['Name'])
+            if created is None or created > cutoff:
+                continue
+            try:
+                delete_s3_prefix(table.get('StorageDescriptor', {}).get('Location'))
+                glue_client.delete_table(DatabaseName=GLUE_DATABASE, Name=table['Name'])
+                dropped.append(table['Name'])
+            except Exception as e:
+                print(f"Failed to drop the session table {table['Name']}: {e}")
+    print(f"Dropped {len(dropped)} expired session tables: {dropped}")
+    return {'DroppedTables': dropped}
+
+
+def get_template_statement(template_name, kpi, aggregation):
+    # Returns (statement name, SQL) of the template for the KPI and aggregation
+    template = QUERY_TEMPLATES.get(template_name)
+    if template is None:
+        raise ValueError(f"Unknown TemplateName {template_name}, use one of: {', '.join(QUERY_TEMPLATES)}")
+    uses_kpi = '{kpi}' in template['Sql']
+    uses_aggregation = '{aggregation}' in template['Sql']
+    if uses_kpi and kpi not in TEMPLATE_KPIS:
+        raise ValueError(f"Kpi must be one of: {', '.join(TEMPLATE_KPIS)}")
+    if uses_aggregation and aggregation not in TEMPLATE_AGGREGATIONS:
+        raise ValueError(f"Aggregation must be one of: {', '.join(TEMPLATE_AGGREGATIONS)}")
+
+    sql = template['Sql'].format(kpi=kpi, aggregation=aggregation, date_range=TEMPLATE_DATE_RANGE)
+    # The hash of the SQL in the name makes changed templates prepare new statements
+    name_parts = [PREPARED_STATEMENT_PREFIX + template_name]
+    if uses_aggregation:
+        name_parts.append(aggregation)
+    if uses_kpi:
+        name_parts.append(kpi)
+    name_parts.append(sha256(sql.encode('utf-8')).hexdigest()[:8])
+    return '_'.join(name_parts), sql
+
+
+def get_template_parameters(event, template_name):
+    # Returns the execution parameters of the template as SQL literals, in the order of the placeholders
+    values = {}
+    for slot in dict.fromkeys(QUERY_TEMPLATES[template_name]['Parameters']):
+        slot_type, default = TEMPLATE_SLOTS[slot]
+        value = get_request_property(event, slot, default)
+        if value is None and slot_type == 'date':
+            dates = sorted(get_table_metadata()['Partitions'], key=lambda date: time.strptime(date, TEMPLATE_DATE_FORMAT))
+            if not dates:
+                raise ValueError(f"{slot} is required, the data set has no dates yet")
+            value = dates[0] if slot == 'StartDate' else dates[-1]
+        if value is None:
+            raise ValueError(f"{slot} is required for the template {template_name}")
+
+        value = str(value).strip()
+        try:
+            if slot_type == 'date':
+                time.strptime(value, TEMPLATE_DATE_FORMAT)
+                values[slot] = f"'{value}'"
+            elif slot_type == 'integer':
+                number = int(value)
+                if not 1 <= number <= TEMPLATE_MAX_TOP_N:
+                    raise ValueError
+                values[slot] = str(number)
+            elif slot_type == 'double':
+                number = float(value)
+                if not math.isfinite(number):
+                    raise ValueError
+                values[slot] = repr(number)
+            else:
+                values[slot] = "'" + value.replace("'", "''") + "'"
+        except ValueError:
+            expected = {
+                'date': "a date formatted like '10 Feb 24'",
+                'integer': f"a number between 1 and {TEMPLATE_MAX_TOP_N}",
+                'double': "a number",
+            }[slot_type]
+            raise ValueError(f"{slot} must be {expected}, got {value!r}")
+    return [values[slot] for slot in QUERY_TEMPLATES[template_name]['Parameters']]
+
+
+def prepare_statement(statement_name, sql, wg_name):
+    with prepared_statements_lock:
+        if statement_name in prepared_statements:
+            return
+    try:
+        athena_client.create_prepared_statement(
+            StatementName=statement_name,
+            WorkGroup=wg_name,
+            QueryStatement=sql,
+            Description="Query template of the athena lambda",
+        )
+        print(f"Prepared statement {statement_name}")
+    except athena_client.exceptions.InvalidRequestException as e:
+        # Prepared by an earlier container
+        if 'already exists' not in str(e).lower():
+            raise
+    with prepared_statements_lock:
+        prepared_statements.add(statement_name)
+
+
+def build_result_body(result, result_format=DEFAULT_RESULT_FORMAT):
+    body = encode_result_rows(result['ColumnInfo'], result['Rows'], result_format)
+    encoding = measure_encoding(result['ColumnInfo'], result['Rows'], body)
+    encoding['Format'] = result_format
+    print("Result encoding: ", encoding)
+
+    body['RowCount'] = len(result['Rows'])
+    add_metric('RowsReturned', len(result['Rows']))
+    body['Truncated'] = result['Truncated']
+    body['Encoding'] = encoding
+    if result['Truncated']:
+        body['ContinuationToken'] = result['ContinuationToken']
+        body['Message'] = (
+            f"The result was truncated after {len(result['Rows'])} rows. Aggregate or filter the query to reduce the "
+            "result size, or pass the ContinuationToken to /athenaQuery to fetch the next rows."
+        )
+    return body
+
+
+def collect_summary_rows(result):
+    # Returns (column info, rows, truncated) with up to SUMMARY_MAX_ROWS rows of the result
+    rows = list(result['Rows'])
+    truncated = result['Truncated']
+    continuation_token = result.get('ContinuationToken')
+    while truncated and continuation_token and len(rows) < SUMMARY_MAX_ROWS:
+        execution_id, starting_token, offset = decode_continuation_token(continuation_token)
+        page = read_query_results(execution_id, starting_token, offset, SUMMARY_MAX_ROWS - len(rows), SUMMARY_MAX_BYTES)
+        rows.extend(page['Rows'])
+        truncated = page['Truncated']
+        continuation_token = page['ContinuationToken']
+    return result['ColumnInfo'], rows, truncated
+
+
+def round_statistic(value):
+    if value is None or not math.isfinite(value):
+        return None
+    return round(float(value), 6)
+
+
+def quantile(sorted_values, fraction):
+    # Linear interpolation between the closest ranks, the default method of numpy.quantile
+    position = (len(sorted_values) - 1) * fraction
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def profile_numeric(values):
+    # The standard deviation is the sample standard deviation, like stddev in Athena
+    if np is not None:
+        array = np.asarray(values, dtype=float)
+        mean = array.mean()
+        std = array.std(ddof=1) if len(array) > 1 else None
+        quantiles = np.quantile(array, SUMMARY_QUANTILES)
+    else:
+        sorted_values = sorted(float(value) for value in values)
+        mean = math.fsum(sorted_values) / len(sorted_values)
+        std = None
+        if len(sorted_values) > 1:
+            std = math.sqrt(math.fsum((value - mean) ** 2 for value in sorted_values) / (len(sorted_values) - 1))
+        quantiles = [quantile(sorted_values, fraction) for fraction in SUMMARY_QUANTILES]
+
+    return {
+        'Min': min(values),
+        'Max': max(values),
+        'Mean': round_statistic(mean),
+        'Std': round_statistic(std),
+        'Quantiles': {f"p{round(fraction * 100)}": round_statistic(value)
+                      for fraction, value in zip(SUMMARY_QUANTILES, quantiles)},
+    }
+
+
+def profile_column(column, values):
+    column_type = column['Type']
+    present = [convert_value(value, column_type) for value in values if value is not None]
+    profile = {
+        'Column': column['Name'],
+        'Type': column_type,
+        'Count': len(present),
+        'Nulls': len(values) - len(present),
+        'NullRate': round_statistic((len(values) - len(present)) / len(values)) if values else None,
+    }
+    if not present:
+        return profile
+
+    numbers = [value for value in present if isinstance(value, (int, float)) and not isinstance(value, bool)]
+    if column_type in INTEGER_TYPES + FLOAT_TYPES and len(numbers) == len(present):
+        profile.update(profile_numeric(numbers))
+        return profile
+
+    counts = {}
+    for value in present:
+        counts[value] = counts.get(value, 0) + 1
+    profile['Distinct'] = len(counts)
+    profile['Min'] = min(present, key=str)
+    profile['Max'] = max(present, key=str)
+    profile['TopValues'] = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))[:SUMMARY_TOP_K]
+    return profile
+
+
+def build_summary_body(result):
+    column_info, rows, truncated = collect_summary_rows(result)
+    add_metric('RowsProfiled', len(rows))
+    columns = [profile_column(column, [row[index] for row in rows]) for index, column in enumerate(column_info)]
+    body = {'Summary': {'RowsProfiled': len(rows), 'Truncated': truncated, 'Columns': columns}}
+    if truncated:
+        body['Message'] = (
+            f"The profile covers the first {len(rows)} rows of the result. Aggregate or filter the query to profile "
+            "the complete result."
+        )
+    return body
+
+
+def athena_query_handler(event, context):
+    # Continue a truncated result set of a previous query without running the query again
+    result_format = get_result_format(event)
+    continuation_token = get_request_property(event, 'ContinuationToken')
+    if continuation_token:
+        execution_id, starting_token, offset = decode_continuation_token(continuation_token)
+        return build_result_body(read_query_results(execution_id, starting_token, offset), result_format)
+
+    # Extracting the SQL query. THe bedrock function call will pass the query in the request body
+    query = get_request_property(event, 'Query')
+
+    print("the received QUERY:",  query)
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("Query is required")
+
+    # Adding the athena destination s3 bucket we need for the boto athena client call
+    s3_output = 's3://' + os.environ["ATHENA_DEST_BUCKET"]
+    wg_name = os.environ["ATHENA_WORKGROUP"]
+
+    # Follow-up queries may reference the materialized result of the previous turn
+    session_id = event.get('sessionId')
+    query = resolve_session_tables(query, session_id)
+
+    # Exploratory questions may trade exactness for time
+    query, approximation_report = plan_approximation(
+        query,
+        str(get_request_property(event, 'Approximate', 'false')).lower() == 'true',
+        get_request_property(event, 'LatencyBudgetMs'),
+        get_request_property(event, 'SamplePercent'),
+    )
+
+    # Check the statement for unbounded scans before it is started. Summaries may profile more rows than a response holds.
+    summarize = str(get_request_property(event, 'Summarize', 'false')).lower() == 'true'
+    export = str(get_request_property(event, 'Export', 'false')).lower() == 'true'
+    materialize = str(get_request_property(event, 'Materialize', 'false')).lower() == 'true'
+    default_limit = GOVERNOR_DEFAULT_LIMIT
+    if export:
+        default_limit = None
+    elif summarize:
+        default_limit = SUMMARY_MAX_ROWS
+    # A materialized table holds the complete result, the default limit only applies to the rows returned from it
+    query, governor_report = govern_query(query, None if materialize else default_limit)
+
+    # Execute the query and wait for completion, bounded by the time left in this invocation
+    run_async = str(get_request_property(event, 'Async', 'false')).lower() == 'true' and not materialize
+    deadline = get_deadline(context)
+    if export:
+        body = export_query(query, s3_output, wg_name, deadline, session_id)
+        if governor_report:
+            body['Governor'] = governor_report
+        return body
+
+    materialized_table = None
+    if materialize:
+        materialized_table = materialize_query(query, s3_output, wg_name, deadline, session_id)
+        query = f"SELECT * FROM {GLUE_DATABASE}.{materialized_table}"
+        if default_limit is not None:
+            query = f"{query}\nLIMIT {default_limit}"
+    result, cache_tier = run_query(query, s3_output, wg_name, deadline, run_async, session_id)
+
+    if summarize:
+        body = build_summary_body(result)
+    else:
+        body = build_result_body(result, result_format)
+    body['CacheHit'] = cache_tier is not None
+    if governor_report:
+        body['Governor'] = governor_report
+    if approximation_report:
+        body['Approximation'] = approximation_report
+    if materialized_table:
+        body['MaterializedTable'] = f"{GLUE_DATABASE}.{materialized_table}"
+    return body
+
+
+def named_query_handler(event, context):
+    # Fill the slots of a registered query template instead of generating SQL
+    result_format = get_result_format(event)
+    template_name = get_request_property(event, 'TemplateName')
+    statement_name, sql = get_template_statement(
+        template_name, get_request_property(event, 'Kpi'), get_request_property(event, 'Aggregation', 'sum'))
+    parameters = get_template_parameters(event, template_name)
+
+    s3_output = 's3://' + os.environ["ATHENA_DEST_BUCKET"]
+    wg_name = os.environ["ATHENA_WORKGROUP"]
+    prepare_statement(statement_name, sql, wg_name)
+
+    query = f"EXECUTE {statement_name} USING {', '.join(parameters)}"
+    print("the named QUERY:", query)
+    deadline = get_deadline(context)
+    result, cache_tier = run_query(query, s3_output, wg_name, deadline, session_id=event.get('sessionId'))
+
+    body = build_result_body(result, result_format)
+    body['CacheHit'] = cache_tier is not None
+    body['Query'] = sql
+    return body
+
+
+def get_query_execution(event):
+    execution_id = get_request_property(event, 'QueryExecutionId')
+    if not execution_id:
+        raise ValueError("QueryExecutionId is required")
+    try:
+        return athena_client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']
+    except athena_client.exceptions.InvalidRequestException as e:
+        raise ValueError(f"Unknown QueryExecutionId {execution_id}: {e}")
+
+
+def build_pending_body(execution_id, state):
+    return {
+        'QueryExecutionId': execution_id,
+        'State': state,
+        'Message': (
+            "The query is still running. Call /athenaStatus with the QueryExecutionId to check on it and "
+            "/athenaFetch to collect the results once it has succeeded."
+        ),
+    }
+
+
+def athena_status_handler(event, context):
+    query_execution = get_query_execution(event)
+    status = query_execution['Status']
+    statistics = query_execution.get('Statistics', {})
+
+    body = {
+        'QueryExecutionId': query_execution['QueryExecutionId'],
+        'State': status['State'],
+        'QueueTimeInMillis': statistics.get('QueryQueueTimeInMillis'),
+        'EngineExecutionTimeInMillis': statistics.get('EngineExecutionTimeInMillis'),
+        'DataScannedInBytes': statistics.get('DataScannedInBytes'),
+    }
+    if status.get('StateChangeReason'):
+        body['StateChangeReason'] = status['StateChangeReason']
+    if status['State'] == 'SUCCEEDED':
+        body['Message'] = "The query has succeeded, call /athenaFetch with the QueryExecutionId to collect the results."
+    return body
+
+
+def athena_fetch_handler(event, context):
+    result_format = get_result_format(event)
+    continuation_token = get_request_property(event, 'ContinuationToken')
+    if continuation_token:
+        execution_id, starting_token, offset = decode_continuation_token(continuation_token)
+        return build_result_body(read_query_results(execution_id, starting_token, offset), result_format)
+
+    query_execution = get_query_execution(event)
+    execution_id = query_execution['QueryExecutionId']
+    state = query_execution['Status']['State']
+    if state not in TERMINAL_STATES:
+        raise QueryStillRunningError(execution_id, state)
+    if state != 'SUCCEEDED':
+        raise QueryFailedError(f"Query failed with status '{state}': {query_execution['Status'].get('StateChangeReason', '')}")
+
+    record_query_duration(query_execution)
+    export_location = get_export_location(query_execution['Query'])
+    if export_location:
+        return build_export_body(export_location, execution_id)
+
+    result = read_query_results(execution_id)
+    fingerprint = get_cache_fingerprint(query_execution['Query'])
+    if fingerprint:
+        put_cached_result(fingerprint, result)
+    if str(get_request_property(event, 'Summarize', 'false')).lower() == 'true':
+        return build_summary_body(result)
+    return build_result_body(result, result_format)
+
+
+def schema_handler(event, context):
+    # Answered from the Glue Data Catalog, no Athena query is started
+    return get_table_metadata()
+
+
+def athena_batch_query_handler(event, context):
+    result_format = get_result_format(event)
+    queries = parse_batch_queries(get_request_property(event, 'Queries'))
+
+    print("the received QUERIES:", queries)
+
+    s3_output = 's3://' + os.environ["ATHENA_DEST_BUCKET"]
+    wg_name = os.environ["ATHENA_WORKGROUP"]
+
+    session_id = event.get('sessionId')
+    queries = [resolve_session_tables(query, session_id) for query in queries]
+
+    deadline = get_deadline(context)
+    outcomes = run_batch_queries(queries, s3_output, wg_name, deadline, session_id)
+
+    results = []
+    for query, (result, cache_tier, error) in zip(queries, outcomes):
+        if error:
+            results.append({'Query': query, 'error': error})
+            continue
+        body = build_result_body(result, result_format)
+        body['CacheHit'] = cache_tier is not None
+        body['Query'] = query
+        results.append(body)
+
+    return {'Results': results}
+
+
+def dispatch_request(event, context, action_group, api_path):
+    # Returns (response code, result) of the action
+    result = ''
+    response_code = 200
+    try:
+        if api_path == '/athenaQuery':
+            result = athena_query_handler(event, context)
+        elif api_path == '/athenaBatchQuery':
+            result = athena_batch_query_handler(event, context)
+        elif api_path == '/athenaStatus':
+            result = athena_status_handler(event, context)
+        elif api_path == '/athenaFetch':
+            result = athena_fetch_handler(event, context)
+        elif api_path == '/schema':
+            result = schema_handler(event, context)
+        elif api_path == '/namedQuery':
+            result = named_query_handler(event, context)
+        else:
+            response_code = 404
+            result = {"error": f"Unrecognized api path: {action_group}::{api_path}"}
+    except QueryStillRunningError as e:
+        response_code = 202
+        result = build_pending_body(e.execution_id, e.state)
+    except QueryTimeoutError as e:
+        response_code = 408
+        result = {"error": str(e)}
+    except (QueryFailedError, QueryRejectedError) as e:
+        response_code = 400
+        result = {"error": str(e)}
+    except QueryThrottledError as e:
+        response_code = 429
+        result = {"error": str(e)}
+    except ValueError as e:
+        response_code = 400
+        result = {"error": str(e)}
+    return response_code, result
+
+
+def handler(event, context):
+    start = time.monotonic()
+    print(event)
+
+    # Scheduled invocations clean up the expired session results, they are not agent requests
+    if event.get('source') == 'aws.events':
+        return cleanup_session_results()
+
+    reset_metrics()
+
+    action_group = event.get('actionGroup')
+    api_path = event.get('apiPath')
+
+    print("api_path: ", api_path)
+
+    # Stays 500 when an unexpected exception escapes, the metrics still record the failed invocation
+    response_code = 500
+    try:
+        response_code, result = dispatch_request(event, context, action_group, api_path)
+
+        response_body = {
+            'application/json': {
+                'body': result
+            }
+        }
+
+        action_response = {
+            'actionGroup': action_group,
+            'apiPath': api_path,
+            'httpMethod': event.get('httpMethod'),
+            'httpStatusCode': response_code,
+            'responseBody': response_body
+        }
+
+        api_response = {'messageVersion': '1.0', 'response': action_response}
+
+        add_metric('PayloadBytes', len(json.dumps(response_body, default=str)))
+        return api_response
+    finally:
+        add_metric('HandlerLatency', (time.monotonic() - start) * 1000)
+        emit_metrics(action_group, api_path, response_code)
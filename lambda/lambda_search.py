@@ -1,40 +1,438 @@
 import json
 import requests
+import math
 import os
+import re
 import shutil
-from googlesearch import search
+import time
+import hashlib
+import threading
+import boto3
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+from googlesearch.user_agents import get_useragent
 from bs4 import BeautifulSoup
 
+# Brotli is optional, urllib3 only decodes br responses when one of these packages is installed
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# selectolax and lxml are optional, the fastest installed parser extracts the page text and html.parser is the fallback
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Pages are fetched concurrently. Every request has its own connect and read timeout and the whole fetch stage is
+# bounded by the time left in the invocation, pages still loading at the deadline are left out of the results.
+FETCH_MAX_WORKERS = int(os.environ.get('SEARCH_FETCH_MAX_WORKERS', '10'))
+FETCH_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('SEARCH_FETCH_CONNECT_TIMEOUT_SECONDS', '3'))
+FETCH_READ_TIMEOUT_SECONDS = float(os.environ.get('SEARCH_FETCH_READ_TIMEOUT_SECONDS', '10'))
+# Time kept back from the invocation deadline to save the aggregated content and build the response
+DEADLINE_SAFETY_MARGIN_SECONDS = 3.0
+
+# Connection pools are kept per host and reused across warm invocations. Idempotent requests are retried a bounded
+# number of times with exponential backoff. Retry-After is honoured up to HTTP_RETRY_AFTER_MAX_SECONDS so a slow site
+# cannot hold the fetch stage.
+HTTP_POOL_HOSTS = int(os.environ.get('SEARCH_HTTP_POOL_HOSTS', '20'))
+HTTP_POOL_MAXSIZE = FETCH_MAX_WORKERS
+HTTP_MAX_RETRIES = int(os.environ.get('SEARCH_HTTP_MAX_RETRIES', '2'))
+HTTP_RETRY_BACKOFF_SECONDS = 0.3
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_RETRY_AFTER_MAX_SECONDS = float(os.environ.get('SEARCH_HTTP_RETRY_AFTER_MAX_SECONDS', '2'))
+HTTP_ACCEPT_ENCODING = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+class CappedRetry(Retry):
+    def get_retry_after(self, response):
+        try:
+            retry_after = super().get_retry_after(response)
+        except InvalidHeader:
+            # A malformed Retry-After falls back to the backoff
+            return None
+        return None if retry_after is None else min(retry_after, HTTP_RETRY_AFTER_MAX_SECONDS)
+
+def create_http_session():
+    retry = CappedRetry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF_SECONDS,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': HTTP_ACCEPT_ENCODING, 'Connection': 'keep-alive'})
+    return session
+
+# Shared HTTP session, created once per container
+http_session = create_http_session()
+
+# Pages are downloaded in chunks and abandoned once they grow past the cap, only HTML and plain text are extracted
+PAGE_MAX_BYTES = int(os.environ.get('SEARCH_PAGE_MAX_BYTES', str(2 * 1024 * 1024)))
+PAGE_CHUNK_BYTES = 64 * 1024
+PAGE_HTML_TYPES = ('text/html', 'application/xhtml+xml')
+PAGE_TEXT_TYPES = ('text/plain',)
+PAGE_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+# Scripts, styles and page furniture such as menus, headers and footers carry no content for the agent
+BOILERPLATE_TAGS = ['script', 'style', 'noscript', 'template', 'svg', 'iframe', 'nav', 'header', 'footer', 'aside', 'form', 'button']
+# Same line breaks as str.splitlines plus runs of two spaces, which split multi-headlines
+TEXT_BREAK_PATTERN = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]|  ')
+# Name of the extraction engine to use instead of the fastest installed one
+EXTRACTION_ENGINE = os.environ.get('SEARCH_EXTRACTION_ENGINE')
+
+def normalize_text(text):
+    # Strip every line and multi-headline and drop the blank ones
+    return '\n'.join(chunk for chunk in (part.strip() for part in TEXT_BREAK_PATTERN.split(text)) if chunk)
+
+def extract_text_selectolax(html):
+    tree = SelectolaxParser(html)
+    tree.strip_tags(BOILERPLATE_TAGS)
+    root = tree.body or tree.root
+    return normalize_text(root.text(separator='')) if root is not None else ''
+
+def extract_text_lxml(html):
+    try:
+        document = lxml.html.document_fromstring(html)
+    except ValueError:
+        # lxml refuses decoded text that still carries an XML encoding declaration
+        document = lxml.html.document_fromstring(html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except lxml.etree.ParserError:
+        # Raised for documents without any element
+        return ''
+    for element in list(document.iter(*BOILERPLATE_TAGS)):
+        element.drop_tree()
+    return normalize_text(document.text_content())
+
+def extract_text_html_parser(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    for element in soup(BOILERPLATE_TAGS):
+        element.decompose()
+    return normalize_text(soup.get_text())
+
+# Extraction engines from fastest to slowest with the module each one needs
+EXTRACTION_ENGINES = OrderedDict([
+    ('selectolax', (extract_text_selectolax, SelectolaxParser)),
+    ('lxml', (extract_text_lxml, lxml)),
+    ('html.parser', (extract_text_html_parser, BeautifulSoup)),
+])
+
+def get_extraction_engine(name=None):
+    if name:
+        extract, module = EXTRACTION_ENGINES[name]
+        if module is None:
+            raise Exception(f"Extraction engine {name} is not installed.")
+        return extract
+    return next(extract for extract, module in EXTRACTION_ENGINES.values() if module is not None)
+
+extract_text = get_extraction_engine(EXTRACTION_ENGINE)
+print(f"Extracting page text with {extract_text.__name__}")
+
+def read_page_body(response):
+    # Content-Length is the compressed size when the page is encoded, still a lower bound for the decoded body
+    if int(response.headers.get('Content-Length') or 0) > PAGE_MAX_BYTES:
+        raise Exception(f"Page is larger than {PAGE_MAX_BYTES} bytes.")
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=PAGE_CHUNK_BYTES):
+        size += len(chunk)
+        if size > PAGE_MAX_BYTES:
+            raise Exception(f"Page is larger than {PAGE_MAX_BYTES} bytes.")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def decode_page_body(body, response, content_type):
+    encoding = None
+    charset = re.search(r'charset=["\']?([\w-]+)', response.headers.get('Content-Type', ''), re.IGNORECASE)
+    if charset:
+        encoding = charset.group(1)
+    elif content_type not in PAGE_TEXT_TYPES:
+        # Fall back to the charset declared in the document head
+        charset = PAGE_CHARSET_PATTERN.search(body[:2048])
+        if charset:
+            encoding = charset.group(1).decode('ascii')
+    try:
+        return body.decode(encoding or 'utf-8', errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+# Cleaned page text is cached by URL in S3 and in a bounded LRU directory on /tmp that survives warm invocations.
+# Entries keep the ETag and Last-Modified validators, cached pages are revalidated and a 304 skips the download and parsing.
+PAGE_CACHE_BUCKET = os.environ.get('PAGE_CACHE_BUCKET')
+PAGE_CACHE_PREFIX = 'page-cache/'
+PAGE_CACHE_DIR = '/tmp/page-cache'
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_PAGE_CACHE_MAX_ENTRIES', '500'))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_PAGE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Initialize the S3 client
+s3_client = boto3.client('s3')
+
+# Local cache files by name with their size, least recently used first
+page_cache_index = OrderedDict()
+page_cache_lock = threading.Lock()
+
+def load_page_cache_index():
+    try:
+        os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+        entries = []
+        for filename in os.listdir(PAGE_CACHE_DIR):
+            stat = os.stat(os.path.join(PAGE_CACHE_DIR, filename))
+            entries.append((stat.st_mtime, filename, stat.st_size))
+        for _, filename, size in sorted(entries):
+            page_cache_index[filename] = size
+    except OSError as e:
+        print(f"Error while loading the page cache index: {e}")
+
+load_page_cache_index()
+
+def get_page_cache_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'
+
+def evict_page_cache():
+    # Called with page_cache_lock held
+    while page_cache_index and (len(page_cache_index) > PAGE_CACHE_MAX_ENTRIES or sum(page_cache_index.values()) > PAGE_CACHE_MAX_BYTES):
+        filename, _ = page_cache_index.popitem(last=False)
+        try:
+            os.unlink(os.path.join(PAGE_CACHE_DIR, filename))
+        except OSError as e:
+            print(f"Failed to evict cached page {filename}. Reason: {e}")
+
+def save_page_locally(key, data):
+    try:
+        os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+        path = os.path.join(PAGE_CACHE_DIR, key)
+        with page_cache_lock:
+            with open(path, 'wb') as file:
+                file.write(data)
+            page_cache_index[key] = len(data)
+            page_cache_index.move_to_end(key)
+            evict_page_cache()
+    except OSError as e:
+        print(f"Error while caching page {key} on /tmp: {e}")
+
+def get_cached_page(url):
+    key = get_page_cache_key(url)
+    with page_cache_lock:
+        if key in page_cache_index:
+            try:
+                with open(os.path.join(PAGE_CACHE_DIR, key), 'rb') as file:
+                    entry = json.loads(file.read())
+                page_cache_index.move_to_end(key)
+                return entry
+            except (OSError, ValueError) as e:
+                print(f"Dropping unreadable cached page {key}: {e}")
+                page_cache_index.pop(key, None)
+    if not PAGE_CACHE_BUCKET:
+        return None
+    try:
+        data = s3_client.get_object(Bucket=PAGE_CACHE_BUCKET, Key=PAGE_CACHE_PREFIX + key)['Body'].read()
+        entry = json.loads(data)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"Error while reading cached page for {url} from S3: {e}")
+        return None
+    save_page_locally(key, data)
+    return entry
+
+def put_cached_page(url, response, content):
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    # A page without validators can never be revalidated, so there is no point in caching it
+    if not etag and not last_modified:
+        return
+    key = get_page_cache_key(url)
+    data = json.dumps({'url': url, 'etag': etag, 'last_modified': last_modified, 'content': content}).encode('utf-8')
+    save_page_locally(key, data)
+    if PAGE_CACHE_BUCKET:
+        try:
+            s3_client.put_object(Bucket=PAGE_CACHE_BUCKET, Key=PAGE_CACHE_PREFIX + key, Body=data, ContentType='application/json')
+        except Exception as e:
+            print(f"Error while writing cached page for {url} to S3: {e}")
+
 def get_page_content(url):
     try:
-        response = requests.get(url)
-        if response:
-            # Parse HTML content
-            soup = BeautifulSoup(response.text, 'html.parser')
-            # Remove script and style elements
-            for script_or_style in soup(["script", "style"]):
-                script_or_style.decompose()
-            # Get text
-            text = soup.get_text()
-            # Break into lines and remove leading and trailing space on each
-            lines = (line.strip() for line in text.splitlines())
-            # Break multi-headlines into a line each
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            # Drop blank lines
-            cleaned_text = '\n'.join(chunk for chunk in chunks if chunk)
-            return cleaned_text
+        cached = get_cached_page(url)
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        response = http_session.get(url, headers=headers, stream=True, timeout=(FETCH_CONNECT_TIMEOUT_SECONDS, FETCH_READ_TIMEOUT_SECONDS))
+        with response:
+            if response.status_code == 304 and cached:
+                print(f"Page not modified, using cached content: {url}")
+                return cached['content']
+            if not response:
+                raise Exception("No response from the server.")
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type and content_type not in PAGE_HTML_TYPES + PAGE_TEXT_TYPES:
+                print(f"Skipping {url} with content type {content_type}")
+                return None
+            text = decode_page_body(read_page_body(response), response, content_type)
+        if content_type in PAGE_TEXT_TYPES:
+            cleaned_text = normalize_text(text)
         else:
-            raise Exception("No response from the server.")
+            cleaned_text = extract_text(text)
+        put_cached_page(url, response, cleaned_text)
+        return cleaned_text
     except Exception as e:
         print(f"Error while fetching and cleaning content from {url}: {e}")
         return None
 
 
+# Pages are split into passages that are ranked against the input text with BM25 and optionally reranked with a
+# Bedrock text embedding model. The best passages are returned with their URL until the token budget is spent.
+PASSAGE_MAX_WORDS = int(os.environ.get('SEARCH_PASSAGE_MAX_WORDS', '120'))
+PASSAGE_TOP_K = int(os.environ.get('SEARCH_PASSAGE_TOP_K', '8'))
+PASSAGE_TOKEN_BUDGET = int(os.environ.get('SEARCH_PASSAGE_TOKEN_BUDGET', '2000'))
+PASSAGE_MAX_PER_URL = 3
+# Rough size of a token in English text, used for the budget
+CHARS_PER_TOKEN = 4
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r'\w+')
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'how', 'in', 'is', 'it', 'of', 'on',
+    'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'which', 'who', 'why', 'with'])
+# Model id of a Titan text embedding model, e.g. amazon.titan-embed-text-v2:0, reranking is off when it is not set
+EMBEDDING_MODEL_ID = os.environ.get('SEARCH_EMBEDDING_MODEL_ID')
+EMBEDDING_RERANK_CANDIDATES = 24
+EMBEDDING_MAX_CHARS = 4000
+
+# Initialize the Bedrock runtime client when reranking is enabled
+bedrock_runtime = boto3.client('bedrock-runtime') if EMBEDDING_MODEL_ID else None
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def split_passages(url, content):
+    # Group consecutive lines into passages of about PASSAGE_MAX_WORDS words, overlong lines are cut on word boundaries
+    passages = []
+    words = []
+    for line in content.splitlines():
+        line_words = line.split()
+        while len(line_words) > PASSAGE_MAX_WORDS:
+            if words:
+                passages.append(' '.join(words))
+                words = []
+            passages.append(' '.join(line_words[:PASSAGE_MAX_WORDS]))
+            line_words = line_words[PASSAGE_MAX_WORDS:]
+        if words and len(words) + len(line_words) > PASSAGE_MAX_WORDS:
+            passages.append(' '.join(words))
+            words = []
+        words.extend(line_words)
+    if words:
+        passages.append(' '.join(words))
+    return [{'url': url, 'text': text} for text in passages]
+
+def rank_passages_bm25(query, passages):
+    # Returns [(score, passage)] best first, passages that share no term with the query are dropped
+    terms = set(tokenize(query))
+    if not terms or not passages:
+        return []
+    counts = [Counter(tokenize(passage['text'])) for passage in passages]
+    lengths = [sum(count.values()) for count in counts]
+    average_length = sum(lengths) / len(lengths) or 1
+    idf = {}
+    for term in terms:
+        frequency = sum(1 for count in counts if term in count)
+        idf[term] = math.log(1 + (len(passages) - frequency + 0.5) / (frequency + 0.5))
+    ranked = []
+    for passage, count, length in zip(passages, counts, lengths):
+        score = 0.0
+        for term in terms:
+            tf = count.get(term)
+            if tf:
+                score += idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        if score > 0:
+            ranked.append((score, passage))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
+
+def embed_text(text):
+    # Titan text embeddings request format
+    response = bedrock_runtime.invoke_model(
+        modelId=EMBEDDING_MODEL_ID,
+        body=json.dumps({'inputText': text[:EMBEDDING_MAX_CHARS]}),
+        contentType='application/json',
+        accept='application/json'
+    )
+    return json.loads(response['body'].read())['embedding']
+
+def cosine_similarity(a, b):
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+def rerank_passages(query, ranked, deadline):
+    # Reorders the best BM25 candidates by embedding similarity, keeps the BM25 order if the model fails or is too slow
+    candidates = ranked[:EMBEDDING_RERANK_CANDIDATES]
+    texts = [query] + [passage['text'] for _, passage in candidates]
+    executor = ThreadPoolExecutor(max_workers=min(FETCH_MAX_WORKERS, len(texts)))
+    futures = [executor.submit(embed_text, text) for text in texts]
+    try:
+        embeddings = []
+        for future in futures:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            embeddings.append(future.result(timeout=timeout))
+    except Exception as e:
+        print(f"Error while reranking passages, keeping the BM25 order: {e}")
+        return ranked
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    query_embedding = embeddings[0]
+    reranked = [(cosine_similarity(query_embedding, embedding), passage) for (_, passage), embedding in zip(candidates, embeddings[1:])]
+    reranked.sort(key=lambda item: item[0], reverse=True)
+    return reranked
+
+def select_passages(ranked):
+    # Best passages first, at most PASSAGE_MAX_PER_URL per page and PASSAGE_TOP_K in total within the token budget
+    selected = []
+    per_url = Counter()
+    tokens = 0
+    for score, passage in ranked:
+        if len(selected) >= PASSAGE_TOP_K:
+            break
+        passage_tokens = math.ceil(len(passage['text']) / CHARS_PER_TOKEN)
+        if per_url[passage['url']] >= PASSAGE_MAX_PER_URL or tokens + passage_tokens > PASSAGE_TOKEN_BUDGET:
+            continue
+        per_url[passage['url']] += 1
+        tokens += passage_tokens
+        selected.append({'url': passage['url'], 'score': round(score, 4), 'text': passage['text']})
+    return selected
+
+def rank_passages(query, pages, deadline=None):
+    # pages is a list of (url, content)
+    passages = [passage for url, content in pages if content for passage in split_passages(url, content)]
+    ranked = rank_passages_bm25(query, passages)
+    if EMBEDDING_MODEL_ID and ranked:
+        ranked = rerank_passages(query, ranked, deadline)
+    selected = select_passages(ranked)
+    print(f"Selected {len(selected)} of {len(passages)} passages")
+    return selected
+
 def empty_tmp_directory():
     try:
         folder = '/tmp'
         for filename in os.listdir(folder):
             file_path = os.path.join(folder, filename)
+            # Keep the page cache for the next invocations
+            if file_path == PAGE_CACHE_DIR:
+                continue
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path):
                     os.unlink(file_path)
@@ -58,32 +456,210 @@ def save_content_to_tmp(content, filename):
     except Exception as e:
         print(f"Error while saving {filename} to /tmp: {e}")
 
-def search_google(query):
+# Search providers are looked up by name and SEARCH_PROVIDERS lists the ones to use. With several providers the query
+# fans out to all of them and the first SEARCH_NUM_RESULTS distinct URLs to come back win.
+SEARCH_PROVIDER_NAMES = [name.strip() for name in os.environ.get('SEARCH_PROVIDERS', 'google').split(',') if name.strip()]
+SEARCH_NUM_RESULTS = int(os.environ.get('SEARCH_NUM_RESULTS', '10'))
+SEARCH_TIMEOUT_SECONDS = float(os.environ.get('SEARCH_TIMEOUT_SECONDS', '5'))
+# Result pages are read from Google the way googlesearch does. A page without parsable results ends the search, the
+# library keeps requesting the same page forever in that case.
+SEARCH_GOOGLE_URL = 'https://www.google.com/search'
+SEARCH_GOOGLE_MAX_PAGES = int(os.environ.get('SEARCH_GOOGLE_MAX_PAGES', '3'))
+# Pause before asking Google for another result page, only paid when the first page comes back short
+SEARCH_GOOGLE_PAGE_INTERVAL_SECONDS = 1
+# Google Programmable Search JSON API
+SEARCH_API_URL = 'https://www.googleapis.com/customsearch/v1'
+SEARCH_API_KEY = os.environ.get('SEARCH_API_KEY')
+SEARCH_ENGINE_ID = os.environ.get('SEARCH_ENGINE_ID')
+SEARCH_API_PAGE_SIZE = 10
+# Comma separated URLs returned by the stub provider, for local runs and tests
+SEARCH_STUB_URLS = os.environ.get('SEARCH_STUB_URLS', '')
+# Search results are cached in the container by normalised query
+SEARCH_CACHE_TTL_SECONDS = int(os.environ.get('SEARCH_CACHE_TTL_SECONDS', '3600'))
+SEARCH_CACHE_MAX_ENTRIES = 256
+
+# Normalised query to (expiry time, urls), least recently used first
+search_cache = OrderedDict()
+search_cache_lock = threading.Lock()
+
+def get_remaining_seconds(deadline, cap):
+    # Time left before the deadline, at most cap. None once the deadline has passed.
+    if deadline is None:
+        return cap
+    remaining = deadline - time.monotonic()
+    return min(remaining, cap) if remaining > 0 else None
+
+def parse_google_results(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    urls = []
+    for result in soup.find_all('div', attrs={'class': 'g'}):
+        link = result.find('a', href=True)
+        if link and result.find('h3') and link['href'].startswith('http'):
+            urls.append(link['href'])
+    return urls
+
+def search_google(query, num_results, deadline=None):
+    urls = []
+    for page in range(SEARCH_GOOGLE_MAX_PAGES):
+        if page > 0:
+            pause = get_remaining_seconds(deadline, SEARCH_GOOGLE_PAGE_INTERVAL_SECONDS)
+            if pause is None:
+                break
+            time.sleep(pause)
+        timeout = get_remaining_seconds(deadline, SEARCH_TIMEOUT_SECONDS)
+        if timeout is None:
+            print(f"Search budget exhausted after {page} Google result pages")
+            break
+        response = http_session.get(SEARCH_GOOGLE_URL,
+            headers={'User-Agent': get_useragent()},
+            params={'q': query, 'num': num_results - len(urls) + 2, 'hl': 'en', 'start': len(urls)},
+            timeout=(FETCH_CONNECT_TIMEOUT_SECONDS, timeout)
+        )
+        response.raise_for_status()
+        new_urls = [url for url in parse_google_results(response.text) if url not in urls]
+        urls.extend(new_urls)
+        if not new_urls or len(urls) >= num_results:
+            break
+    return urls[:num_results]
+
+def search_google_api(query, num_results, deadline=None):
+    if not SEARCH_API_KEY or not SEARCH_ENGINE_ID:
+        raise Exception("SEARCH_API_KEY and SEARCH_ENGINE_ID must be set to use the google_api provider.")
+    urls = []
+    while len(urls) < num_results:
+        timeout = get_remaining_seconds(deadline, SEARCH_TIMEOUT_SECONDS)
+        if timeout is None:
+            break
+        page_size = min(SEARCH_API_PAGE_SIZE, num_results - len(urls))
+        response = http_session.get(SEARCH_API_URL,
+            params={'key': SEARCH_API_KEY, 'cx': SEARCH_ENGINE_ID, 'q': query, 'num': page_size, 'start': len(urls) + 1},
+            timeout=(FETCH_CONNECT_TIMEOUT_SECONDS, timeout)
+        )
+        response.raise_for_status()
+        items = response.json().get('items', [])
+        urls.extend(item['link'] for item in items if item.get('link'))
+        if len(items) < page_size:
+            break
+    return urls[:num_results]
+
+def search_stub(query, num_results, deadline=None):
+    return [url.strip() for url in SEARCH_STUB_URLS.split(',') if url.strip()][:num_results]
+
+SEARCH_PROVIDERS = {
+    'google': search_google,
+    'google_api': search_google_api,
+    'stub': search_stub,
+}
+
+def get_search_cache_key(query):
+    return ' '.join(query.lower().split())
+
+def get_cached_search(key):
+    with search_cache_lock:
+        entry = search_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, urls = entry
+        if expires_at <= time.monotonic():
+            del search_cache[key]
+            return None
+        search_cache.move_to_end(key)
+        return list(urls)
+
+def put_cached_search(key, urls):
+    with search_cache_lock:
+        search_cache[key] = (time.monotonic() + SEARCH_CACHE_TTL_SECONDS, list(urls))
+        search_cache.move_to_end(key)
+        while len(search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+            search_cache.popitem(last=False)
+
+def search_web(query, deadline=None):
+    key = get_search_cache_key(query)
+    cached = get_cached_search(key)
+    if cached is not None:
+        print(f"Using cached search results for: {query}")
+        return cached
+    providers = {}
+    for name in SEARCH_PROVIDER_NAMES:
+        if name in SEARCH_PROVIDERS:
+            providers[name] = SEARCH_PROVIDERS[name]
+        else:
+            print(f"Skipping unknown search provider {name}")
+    urls = []
+    if not providers:
+        return urls
+    executor = ThreadPoolExecutor(max_workers=len(providers))
+    futures = {executor.submit(provider, query, SEARCH_NUM_RESULTS, deadline): name for name, provider in providers.items()}
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
     try:
-        search_results = []
-        for j in search(query, sleep_interval=5, num_results=10):
-            search_results.append(j)
-        return search_results
-    except Exception as e:
-        print(f"Error during Google search: {e}")
-        return []
+        for future in as_completed(futures, timeout=timeout):
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Error during {futures[future]} search: {e}")
+                continue
+            print(f"{futures[future]} search returned {len(results)} results")
+            for url in results:
+                if url not in urls:
+                    urls.append(url)
+            if len(urls) >= SEARCH_NUM_RESULTS:
+                break
+    except FuturesTimeoutError:
+        print(f"Search budget exhausted with {len(urls)} results")
+    # Do not wait for the slower providers
+    executor.shutdown(wait=False, cancel_futures=True)
+    urls = urls[:SEARCH_NUM_RESULTS]
+    if urls:
+        put_cached_search(key, urls)
+    return urls
+
+def get_deadline(context):
+    # Monotonic deadline derived from the time the Lambda runtime grants this invocation
+    if context is None:
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_SAFETY_MARGIN_SECONDS
 
-def handle_search(event):
+def fetch_pages(urls, deadline):
+    # Returns {url: content} for the pages that completed before the deadline, content is None for failed pages
+    contents = {}
+    if not urls:
+        return contents
+    executor = ThreadPoolExecutor(max_workers=min(FETCH_MAX_WORKERS, len(urls)))
+    futures = {executor.submit(get_page_content, url): url for url in urls}
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            contents[futures[future]] = future.result()
+    except FuturesTimeoutError:
+        print(f"Fetch budget exhausted, returning {len(contents)} of {len(urls)} pages")
+    # Do not wait for the pages that are still loading
+    executor.shutdown(wait=False, cancel_futures=True)
+    return contents
+
+def handle_search(event, context=None):
     input_text = event.get('inputText', '')  # Extract 'inputText'
     
     # Empty the /tmp directory before saving new files
     print("Emptying temporary directory...")
     empty_tmp_directory()
 
-    # Proceed with Google search
-    print("Performing Google search...")
-    urls_to_scrape = search_google(input_text)
+    # Search the web with the configured providers, bounded by the time left in this invocation
+    print("Performing web search...")
+    deadline = get_deadline(context)
+    urls_to_scrape = search_web(input_text, deadline)
+
+    # Fetch the pages concurrently
+    print("Fetching pages...")
+    contents = fetch_pages(urls_to_scrape, deadline)
 
     aggregated_content = ""
     results = []
     for url in urls_to_scrape:
         print("URLs Used: ", url)
-        content = get_page_content(url)
+        if url not in contents:
+            results.append({'url': url, 'error': 'Timed out fetching content'})
+            continue
+        content = contents[url]
         if content:
             print("CONTENT: ", content)
             filename = url.split('//')[-1].replace('/', '_') + '.txt'  # Simple filename from URL
@@ -102,14 +678,18 @@ def handle_search(event):
     else:
         results.append({'aggregated_file': aggregated_filename, 'error': 'Failed to save aggregated content to /tmp'})
 
-    return {"results": results}
+    # Rank the page passages against the input so the agent gets the relevant snippets instead of whole pages
+    print("Ranking passages...")
+    passages = rank_passages(input_text, [(url, contents.get(url)) for url in urls_to_scrape], deadline)
+
+    return {"results": results, "passages": passages}
 
 def handler(event, context):
     print("THE EVENT: ", event)
     
     response_code = 200
     if event.get('apiPath') == '/search':
-        result = handle_search(event)
+        result = handle_search(event, context)
     else:
         response_code = 404
         result = {"error": "Unrecognized api path"}
@@ -77,6 +77,11 @@ class DataFoundationStack(Stack):
             lifecycle_rules=[
                 s3.LifecycleRule(
                     noncurrent_version_expiration=Duration.days(7)
+                ),
+                # Pages cached by the search lambda are only rewritten when they change, expire old copies after a month
+                s3.LifecycleRule(
+                    prefix="page-cache/",
+                    expiration=Duration.days(30)
                 )
             ],
         )
@@ -371,6 +376,24 @@ class DataFoundationStack(Stack):
             lifecycle_rules=[
                 s3.LifecycleRule(
                     noncurrent_version_expiration=Duration.days(7)
+                ),
+                # Entries of the athena lambda result cache expire after ATHENA_RESULT_CACHE_TTL_SECONDS, or
+                # ATHENA_UNVERSIONED_RESULT_CACHE_TTL_SECONDS without a data version. Keep both below a day, this rule
+                # removes the leftovers.
+                s3.LifecycleRule(
+                    prefix="result-cache/",
+                    expiration=Duration.days(1)
+                ),
+                # Without an external_location Athena writes CTAS tables below tables/ of the enforced workgroup result
+                # location. Session result tables are dropped by the athena lambda after two hours, remove data left behind
+                s3.LifecycleRule(
+                    prefix="query-results/tables/",
+                    expiration=Duration.days(2)
+                ),
+                # Exported query results are shared with presigned links that expire within hours
+                s3.LifecycleRule(
+                    prefix="exports/",
+                    expiration=Duration.days(7)
                 )
             ],
         )
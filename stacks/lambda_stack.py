@@ -1,9 +1,14 @@
 from aws_cdk import (
     Duration,
+    Size,
     Stack,
     CfnOutput,
+    RemovalPolicy,
     aws_lambda as _lambda,
     aws_iam as iam,
+    aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as targets,
     Fn as Fn,
 )
 from cdk_nag import (
@@ -27,8 +32,21 @@ class LambdaStack(Stack):
             handler='lambda_athena.handler',
             timeout=Duration.seconds(60),
             memory_size=4048,
+            # Room for the local copy of the processed data set used by the embedded query engine
+            ephemeral_storage_size=Size.mebibytes(2048),
         )
 
+        # Create a Lambda layer with the embedded query engine and NumPy for the result summaries. Both are native
+        # packages, the layer holds their manylinux x86_64 builds for Python 3.13.
+        athena_layer = _lambda.LayerVersion(
+            self, 'athena-py-lib-layer',
+            code=_lambda.Code.from_asset('assets/lambda_layer_athena_deps.zip'),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_13],
+        )
+
+        # Add the layer to the athena lambda function
+        athena_lambda.add_layers(athena_layer)
+
         # Export the lambda arn
         CfnOutput(self, "LambdaAthenaForBedrockAgent",
             value=athena_lambda.function_arn,
@@ -55,6 +73,7 @@ class LambdaStack(Stack):
                 "athena:GetQueryExecutions",
                 "athena:GetQueryResults",
                 "athena:GetQueryResultsStream",
+                "athena:GetQueryRuntimeStatistics",
                 "athena:GetTable",
                 "athena:GetTableMetadata",
                 "athena:GetTables",
@@ -70,6 +89,8 @@ class LambdaStack(Stack):
                 "athena:StopQueryExecution",
                 "athena:BatchGetNamedQuery",
                 "athena:BatchGetPreparedStatement",
+                "athena:CreatePreparedStatement",
+                "athena:GetPreparedStatement",
                 "glue:GetDatabase",
                 "glue:GetDatabases"
                 ],
@@ -89,6 +110,7 @@ class LambdaStack(Stack):
                     "s3:AbortMultipartUpload",
                     "s3:CreateBucket",
                     "s3:PutObject",
+                    "s3:DeleteObject",
                     "s3:PutBucketLogging",
                     "s3:PutBucketVersioning",
                     "s3:PutBucketNotification",
@@ -112,7 +134,9 @@ class LambdaStack(Stack):
                     "glue:GetTables",
                     "glue:GetPartition",
                     "glue:GetPartitions",
-                    "glue:BatchGetPartition"
+                    "glue:BatchGetPartition",
+                    "glue:CreateTable",
+                    "glue:DeleteTable"
                 ],
             resources=[
                     f"arn:aws:glue:{dict1['region']}:{dict1['account_id']}:catalog",
@@ -144,6 +168,31 @@ class LambdaStack(Stack):
         
         athena_workgroup = Fn.import_value("AthenaWorkGroupName")
         athena_lambda.add_environment("ATHENA_WORKGROUP", athena_workgroup) 
+
+        data_bucket = Fn.import_value("DataSetBucketName")
+        athena_lambda.add_environment("DATA_BUCKET", data_bucket)
+
+        # Lifetimes of the result cache entries, with and without a data version. Keep both below the one day
+        # expiration of the result-cache/ prefix in the athena destination bucket
+        athena_lambda.add_environment("ATHENA_RESULT_CACHE_TTL_SECONDS", "21600")
+        athena_lambda.add_environment("ATHENA_UNVERSIONED_RESULT_CACHE_TTL_SECONDS", "3600")
+
+        # Create a table for the lock records that let concurrent invocations share one execution of identical queries
+        query_lock_table = dynamodb.Table(self, 'athena-query-locks',
+            partition_key=dynamodb.Attribute(name="LockKey", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
+            point_in_time_recovery=True,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        query_lock_table.grant_read_write_data(athena_lambda)
+        athena_lambda.add_environment("ATHENA_LOCK_TABLE", query_lock_table.table_name)
+
+        # Invoke the athena lambda every hour to drop the expired session result tables
+        session_cleanup_rule = events.Rule(self, 'session-result-cleanup',
+            schedule=events.Schedule.rate(Duration.hours(1)),
+        )
+        session_cleanup_rule.add_target(targets.LambdaFunction(athena_lambda))
         
         ### 2. Define a Lambda function for the agent to search the web
 
@@ -167,6 +216,35 @@ class LambdaStack(Stack):
         # Add the layer to the search lambda function
         search_lambda.add_layers(layer)
 
+        # Cache the scraped pages in the data bucket so unchanged pages are only revalidated
+        search_lambda.add_environment("PAGE_CACHE_BUCKET", data_bucket)
+
+        search_lambda.add_to_role_policy(
+            iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=[
+                    "s3:GetObject",
+                    "s3:PutObject",
+                ],
+            resources=[
+                    f"{Fn.import_value('DataSetBucketArn')}/page-cache/*",
+                    ],
+            )
+        )
+
+        # Passages are ranked with BM25, set SEARCH_EMBEDDING_MODEL_ID to rerank them with a Titan text embedding model
+        search_lambda.add_to_role_policy(
+            iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=[
+                    "bedrock:InvokeModel",
+                ],
+            resources=[
+                    f"arn:aws:bedrock:{dict1['region']}::foundation-model/amazon.titan-embed-text-*",
+                    ],
+            )
+        )
+
         # Export the lambda arn
         CfnOutput(self, "LambdaSearchForBedrockAgent",
             value=search_lambda.function_arn,
@@ -0,0 +1,102 @@
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+import types
+
+# Benchmark the page text extraction engines of the search lambda over a corpus of saved pages.
+#
+#   python tests/benchmarks/bench_page_extraction.py [directory of saved .html pages] [--repeat 3]
+#
+# Without a directory a synthetic corpus of documentation-like pages is generated. The search lambda dependencies
+# (bs4 and optionally selectolax and lxml) must be installed, googlesearch is not needed.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+if importlib.util.find_spec('googlesearch') is None:
+    sys.modules['googlesearch'] = types.SimpleNamespace()
+    sys.modules['googlesearch.user_agents'] = types.SimpleNamespace(get_useragent=None)
+
+import lambda_search
+from bs4 import BeautifulSoup
+
+WORDS = ('cell', 'throughput', 'latency', 'volte', 'erab', 'drop', 'rate', 'packet', 'traffic', 'vendor', 'region',
+    'availability', 'utilization', 'configure', 'parameter', 'threshold', 'network', 'signal', 'handover', 'carrier')
+
+def extract_text_legacy(html):
+    # The extraction the search lambda used before the engines were introduced
+    soup = BeautifulSoup(html, 'html.parser')
+    for script_or_style in soup(["script", "style"]):
+        script_or_style.decompose()
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return '\n'.join(chunk for chunk in chunks if chunk)
+
+def sentence(rng, size):
+    return ' '.join(rng.choice(WORDS) for _ in range(size)).capitalize() + '.'
+
+def synthetic_page(rng, sections):
+    parts = ['<!DOCTYPE html><html><head><title>Page</title>',
+        '<style>' + 'body { margin: 0; } ' * 200 + '</style>',
+        '<script>' + 'var x = 1; ' * 500 + '</script></head><body>',
+        '<header><nav><ul>' + ''.join(f'<li><a href="/p{i}">{sentence(rng, 2)}</a></li>' for i in range(60)) + '</ul></nav></header><main>']
+    for i in range(sections):
+        parts.append(f'<h2 id="s{i}">{sentence(rng, 5)}</h2>')
+        parts.extend(f'<p>{sentence(rng, 30)} <b>{sentence(rng, 3)}</b> {sentence(rng, 20)}</p>' for _ in range(4))
+        rows = ''.join(f'<tr><td>{sentence(rng, 2)}</td><td>{rng.random():.3f}</td></tr>' for _ in range(10))
+        parts.append(f'<table>{rows}</table><pre><code>{sentence(rng, 15)}</code></pre>')
+    parts.append('</main><aside>' + sentence(rng, 50) + '</aside><footer>' + sentence(rng, 40) + '</footer></body></html>')
+    return ''.join(parts)
+
+def load_corpus(directory):
+    pages = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(('.html', '.htm')):
+            with open(os.path.join(directory, filename), 'rb') as file:
+                pages.append(file.read().decode('utf-8', errors='replace'))
+    return pages
+
+def benchmark(extract, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for page in pages:
+            extract(page)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(pages)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the page text extraction engines of the search lambda')
+    parser.add_argument('corpus', nargs='?', help='directory of saved .html pages')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=50, help='number of synthetic pages')
+    args = parser.parse_args()
+
+    if args.corpus:
+        pages = load_corpus(args.corpus)
+    else:
+        rng = random.Random(7)
+        pages = [synthetic_page(rng, rng.randint(10, 60)) for _ in range(args.pages)]
+    if not pages:
+        sys.exit(f"No pages found in {args.corpus}")
+    print(f"{len(pages)} pages, {sum(len(page) for page in pages) / len(pages) / 1024:.0f} KiB on average")
+
+    engines = [('legacy', extract_text_legacy)]
+    for name, (extract, module) in lambda_search.EXTRACTION_ENGINES.items():
+        if module is None:
+            print(f"{name:<12} not installed")
+        else:
+            engines.append((name, extract))
+
+    baseline = None
+    for name, extract in engines:
+        per_page = benchmark(extract, pages, args.repeat)
+        baseline = baseline or per_page
+        print(f"{name:<12} {per_page * 1000:8.2f} ms CPU per page {baseline / per_page:8.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,929 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import lambda_athena
+
+
+def test_sampled_ratio_scales_each_aggregate():
+    query, report = lambda_athena.approximate_query('SELECT sum("traffic") / count(*) FROM data_proc', 10)
+    assert query == 'SELECT (sum("traffic") * 10) / (count(*) * 10) FROM data_proc TABLESAMPLE BERNOULLI (10)'
+    assert report['SamplePercent'] == 10
+
+
+def test_sampled_percentage_keeps_precedence():
+    query, _ = lambda_athena.approximate_query('SELECT 100.0 * sum(a) / sum(b) AS share FROM data_proc WHERE city = \'x\'', 20)
+    assert query == 'SELECT 100.0 * (sum(a) * 5) / (sum(b) * 5) AS share FROM data_proc TABLESAMPLE BERNOULLI (20) WHERE city = \'x\''
+
+
+def test_sampled_aggregate_wraps_filter_and_window_clauses():
+    query, _ = lambda_athena.approximate_query('SELECT count(*) FILTER (WHERE a > 1), sum(count(*)) OVER () FROM data_proc d GROUP BY city', 50)
+    assert query == ('SELECT (count(*) FILTER (WHERE a > 1) * 2), (sum(count(*)) OVER () * 2) '
+        'FROM data_proc d TABLESAMPLE BERNOULLI (50) GROUP BY city')
+
+
+def test_nested_select_is_not_sampled():
+    query, report = lambda_athena.approximate_query('SELECT sum(a) FROM (SELECT a FROM data_proc)', 10)
+    assert query == 'SELECT sum(a) FROM (SELECT a FROM data_proc)'
+    assert report['SamplePercent'] is None
+
+
+def test_approximate_functions_are_rewritten():
+    query, report = lambda_athena.approximate_query(
+        'SELECT count(DISTINCT "4g_cell_name"), median(x), percentile_cont(0.9) WITHIN GROUP (ORDER BY y DESC) FROM data_proc')
+    assert query == 'SELECT approx_distinct("4g_cell_name"), approx_percentile(x, 0.5), approx_percentile(y, 1 - 0.9) FROM data_proc'
+    assert report['SamplePercent'] is None
+
+
+def test_multi_column_distinct_count_is_not_rewritten():
+    query, report = lambda_athena.approximate_query(
+        'SELECT count(DISTINCT city, concat(a, b)), count(DISTINCT coalesce(city, \'x\')) FROM data_proc')
+    assert query == 'SELECT count(DISTINCT city, concat(a, b)), approx_distinct(coalesce(city, \'x\')) FROM data_proc'
+    assert report['Rewrites'] == ['count(DISTINCT) -> approx_distinct']
+    assert lambda_athena.approximate_query('SELECT count(DISTINCT a, b) FROM data_proc') == (
+        'SELECT count(DISTINCT a, b) FROM data_proc', None)
+
+
+def test_sampled_min_and_max_are_reported_as_biased():
+    _, report = lambda_athena.approximate_query('SELECT min(a), max(a), sum(a) FROM data_proc', 10)
+    assert 'min and max only see the sampled rows' in report['ErrorBounds'][0]
+
+
+def test_exact_query_is_left_alone():
+    assert lambda_athena.approximate_query('SELECT city FROM data_proc') == ('SELECT city FROM data_proc', None)
+
+
+class FakeResultClients:
+    # Athena result pages and the CSV object of a SELECT with the columns n and label, one row per number
+    def __init__(self, row_count):
+        self.records = [['n', 'label']] + [[str(n), f"row {n}"] for n in range(row_count)]
+        self.body = ''.join(','.join(f'"{value}"' for value in record) + '\n' for record in self.records).encode('utf-8')
+
+    def page(self, start, size):
+        rows = [{'Data': [{'VarCharValue': value} for value in record]} for record in self.records[start:start + size]]
+        page = {'ResultSet': {'Rows': rows, 'ResultSetMetadata': {'ColumnInfo': [
+            {'Name': 'n', 'Type': 'integer'}, {'Name': 'label', 'Type': 'varchar'}]}}}
+        if start + size < len(self.records):
+            page['NextToken'] = str(start + size)
+        return page
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, QueryExecutionId, PaginationConfig):
+        start = int(PaginationConfig.get('StartingToken') or 0)
+        while True:
+            page = self.page(start, PaginationConfig['PageSize'])
+            yield page
+            if 'NextToken' not in page:
+                break
+            start = int(page['NextToken'])
+
+    def get_query_results(self, QueryExecutionId, MaxResults):
+        return self.page(0, MaxResults)
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': {'ResultConfiguration': {'OutputLocation': f"s3://results/{QueryExecutionId}.csv"}}}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(value) for value in Range[len('bytes='):].split('-'))
+        return {'Body': io.BytesIO(self.body[start:end + 1]), 'ContentRange': f"bytes {start}-{end}/{len(self.body)}"}
+
+
+def read_all(monkeypatch, row_count, **kwargs):
+    clients = FakeResultClients(row_count)
+    monkeypatch.setattr(lambda_athena, 'athena_client', clients)
+    monkeypatch.setattr(lambda_athena, 's3_client', clients)
+    return lambda_athena.read_query_results('execution', max_rows=10000, max_bytes=10 ** 9, **kwargs)
+
+
+def test_fresh_read_streams_every_row_after_the_first_page(monkeypatch):
+    result = read_all(monkeypatch, 3000)
+    assert [row[0] for row in result['Rows']] == [str(n) for n in range(3000)]
+    assert result['Rows'][1500] == ['1500', 'row 1500']
+    assert not result['Truncated']
+
+
+def test_continued_read_from_the_first_page_streams_every_remaining_row(monkeypatch):
+    # Offset 500 of the first page is the data row 499, the header is record 0
+    result = read_all(monkeypatch, 3000, offset=500)
+    assert [row[0] for row in result['Rows']] == [str(n) for n in range(499, 3000)]
+
+
+def test_cleanup_drops_expired_session_tables_at_their_catalog_location(monkeypatch):
+    with mock_aws():
+        monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+        s3 = boto3.client('s3')
+        glue = boto3.client('glue')
+        monkeypatch.setattr(lambda_athena, 's3_client', s3)
+        monkeypatch.setattr(lambda_athena, 'glue_client', glue)
+        s3.create_bucket(Bucket='athena-results')
+        s3.create_bucket(Bucket='data-set')
+        glue.create_database(DatabaseInput={'Name': lambda_athena.GLUE_DATABASE})
+        now_ms = int(time.time() * 1000)
+        tables = {
+            f"session_result_abc_{now_ms - 3 * 3600 * 1000}": 's3://athena-results/query-results/tables/expired',
+            f"session_result_abc_{now_ms}": 's3://athena-results/query-results/tables/recent',
+            f"session_result_def_{now_ms - 3 * 3600 * 1000}": 's3://data-set/data-proc',
+        }
+        for name, location in tables.items():
+            glue.create_table(DatabaseName=lambda_athena.GLUE_DATABASE,
+                              TableInput={'Name': name, 'StorageDescriptor': {'Location': location}})
+        for table in ('expired', 'expired-other', 'recent'):
+            s3.put_object(Bucket='athena-results', Key=f"query-results/tables/{table}/part-0.parquet", Body=b'x')
+        s3.put_object(Bucket='data-set', Key='data-proc/part-0.parquet', Body=b'x')
+
+        result = lambda_athena.cleanup_session_results()
+
+        assert sorted(result['DroppedTables']) == sorted(name for name in tables if 'recent' not in tables[name])
+        keys = [item['Key'] for item in s3.list_objects_v2(Bucket='athena-results')['Contents']]
+        assert keys == ['query-results/tables/expired-other/part-0.parquet', 'query-results/tables/recent/part-0.parquet']
+        # Data outside the Athena bucket is never deleted
+        assert s3.list_objects_v2(Bucket='data-set')['KeyCount'] == 1
+
+
+def governed(monkeypatch, query):
+    # Ten partitions of 1 GiB each, every full scan is over the limit
+    partitions = {f"{day:02d} Feb 24": 1024 ** 3 for day in range(1, 11)}
+    monkeypatch.setattr(lambda_athena, 'get_table_stats', lambda: (partitions, ['city', 'date', 'vendor']))
+    monkeypatch.setattr(lambda_athena, 'GOVERNOR_MODE', 'enforce')
+    return lambda_athena.govern_query(query)
+
+
+def test_order_by_date_is_not_a_date_filter(monkeypatch):
+    with pytest.raises(lambda_athena.QueryRejectedError):
+        governed(monkeypatch, "SELECT city FROM data_proc WHERE city = 'a' ORDER BY date")
+
+
+def test_date_predicate_passes_the_governor(monkeypatch):
+    query, report = governed(monkeypatch, "SELECT city FROM data_proc WHERE city = 'a' AND \"date\" = '10 Feb 24'")
+    assert report['HasDateFilter'] and report['PartitionsScanned'] == 1
+    assert query.endswith('LIMIT 1000')
+
+
+def test_date_predicate_in_a_subquery_counts(monkeypatch):
+    _, report = governed(monkeypatch, "SELECT count(*) FROM (SELECT city FROM data_proc WHERE date >= '05 Feb 24') t")
+    assert report['HasDateFilter']
+
+
+def test_metadata_statements_are_not_governed(monkeypatch):
+    for query in ('DESCRIBE data_set_db.data_proc', 'SHOW COLUMNS FROM data_set_db.data_proc'):
+        assert governed(monkeypatch, query) == (query, None)
+
+
+def test_writes_on_data_proc_are_rejected(monkeypatch):
+    with pytest.raises(lambda_athena.QueryRejectedError):
+        governed(monkeypatch, 'DROP TABLE data_set_db.data_proc')
+
+
+def test_batch_queries_are_split_outside_literals():
+    assert lambda_athena.parse_batch_queries("SELECT 'a;b' AS x; SELECT \"c;d\" FROM t;") == [
+        "SELECT 'a;b' AS x", 'SELECT "c;d" FROM t']
+    assert lambda_athena.parse_batch_queries('["SELECT 1", "SELECT 2"]') == ['SELECT 1', 'SELECT 2']
+    assert lambda_athena.parse_batch_queries('"SELECT 1; SELECT 2"') == ['SELECT 1', 'SELECT 2']
+
+
+@pytest.mark.parametrize('value', ['5', '{"q": "SELECT 1"}', '["SELECT 1", 2]', 'null'])
+def test_batch_queries_that_are_not_sql_are_rejected(value):
+    with pytest.raises(ValueError):
+        lambda_athena.parse_batch_queries(value)
+
+
+def fake_result(max_bytes):
+    # Rows of about 100 bytes up to the budget
+    rows = []
+    while len(json.dumps(rows)) + 100 <= max_bytes:
+        rows.append(['x' * 94])
+    return {'ColumnInfo': [{'Name': 'x', 'Type': 'varchar'}], 'Rows': rows, 'Truncated': True, 'ContinuationToken': 'token'}
+
+
+def test_batch_results_stay_within_the_shared_budget_when_cached(monkeypatch):
+    with mock_aws():
+        monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+        monkeypatch.delenv('DATA_BUCKET', raising=False)
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='athena-results')
+        monkeypatch.setattr(lambda_athena, 's3_client', s3)
+        monkeypatch.setattr(lambda_athena, 'result_cache', lambda_athena.OrderedDict())
+        monkeypatch.setattr(lambda_athena, 'run_fast_path_query', lambda *args, **kwargs: None)
+        monkeypatch.setattr(lambda_athena, 'start_or_attach', lambda query, *args: (query, 'owner'))
+        monkeypatch.setattr(lambda_athena, 'release_query_lock', lambda *args: None)
+        monkeypatch.setattr(lambda_athena, 'wait_for_queries',
+                            lambda execution_ids, deadline, owned_ids: {execution_id: {'Status': {'State': 'SUCCEEDED'}} for execution_id in execution_ids})
+        monkeypatch.setattr(lambda_athena, 'read_query_results', lambda execution_id, max_bytes: fake_result(max_bytes))
+
+        queries = [f"SELECT x FROM other WHERE id = {index}" for index in range(10)]
+        # Each statement was cached with the full budget by /athenaQuery
+        for query in queries:
+            lambda_athena.put_cached_result(lambda_athena.get_cache_fingerprint(query), fake_result(lambda_athena.MAX_RESULT_BYTES))
+
+        for _ in range(2):
+            outcomes = lambda_athena.run_batch_queries(queries, 's3://athena-results', 'wg', None)
+            assert sum(len(json.dumps(result['Rows'])) for result, _, _ in outcomes) <= lambda_athena.MAX_RESULT_BYTES
+        # The second batch is served from the cache entries of the batch budget
+        assert all(tier == 'memory' for _, tier, _ in outcomes)
+
+
+def test_fingerprint_ignores_layout_comments_case_and_in_list_order():
+    fingerprint = lambda_athena.query_fingerprint("SELECT city, sum(x) FROM data_proc WHERE vendor IN ('Nokia', 'Ericsson') GROUP BY city")
+    assert lambda_athena.query_fingerprint(
+        "select CITY,\n  SUM(x) -- traffic\nfrom data_proc /* all */ where vendor in ('Ericsson','Nokia') group by city;") == fingerprint
+    # String literals keep their case and different values are different queries
+    assert lambda_athena.query_fingerprint("SELECT city, sum(x) FROM data_proc WHERE vendor IN ('nokia', 'Ericsson') GROUP BY city") != fingerprint
+    assert lambda_athena.query_fingerprint("SELECT city, sum(x) FROM data_proc WHERE vendor IN ('Nokia') GROUP BY city") != fingerprint
+
+
+@pytest.mark.parametrize('query', ["INSERT INTO t SELECT * FROM data_proc", "SELECT 1; DROP TABLE data_proc", "DROP TABLE data_proc"])
+def test_statements_that_modify_anything_are_not_cached(monkeypatch, query):
+    monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: None)
+    assert lambda_athena.get_cache_fingerprint(query) is None
+
+
+def test_cache_fingerprint_includes_the_data_version(monkeypatch):
+    query = 'SELECT count(*) FROM data_proc'
+    monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: None)
+    unversioned = lambda_athena.get_cache_fingerprint(query)
+    monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: 'v1')
+    first = lambda_athena.get_cache_fingerprint(query)
+    monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: 'v2')
+    assert len({unversioned, first, lambda_athena.get_cache_fingerprint(query)}) == 3
+
+
+def test_result_cache_serves_from_memory_then_s3(monkeypatch):
+    with mock_aws():
+        monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='athena-results')
+        monkeypatch.setattr(lambda_athena, 's3_client', s3)
+        monkeypatch.setattr(lambda_athena, 'result_cache', lambda_athena.OrderedDict())
+        monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: None)
+        result = fake_result(1000)
+
+        assert lambda_athena.get_cached_result('abc') == (None, None)
+        lambda_athena.put_cached_result('abc', result)
+        assert lambda_athena.get_cached_result('abc') == (result, 'memory')
+
+        # A cold container finds the entry in S3 and keeps it in memory for the next invocation
+        lambda_athena.result_cache.clear()
+        assert lambda_athena.get_cached_result('abc') == (result, 's3')
+        assert lambda_athena.get_cached_result('abc') == (result, 'memory')
+
+        # Expired entries are misses in both tiers
+        s3.put_object(Bucket='athena-results', Key='result-cache/abc.json', Body=json.dumps({'ExpiresAt': time.time() - 1, 'Result': result}))
+        lambda_athena.result_cache['abc'] = (time.time() - 1, result)
+        assert lambda_athena.get_cached_result('abc') == (None, None)
+        assert 'abc' not in lambda_athena.result_cache
+
+
+def test_memory_cache_keeps_the_most_recently_used_entries(monkeypatch):
+    monkeypatch.setattr(lambda_athena, 'result_cache', lambda_athena.OrderedDict())
+    monkeypatch.setattr(lambda_athena, 'RESULT_CACHE_MAX_ENTRIES', 2)
+    expires_at = time.time() + 60
+    for fingerprint in ('a', 'b'):
+        lambda_athena.store_in_memory_cache(fingerprint, expires_at, {'Rows': []})
+    assert lambda_athena.get_cached_result('a')[1] == 'memory'
+    lambda_athena.store_in_memory_cache('c', expires_at, {'Rows': []})
+    assert list(lambda_athena.result_cache) == ['a', 'c']
+
+
+@pytest.mark.parametrize('version, ttl_name', [('v1', 'RESULT_CACHE_TTL_SECONDS'), (None, 'UNVERSIONED_RESULT_CACHE_TTL_SECONDS')])
+def test_cached_results_expire_after_the_configured_ttl(monkeypatch, version, ttl_name):
+    with mock_aws():
+        monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='athena-results')
+        monkeypatch.setattr(lambda_athena, 's3_client', s3)
+        monkeypatch.setattr(lambda_athena, 'result_cache', lambda_athena.OrderedDict())
+        monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: version)
+        monkeypatch.setattr(lambda_athena, ttl_name, 120)
+
+        lambda_athena.put_cached_result('abc', fake_result(1000))
+        entry = json.loads(s3.get_object(Bucket='athena-results', Key='result-cache/abc.json')['Body'].read())
+        assert 110 < entry['ExpiresAt'] - time.time() <= 120
+        assert lambda_athena.result_cache['abc'][0] == entry['ExpiresAt']
+
+
+def test_result_cache_ttl_settings_are_independent():
+    script = 'import lambda_athena; print(lambda_athena.RESULT_CACHE_TTL_SECONDS, lambda_athena.UNVERSIONED_RESULT_CACHE_TTL_SECONDS)'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    env.pop('ATHENA_RESULT_CACHE_TTL_SECONDS', None)
+    env.pop('ATHENA_UNVERSIONED_RESULT_CACHE_TTL_SECONDS', None)
+    assert subprocess.check_output([sys.executable, '-c', script], env=env).split() == [b'21600', b'3600']
+    env['ATHENA_RESULT_CACHE_TTL_SECONDS'] = '600'
+    assert subprocess.check_output([sys.executable, '-c', script], env=env).split() == [b'600', b'3600']
+    env['ATHENA_UNVERSIONED_RESULT_CACHE_TTL_SECONDS'] = '60'
+    assert subprocess.check_output([sys.executable, '-c', script], env=env).split() == [b'600', b'60']
+
+
+def create_lock_table():
+    dynamodb = boto3.client('dynamodb')
+    dynamodb.create_table(TableName='locks', KeySchema=[{'AttributeName': 'LockKey', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'LockKey', 'AttributeType': 'S'}], BillingMode='PAY_PER_REQUEST')
+
+
+def test_token_bucket_is_shared_by_containers():
+    with mock_aws():
+        create_lock_table()
+        first, second = lambda_athena.DynamoDbTokenBucketStore('locks'), lambda_athena.DynamoDbTokenBucketStore('locks')
+        assert [store.take('admission#workgroup', 0.5, 3) for store in (first, second, first)] == [0, 0, 0]
+        # The burst is used up across both containers, the next token follows at the refill rate
+        assert 1.5 < second.take('admission#workgroup', 0.5, 3) <= 2
+
+
+def test_admission_is_limited_per_session(monkeypatch):
+    with mock_aws():
+        create_lock_table()
+        monkeypatch.setattr(lambda_athena, 'token_bucket_store', lambda_athena.DynamoDbTokenBucketStore('locks'))
+        monkeypatch.setattr(lambda_athena, 'ADMISSION_SESSION_BURST', 2)
+        monkeypatch.setattr(lambda_athena, 'ADMISSION_SESSION_RATE_PER_SECOND', 0.1)
+        for _ in range(2):
+            lambda_athena.admit_query_start('session-a', None)
+        with pytest.raises(lambda_athena.QueryThrottledError):
+            lambda_athena.admit_query_start('session-a', time.monotonic() + 1)
+        # Other sessions still start queries from the shared workgroup bucket
+        lambda_athena.admit_query_start('session-b', time.monotonic() + 1)
+
+
+@pytest.fixture
+def fast_path_data(monkeypatch, tmp_path):
+    duckdb = pytest.importorskip('duckdb')
+    with mock_aws():
+        # A small data_proc table partitioned by date the way the etl job writes it
+        source = tmp_path / 'source'
+        duckdb.connect().execute(f"""
+            COPY (SELECT "4g_cell_name", city, vendor, CAST("4g_volte_traffic" AS DOUBLE) AS "4g_volte_traffic", users, date FROM (VALUES
+                ('cell_1', 'Riyadh_City', 'Ericsson', 10.5, 7, '10 Feb 24'),
+                ('cell_2', 'Riyadh_City', 'Nokia', 20.0, 8, '10 Feb 24'),
+                ('cell_1', 'Riyadh_City', 'Ericsson', 30.0, 9, '11 Feb 24'),
+                ('cell_3', 'Rural', 'Nokia', 5.0, 3, '11 Feb 24'))
+                AS t("4g_cell_name", city, vendor, "4g_volte_traffic", users, date))
+            TO '{source}' (FORMAT PARQUET, PARTITION_BY (date))""")
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='data-set')
+        for path in source.rglob('*.parquet'):
+            s3.upload_file(str(path), 'data-set', f"{lambda_athena.DATA_PROC_PREFIX}{path.relative_to(source).as_posix()}")
+
+        monkeypatch.setenv('DATA_BUCKET', 'data-set')
+        monkeypatch.setattr(lambda_athena, 's3_client', s3)
+        monkeypatch.setattr(lambda_athena, 'FAST_PATH_CACHE_DIR', str(tmp_path / 'cache'))
+        monkeypatch.setattr(lambda_athena, 'fast_path', {'connection': None, 'synced_at': 0.0, 'etags': {}, 'available': False, 'version': None})
+        monkeypatch.setattr(lambda_athena, 'data_version', {'checked_at': 0.0, 'version': None})
+        yield tmp_path
+
+
+def test_fast_path_answers_from_generated_parquet(fast_path_data):
+    result = lambda_athena.run_fast_path_query(
+        'SELECT "date", count(*) AS cells, sum("4g_volte_traffic") AS traffic, sum(users) / 2 AS half '
+        'FROM data_set_db.data_proc WHERE "city" = \'Riyadh_City\' GROUP BY "date" ORDER BY "date"', None)
+    assert [column['Type'] for column in result['ColumnInfo']] == ['varchar', 'bigint', 'double', 'bigint']
+    # The date partition stays a string and integer division truncates as on Athena
+    assert result['Rows'] == [['10 Feb 24', '2', '30.5', '7'], ['11 Feb 24', '1', '30.0', '4']]
+
+    # Statements DuckDB cannot run fall back to Athena
+    assert lambda_athena.run_fast_path_query('SELECT athena_only_function(city) FROM data_proc', None) is None
+
+
+@pytest.mark.parametrize('query', [
+    "SELECT * FROM read_csv('/etc/passwd', header = false), data_proc",
+    "SELECT * FROM glob('/etc/*'), data_proc",
+    "SELECT city FROM data_proc UNION ALL SELECT content FROM read_text('/etc/hostname')",
+])
+def test_fast_path_cannot_read_local_files(fast_path_data, query):
+    assert lambda_athena.run_fast_path_query(query, None) is None
+    # The configuration can't be unlocked from a query either
+    connection = lambda_athena.fast_path['connection']
+    with pytest.raises(Exception):
+        connection.cursor().execute("SET enable_external_access = true")
+
+
+def test_fast_path_sync_is_bounded_and_resumed(fast_path_data, monkeypatch):
+    monkeypatch.setattr(lambda_athena, 'FAST_PATH_SYNC_MAX_SECONDS', 0)
+    query = 'SELECT count(*) FROM data_proc'
+    # The mirror is not ready within the budget, the query runs on Athena and the next request continues the sync
+    assert lambda_athena.run_fast_path_query(query, time.monotonic() + 30) is None
+    assert lambda_athena.fast_path['synced_at'] == 0.0
+    monkeypatch.setattr(lambda_athena, 'FAST_PATH_SYNC_MAX_SECONDS', 10)
+    # A request that is almost out of time does not start downloading
+    assert lambda_athena.run_fast_path_query(query, time.monotonic()) is None
+    assert lambda_athena.run_fast_path_query(query, time.monotonic() + 30)['Rows'] == [['4']]
+
+
+class FakeStatisticsClient:
+    def __init__(self, output_rows):
+        self.output_rows = output_rows
+
+    def get_query_runtime_statistics(self, QueryExecutionId):
+        return {'QueryRuntimeStatistics': {'Rows': {'InputRows': 10 ** 6, 'OutputRows': self.output_rows}}}
+
+
+def test_export_manifest_takes_the_row_count_from_athena(monkeypatch):
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='athena-dest')
+        for n in range(3):
+            s3.put_object(Bucket='athena-dest', Key=f"exports/abc/part-{n}.parquet", Body=b'PAR1' * (n + 1))
+        monkeypatch.setattr(lambda_athena, 's3_client', s3)
+        monkeypatch.setattr(lambda_athena, 'athena_client', FakeStatisticsClient(12345))
+
+        export = lambda_athena.build_export_body('s3://athena-dest/exports/abc/', 'execution-1')['Export']
+        assert export['TotalRows'] == 12345
+        assert export['FileCount'] == 3
+        assert export['TotalBytes'] == 24
+        assert [item['Key'] for item in export['Files']] == [f"exports/abc/part-{n}.parquet" for n in range(3)]
+        assert all(item['Url'].startswith('https://') for item in export['Files'])
+
+
+def read_emf_line(output):
+    # The EMF document is the last line the handler prints
+    record = json.loads(output.strip().splitlines()[-1])
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    return record, directive
+
+
+def test_metrics_are_emitted_as_one_emf_document(capsys):
+    lambda_athena.reset_metrics()
+    lambda_athena.record_query_statistics({'Statistics': {
+        'QueryQueueTimeInMillis': 40, 'EngineExecutionTimeInMillis': 900, 'QueryPlanningTimeInMillis': 25,
+        'DataScannedInBytes': 2048, 'ResultReuseInformation': {'ReusedPreviousResult': True}}})
+    # Values of the same metric add up across the statements of a batch
+    lambda_athena.add_metric('DataScannedInBytes', 1024)
+    lambda_athena.add_metric('RowsReturned', 7)
+    lambda_athena.emit_metrics('athena-actions', '/athenaQuery', 200)
+
+    record, directive = read_emf_line(capsys.readouterr().out)
+    assert isinstance(record['_aws']['Timestamp'], int)
+    assert directive['Namespace'] == lambda_athena.METRICS_NAMESPACE
+    assert directive['Dimensions'] == [['ActionGroup', 'ApiPath']]
+    assert record['ActionGroup'] == 'athena-actions'
+    assert record['ApiPath'] == '/athenaQuery'
+    assert record['HttpStatusCode'] == 200
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    assert units == {'QueueTime': 'Milliseconds', 'EngineExecutionTime': 'Milliseconds', 'PlanningTime': 'Milliseconds',
+                     'DataScannedInBytes': 'Bytes', 'ResultReuseHit': 'Count', 'RowsReturned': 'Count'}
+    assert record['DataScannedInBytes'] == 3072
+    assert record['ResultReuseHit'] == 1
+    assert record['RowsReturned'] == 7
+
+
+def test_handler_emits_metrics_for_every_response(capsys):
+    lambda_athena.add_metric('RowsReturned', 5)
+    response = lambda_athena.handler({'actionGroup': 'athena-actions', 'apiPath': '/unknown'}, None)
+    assert response['response']['httpStatusCode'] == 404
+
+    record, directive = read_emf_line(capsys.readouterr().out)
+    assert record['ApiPath'] == '/unknown'
+    assert record['HttpStatusCode'] == 404
+    # Metrics of an earlier invocation of the container are not carried over
+    assert 'RowsReturned' not in record
+    assert {metric['Name'] for metric in directive['Metrics']} == {'PayloadBytes', 'HandlerLatency'}
+    assert record['PayloadBytes'] == len(json.dumps(response['response']['responseBody']))
+
+
+class FakeAthenaClient:
+    # Executions by id as {'Query': ..., 'States': [...]}, each poll advances an execution to its next state
+
+    def __init__(self, executions=None):
+        self.executions = executions or {}
+        self.stopped = []
+        self.polls = []
+
+    def describe(self, execution_id):
+        execution = self.executions[execution_id]
+        state = execution['States'][0] if execution_id not in self.stopped else 'CANCELLED'
+        if len(execution['States']) > 1:
+            execution['States'].pop(0)
+        return {'QueryExecutionId': execution_id, 'Query': execution['Query'], 'Status': {'State': state},
+                'Statistics': execution.get('Statistics', {})}
+
+    def get_query_execution(self, QueryExecutionId):
+        self.polls.append(QueryExecutionId)
+        return {'QueryExecution': self.describe(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.polls.extend(QueryExecutionIds)
+        return {'QueryExecutions': [self.describe(execution_id) for execution_id in QueryExecutionIds]}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.stopped.append(QueryExecutionId)
+
+
+def test_polling_backs_off_with_jitter_up_to_the_cap(monkeypatch):
+    athena = FakeAthenaClient({'query': {'Query': 'SELECT 1', 'States': ['QUEUED'] + ['RUNNING'] * 9 + ['SUCCEEDED']}})
+    monkeypatch.setattr(lambda_athena, 'athena_client', athena)
+    sleeps = []
+    monkeypatch.setattr(lambda_athena.time, 'sleep', sleeps.append)
+    assert lambda_athena.wait_for_query('query', time.monotonic() + 60)['Status']['State'] == 'SUCCEEDED'
+    assert len(athena.polls) == 11
+    assert len(sleeps) == 10
+    for attempt, delay in enumerate(sleeps):
+        bound = min(lambda_athena.POLL_INITIAL_DELAY_SECONDS * lambda_athena.POLL_BACKOFF_FACTOR ** attempt,
+                    lambda_athena.POLL_MAX_DELAY_SECONDS)
+        assert bound / 2 <= delay <= bound
+    assert max(sleeps) <= lambda_athena.POLL_MAX_DELAY_SECONDS
+    assert sleeps[-1] > sleeps[0] * 4
+
+    # Jittered delays differ between invocations, the engine time reported by Athena raises the delay
+    running = {'Status': {'State': 'RUNNING'}, 'Statistics': {'EngineExecutionTimeInMillis': 5000}}
+    delays = {lambda_athena.next_poll_delay(0, running) for _ in range(20)}
+    assert len(delays) > 1
+    assert all(0.5 <= delay <= 1.0 for delay in delays)
+    assert lambda_athena.next_poll_delay(100, running) <= lambda_athena.POLL_MAX_DELAY_SECONDS
+
+
+def test_query_still_running_at_the_deadline_is_stopped(monkeypatch):
+    athena = FakeAthenaClient({'query': {'Query': 'SELECT 1', 'States': ['RUNNING']}})
+    monkeypatch.setattr(lambda_athena, 'athena_client', athena)
+    start = time.monotonic()
+    with pytest.raises(lambda_athena.QueryTimeoutError, match='was cancelled'):
+        lambda_athena.wait_for_query('query', time.monotonic() + 0.3)
+    # The last sleep is cut to the deadline
+    assert time.monotonic() - start < 1
+    assert athena.stopped == ['query']
+
+    # A detached query keeps running
+    athena.stopped = []
+    with pytest.raises(lambda_athena.QueryStillRunningError):
+        lambda_athena.wait_for_query('query', time.monotonic() + 0.1, detach=True)
+    assert athena.stopped == []
+
+
+def test_batch_deadline_only_stops_owned_executions(monkeypatch):
+    athena = FakeAthenaClient({
+        'owned': {'Query': 'SELECT 1', 'States': ['RUNNING']},
+        'shared': {'Query': 'SELECT 2', 'States': ['RUNNING']},
+    })
+    monkeypatch.setattr(lambda_athena, 'athena_client', athena)
+    monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: None)
+    monkeypatch.setattr(lambda_athena, 'run_local_query', lambda *args, **kwargs: (None, None))
+    # The first statement starts its own execution, the second attaches to the execution of another caller
+    monkeypatch.setattr(lambda_athena, 'start_or_attach',
+                        lambda query, *args: ('owned', 'owner') if 'id = 1' in query else ('shared', None))
+    released = []
+    monkeypatch.setattr(lambda_athena, 'release_query_lock', lambda fingerprint, owner: released.append(owner))
+
+    queries = ['SELECT x FROM other WHERE id = 1', 'SELECT x FROM other WHERE id = 2']
+    outcomes = lambda_athena.run_batch_queries(queries, 's3://athena-results', 'wg', time.monotonic() + 0.3)
+    assert athena.stopped == ['owned']
+    assert 'was cancelled' in outcomes[0][2]
+    assert 'keeps running' in outcomes[1][2]
+    assert sorted(map(str, released)) == ['None', 'owner']
+
+
+def agent_event(api_path, session_id='session-a', **properties):
+    # Action group event as the Bedrock agent sends it
+    return {
+        'actionGroup': 'athena-actions',
+        'apiPath': api_path,
+        'httpMethod': 'POST',
+        'sessionId': session_id,
+        'requestBody': {'content': {'application/json': {'properties': [
+            {'name': name, 'type': 'string', 'value': value} for name, value in properties.items()]}}},
+    }
+
+
+def test_materialized_tables_hold_the_complete_result(monkeypatch):
+    monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+    monkeypatch.setenv('ATHENA_WORKGROUP', 'wg')
+    materialized = []
+    ran = []
+    monkeypatch.setattr(lambda_athena, 'materialize_query',
+                        lambda query, *args: materialized.append(query) or 'session_result_abc_1')
+    monkeypatch.setattr(lambda_athena, 'run_query', lambda query, *args: ran.append(query) or (fake_result(100), None))
+    partitions = {f"{day:02d} Feb 24": 1024 for day in range(1, 11)}
+    monkeypatch.setattr(lambda_athena, 'get_table_stats', lambda: (partitions, ['city', 'date', 'vendor']))
+    query = "SELECT cell, city FROM data_proc WHERE date = '01 Feb 24'"
+
+    lambda_athena.athena_query_handler(agent_event('/athenaQuery', Query=query, Materialize='true'), None)
+    assert materialized == [query]
+    # Only the rows returned from the table are limited
+    assert ran == [f"SELECT * FROM {lambda_athena.GLUE_DATABASE}.session_result_abc_1\nLIMIT {lambda_athena.GOVERNOR_DEFAULT_LIMIT}"]
+
+    lambda_athena.athena_query_handler(agent_event('/athenaQuery', Query=query), None)
+    assert ran[-1] == f"{query}\nLIMIT {lambda_athena.GOVERNOR_DEFAULT_LIMIT}"
+
+
+@pytest.mark.parametrize('properties', [{}, {'Query': ''}, {'Query': '   '}])
+def test_missing_query_is_a_bad_request(monkeypatch, properties):
+    monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+    monkeypatch.setenv('ATHENA_WORKGROUP', 'wg')
+    response = lambda_athena.handler(agent_event('/athenaQuery', **properties), None)['response']
+    assert response['httpStatusCode'] == 400
+    assert response['responseBody']['application/json']['body'] == {'error': 'Query is required'}
+
+
+TYPED_RESULT = {
+    'ColumnInfo': [{'Name': 'city', 'Type': 'varchar'}, {'Name': 'drops', 'Type': 'bigint'},
+                   {'Name': 'rate', 'Type': 'double'}, {'Name': 'active', 'Type': 'boolean'}, {'Name': 'day', 'Type': 'date'}],
+    'Rows': [['Lisbon', '12', '0.25', 'true', '2024-02-05'], ['Porto', None, 'NaN', 'false', None]],
+    'Truncated': False,
+}
+
+
+def test_compact_format_returns_typed_values(monkeypatch):
+    monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+    monkeypatch.setenv('ATHENA_WORKGROUP', 'wg')
+    monkeypatch.setattr(lambda_athena, 'run_query', lambda *args, **kwargs: (TYPED_RESULT, None))
+    response = lambda_athena.handler(agent_event('/athenaQuery', Query='SELECT * FROM other', Format='Compact'), None)['response']
+    assert response['httpStatusCode'] == 200
+    body = response['responseBody']['application/json']['body']
+    assert body['Columns'] == ['city:varchar', 'drops:bigint', 'rate:double', 'active:boolean', 'day:date']
+    # Dates stay ISO text, NULL is None and NaN is kept as text because it is not valid JSON
+    assert body['Rows'] == [['Lisbon', 12, 0.25, True, '2024-02-05'], ['Porto', None, 'NaN', False, None]]
+    assert body['Encoding']['Format'] == 'compact'
+    assert body['Encoding']['EncodedBytes'] < body['Encoding']['RawBytes']
+
+
+def test_unknown_format_is_a_bad_request(monkeypatch):
+    monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+    monkeypatch.setenv('ATHENA_WORKGROUP', 'wg')
+    monkeypatch.setattr(lambda_athena, 'run_query', lambda *args, **kwargs: pytest.fail('the query must not run'))
+    response = lambda_athena.handler(agent_event('/athenaQuery', Query='SELECT * FROM other', Format='xml'), None)['response']
+    assert response['httpStatusCode'] == 400
+    assert "Unsupported Format 'xml'" in response['responseBody']['application/json']['body']['error']
+
+
+def test_slow_queries_continue_asynchronously(monkeypatch):
+    monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+    monkeypatch.setenv('ATHENA_WORKGROUP', 'wg')
+    monkeypatch.setattr(lambda_athena, 'ASYNC_AFTER_SECONDS', 0.2)
+    athena = FakeAthenaClient({'exec-1': {'Query': 'SELECT * FROM other', 'States': ['RUNNING'] * 50,
+                                          'Statistics': {'EngineExecutionTimeInMillis': 900}}})
+    monkeypatch.setattr(lambda_athena, 'athena_client', athena)
+    monkeypatch.setattr(lambda_athena, 'get_data_version', lambda: None)
+    monkeypatch.setattr(lambda_athena, 'run_local_query', lambda *args, **kwargs: (None, None))
+    monkeypatch.setattr(lambda_athena, 'start_or_attach', lambda *args: ('exec-1', 'owner'))
+    monkeypatch.setattr(lambda_athena, 'put_cached_result', lambda *args: None)
+    monkeypatch.setattr(lambda_athena, 'read_query_results', lambda execution_id, *args: TYPED_RESULT)
+
+    def call(api_path, **properties):
+        response = lambda_athena.handler(agent_event(api_path, **properties), None)['response']
+        return response['httpStatusCode'], response['responseBody']['application/json']['body']
+
+    # The query outlives the synchronous budget and keeps running
+    start = time.monotonic()
+    code, body = call('/athenaQuery', Query='SELECT * FROM other')
+    assert time.monotonic() - start < 1
+    assert (code, body['QueryExecutionId'], body['State']) == (202, 'exec-1', 'RUNNING')
+    assert athena.stopped == []
+
+    code, body = call('/athenaStatus', QueryExecutionId='exec-1')
+    assert (code, body['State'], body['EngineExecutionTimeInMillis']) == (200, 'RUNNING', 900)
+    code, body = call('/athenaFetch', QueryExecutionId='exec-1')
+    assert (code, body['State']) == (202, 'RUNNING')
+
+    athena.executions['exec-1']['States'] = ['SUCCEEDED']
+    code, body = call('/athenaStatus', QueryExecutionId='exec-1')
+    assert (code, body['State']) == (200, 'SUCCEEDED')
+    assert '/athenaFetch' in body['Message']
+    code, body = call('/athenaFetch', QueryExecutionId='exec-1')
+    assert code == 200
+    assert body['Rows'] == [['Lisbon', 12, 0.25, True, '2024-02-05'], ['Porto', None, 'NaN', False, None]]
+
+
+@pytest.mark.parametrize('api_path', ['/athenaStatus', '/athenaFetch'])
+def test_missing_execution_id_is_a_bad_request(api_path):
+    response = lambda_athena.handler(agent_event(api_path), None)['response']
+    assert response['httpStatusCode'] == 400
+    assert response['responseBody']['application/json']['body'] == {'error': 'QueryExecutionId is required'}
+
+
+@pytest.fixture
+def glue_catalog(monkeypatch):
+    # The data_proc table in a moto Glue catalog with the GetTable and GetPartitions calls it received
+    with mock_aws():
+        glue = boto3.client('glue')
+        glue.create_database(DatabaseInput={'Name': lambda_athena.GLUE_DATABASE})
+        table_input = {
+            'Name': lambda_athena.DATA_PROC_TABLE,
+            'StorageDescriptor': {'Columns': [{'Name': '4g_cell_name', 'Type': 'string'}, {'Name': 'traffic', 'Type': 'double'}]},
+            'PartitionKeys': [{'Name': 'date', 'Type': 'string'}],
+        }
+        glue.create_table(DatabaseName=lambda_athena.GLUE_DATABASE, TableInput=table_input)
+        calls = []
+        for operation in ('GetTable', 'GetPartitions'):
+            glue.meta.events.register(f'before-call.glue.{operation}', lambda model, **kwargs: calls.append(model.name))
+        monkeypatch.setattr(lambda_athena, 'glue_client', glue)
+        monkeypatch.setattr(lambda_athena, 'table_metadata', {'checked_at': 0.0, 'loaded_at': 0.0, 'version': None, 'schema': None})
+        yield glue, table_input, calls
+
+
+def add_partition(glue, day):
+    glue.create_partition(DatabaseName=lambda_athena.GLUE_DATABASE, TableName=lambda_athena.DATA_PROC_TABLE,
+                          PartitionInput={'Values': [day], 'StorageDescriptor': {'Columns': []}})
+
+
+def get_schema():
+    response = lambda_athena.handler(agent_event('/schema'), None)['response']
+    assert response['httpStatusCode'] == 200
+    return response['responseBody']['application/json']['body']
+
+
+def test_schema_is_served_from_the_glue_catalog(glue_catalog):
+    glue, _, calls = glue_catalog
+    add_partition(glue, '02 Feb 24')
+    add_partition(glue, '01 Feb 24')
+    schema = get_schema()
+    assert schema['Database'] == lambda_athena.GLUE_DATABASE
+    assert schema['Columns'] == ['4g_cell_name:string', 'traffic:double']
+    assert schema['PartitionKeys'] == ['date:string']
+    assert schema['Partitions'] == ['01 Feb 24', '02 Feb 24']
+    assert calls == ['GetTable', 'GetPartitions']
+
+
+def test_schema_cache_is_reused_until_the_table_changes(monkeypatch, glue_catalog):
+    glue, table_input, calls = glue_catalog
+    add_partition(glue, '01 Feb 24')
+    first = get_schema()
+
+    # Within the check interval the catalog is not read at all
+    add_partition(glue, '02 Feb 24')
+    assert get_schema() == first
+    assert calls == ['GetTable', 'GetPartitions']
+
+    # An unchanged table only costs the GetTable check
+    monkeypatch.setattr(lambda_athena, 'SCHEMA_CHECK_INTERVAL_SECONDS', 0)
+    assert get_schema() == first
+    assert calls == ['GetTable', 'GetPartitions', 'GetTable']
+
+    # An update of the table moves its VersionId and UpdateTime and reloads the schema with the new partitions
+    table_input['StorageDescriptor']['Columns'].append({'Name': 'drops', 'Type': 'bigint'})
+    glue.update_table(DatabaseName=lambda_athena.GLUE_DATABASE, TableInput=table_input)
+    schema = get_schema()
+    assert schema['Columns'][-1] == 'drops:bigint'
+    assert schema['Partitions'] == ['01 Feb 24', '02 Feb 24']
+    assert calls[-2:] == ['GetTable', 'GetPartitions']
+
+
+def test_schema_reloads_when_only_the_update_time_changes(monkeypatch, glue_catalog):
+    glue, _, calls = glue_catalog
+    get_schema()
+    monkeypatch.setattr(lambda_athena, 'SCHEMA_CHECK_INTERVAL_SECONDS', 0)
+    get_table = glue.get_table
+
+    def touched_table(**kwargs):
+        response = get_table(**kwargs)
+        response['Table']['UpdateTime'] = time.time()
+        return response
+    monkeypatch.setattr(glue, 'get_table', touched_table)
+    add_partition(glue, '03 Feb 24')
+    assert get_schema()['Partitions'] == ['03 Feb 24']
+
+
+class FakePreparedStatementClient:
+    def __init__(self):
+        self.statements = {}
+
+    def create_prepared_statement(self, StatementName, WorkGroup, QueryStatement, Description):
+        self.statements[StatementName] = QueryStatement
+
+
+@pytest.fixture
+def named_queries(monkeypatch):
+    # Runs /namedQuery with the statements it prepared and the queries it ran
+    monkeypatch.setenv('ATHENA_DEST_BUCKET', 'athena-results')
+    monkeypatch.setenv('ATHENA_WORKGROUP', 'wg')
+    athena = FakePreparedStatementClient()
+    ran = []
+    monkeypatch.setattr(lambda_athena, 'athena_client', athena)
+    monkeypatch.setattr(lambda_athena, 'prepared_statements', set())
+    monkeypatch.setattr(lambda_athena, 'run_query', lambda query, *args, **kwargs: ran.append(query) or (TYPED_RESULT, None))
+
+    def call(**properties):
+        response = lambda_athena.handler(agent_event('/namedQuery', **properties), None)['response']
+        return response['httpStatusCode'], response['responseBody']['application/json']['body']
+    return call, athena, ran
+
+
+def test_named_query_fills_the_template_slots_as_literals(named_queries):
+    call, athena, ran = named_queries
+    code, body = call(TemplateName='top_cells_by_kpi', Kpi='4g_drop_packet', Aggregation='avg',
+                      StartDate='01 Feb 24', EndDate=' 10 Feb 24', City="Lisbon' OR '1'='1", TopN='5')
+    assert code == 200
+    [(statement_name, sql)] = athena.statements.items()
+    assert statement_name.startswith('named_top_cells_by_kpi_avg_4g_drop_packet_')
+    assert 'avg("4g_drop_packet")' in sql
+    assert body['Query'] == sql
+    # The quote of the injection attempt is doubled, the value stays one string literal
+    assert ran == [f"EXECUTE {statement_name} USING '01 Feb 24', '10 Feb 24', "
+                   "'Lisbon'' OR ''1''=''1', 'Lisbon'' OR ''1''=''1', 5"]
+
+    # The same template and KPI reuse the prepared statement
+    call(TemplateName='top_cells_by_kpi', Kpi='4g_drop_packet', Aggregation='avg', StartDate='01 Feb 24', EndDate='10 Feb 24')
+    assert len(athena.statements) == 1
+    assert ran[-1] == f"EXECUTE {statement_name} USING '01 Feb 24', '10 Feb 24', '', '', 10"
+
+
+@pytest.mark.parametrize('properties, error', [
+    ({}, 'Unknown TemplateName'),
+    ({'TemplateName': 'drop_tables'}, 'Unknown TemplateName drop_tables'),
+    ({'TemplateName': 'kpi_by_city', 'Kpi': '4g_utilization" FROM x --'}, 'Kpi must be one of'),
+    ({'TemplateName': 'kpi_by_city', 'Kpi': '4g_utilization', 'Aggregation': 'count(*)) --'}, 'Aggregation must be one of'),
+    ({'TemplateName': 'top_cells_by_kpi', 'Kpi': '4g_utilization', 'TopN': '5; DROP TABLE data_proc'}, 'TopN must be a number'),
+    ({'TemplateName': 'top_cells_by_kpi', 'Kpi': '4g_utilization', 'TopN': '1000'}, 'TopN must be a number'),
+    ({'TemplateName': 'kpi_by_city', 'Kpi': '4g_utilization', 'StartDate': "01 Feb 24' OR 1=1 --"}, 'StartDate must be a date'),
+    ({'TemplateName': 'cells_above_threshold', 'Kpi': '4g_utilization'}, 'Threshold is required'),
+    ({'TemplateName': 'cells_above_threshold', 'Kpi': '4g_utilization', 'Threshold': 'nan'}, 'Threshold must be a number'),
+])
+def test_invalid_named_queries_are_bad_requests(named_queries, properties, error):
+    call, athena, ran = named_queries
+    code, body = call(**dict({'StartDate': '01 Feb 24', 'EndDate': '10 Feb 24'}, **properties))
+    assert code == 400
+    assert error in body['error']
+    assert athena.statements == {}
+    assert ran == []
+
+
+def test_unexpected_failures_still_emit_metrics(monkeypatch, capsys):
+    def failing_schema_handler(event, context):
+        lambda_athena.add_metric('PollCount', 1)
+        raise lambda_athena.ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'denied'}}, 'GetTable')
+    monkeypatch.setattr(lambda_athena, 'schema_handler', failing_schema_handler)
+
+    with pytest.raises(lambda_athena.ClientError):
+        lambda_athena.handler(agent_event('/schema'), None)
+    record, directive = read_emf_line(capsys.readouterr().out)
+    assert record['ApiPath'] == '/schema'
+    assert record['HttpStatusCode'] == 500
+    assert record['PollCount'] == 1
+    assert 'HandlerLatency' in record
+
+
+def profile_result(rows, truncated=False, continuation_token=None):
+    column_info = [{'Name': 'users', 'Type': 'bigint'}, {'Name': 'traffic', 'Type': 'double'},
+                   {'Name': 'vendor', 'Type': 'varchar'}]
+    return {'ColumnInfo': column_info, 'Rows': rows, 'Truncated': truncated, 'ContinuationToken': continuation_token}
+
+
+@pytest.mark.parametrize('numpy', [True, False])
+def test_summary_profiles_numeric_and_string_columns(monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(lambda_athena, 'np', None)
+    rows = [['1', '1.5', 'Nokia'], ['2', None, 'Ericsson'], ['3', '2.5', 'Nokia'], ['4', '3.5', None], [None, '4.5', 'Nokia']]
+    summary = lambda_athena.build_summary_body(profile_result(rows))['Summary']
+    assert summary['RowsProfiled'] == 5
+    assert summary['Truncated'] is False
+    users, traffic, vendor = summary['Columns']
+
+    assert users == {'Column': 'users', 'Type': 'bigint', 'Count': 4, 'Nulls': 1, 'NullRate': 0.2, 'Min': 1, 'Max': 4,
+                     'Mean': 2.5, 'Std': 1.290994,
+                     'Quantiles': {'p5': 1.15, 'p25': 1.75, 'p50': 2.5, 'p75': 3.25, 'p95': 3.85}}
+    assert traffic['Count'] == 4
+    assert traffic['Min'] == 1.5
+    assert traffic['Max'] == 4.5
+    assert traffic['Mean'] == 3.0
+    assert vendor == {'Column': 'vendor', 'Type': 'varchar', 'Count': 4, 'Nulls': 1, 'NullRate': 0.2, 'Distinct': 2,
+                      'Min': 'Ericsson', 'Max': 'Nokia', 'TopValues': [('Nokia', 3), ('Ericsson', 1)]}
+
+
+def test_summary_of_an_empty_or_null_column(monkeypatch):
+    summary = lambda_athena.build_summary_body(profile_result([[None, None, None]]))['Summary']
+    assert summary['Columns'][0] == {'Column': 'users', 'Type': 'bigint', 'Count': 0, 'Nulls': 1, 'NullRate': 1.0}
+    assert lambda_athena.build_summary_body(profile_result([]))['Summary']['Columns'][2]['NullRate'] is None
+
+
+def test_summary_continues_truncated_results_up_to_the_row_cap(monkeypatch):
+    monkeypatch.setattr(lambda_athena, 'SUMMARY_MAX_ROWS', 5)
+    pages = []
+
+    def read_page(execution_id, starting_token, offset, max_rows, max_bytes):
+        pages.append((starting_token, max_rows))
+        rows = [[str(len(pages) * 10 + n), '1.0', 'Nokia'] for n in range(2)][:max_rows]
+        return profile_result(rows, True, lambda_athena.encode_continuation_token('exec', f"page-{len(pages) + 1}", 0))
+    monkeypatch.setattr(lambda_athena, 'read_query_results', read_page)
+
+    first = profile_result([['1', '1.0', 'Nokia'], ['2', '1.0', 'Nokia']], True,
+                           lambda_athena.encode_continuation_token('exec', 'page-1', 0))
+    body = lambda_athena.build_summary_body(first)
+    # Pages are read until the cap, the last page is asked for the rows that are still missing only
+    assert pages == [('page-1', 3), ('page-2', 1)]
+    assert body['Summary']['RowsProfiled'] == 5
+    assert body['Summary']['Columns'][0]['Max'] == 20
+    assert body['Summary']['Truncated'] is True
+    assert 'first' in body['Message']
+
+
+def test_delayed_starts_are_counted_and_bounded_by_the_deadline(monkeypatch):
+    monkeypatch.setattr(lambda_athena, 'token_bucket_store', lambda_athena.LocalTokenBucketStore())
+    monkeypatch.setattr(lambda_athena, 'ADMISSION_BURST', 1)
+    monkeypatch.setattr(lambda_athena, 'ADMISSION_RATE_PER_SECOND', 5)
+    lambda_athena.reset_metrics()
+
+    lambda_athena.admit_query_start(None, None)
+    assert 'AdmissionWait' not in lambda_athena.invocation_metrics
+    # The next token follows after 0.2 seconds, the start waits for it
+    lambda_athena.admit_query_start(None, time.monotonic() + 5)
+    assert lambda_athena.invocation_metrics['AdmissionWait'] == 1
+    assert lambda_athena.invocation_metrics['AdmissionWaitTime'] >= 100
+
+    # With 0.3 seconds left the start may wait 0.15 seconds only, which is not enough for the next token
+    with pytest.raises(lambda_athena.QueryThrottledError):
+        lambda_athena.admit_query_start(None, time.monotonic() + 0.3)
+    assert lambda_athena.invocation_metrics['AdmissionWait'] == 2
+    assert lambda_athena.invocation_metrics['AdmissionRejected'] == 1
@@ -0,0 +1,440 @@
+import http.server
+import io
+import json
+import socketserver
+import threading
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import lambda_search
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    # path: (status, headers, body, delay in seconds) or a function of the request headers that returns one, every
+    # request is recorded as (path, headers, client port). Connections are kept alive like on real sites.
+    protocol_version = 'HTTP/1.1'
+    routes = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        PageHandler.requests.append((path, dict(self.headers), self.client_address[1]))
+        route = PageHandler.routes.get(path, (404, {}, b'', 0))
+        status, headers, body, delay = route(self.headers) if callable(route) else route
+        time.sleep(delay)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PageServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def web_server():
+    PageHandler.routes = {}
+    PageHandler.requests = []
+    server = PageServer(('127.0.0.1', 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def page_cache(monkeypatch, tmp_path):
+    # Every test starts without cached pages and never touches the /tmp cache of the machine
+    monkeypatch.setattr(lambda_search, 'PAGE_CACHE_DIR', str(tmp_path / 'page-cache'))
+    monkeypatch.setattr(lambda_search, 'PAGE_CACHE_BUCKET', None)
+    monkeypatch.setattr(lambda_search, 'page_cache_index', lambda_search.OrderedDict())
+    monkeypatch.setattr(lambda_search, 'empty_tmp_directory', lambda: None)
+
+
+class FakeContext:
+    def __init__(self, remaining_seconds):
+        self.deadline = time.monotonic() + remaining_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def html_page(text):
+    return (200, {'Content-Type': 'text/html; charset=utf-8'},
+            f'<html><head><script>var a;</script></head><body><main><p>{text}</p></main></body></html>'.encode(), 0)
+
+
+def google_page(urls):
+    results = ''.join(f'<div class="g"><a href="{url}"><h3>Result</h3></a></div>' for url in urls)
+    return f'<html><body>{results}</body></html>'.encode()
+
+
+def test_google_search_stops_on_a_page_without_results(monkeypatch, web_server):
+    monkeypatch.setattr(lambda_search, 'SEARCH_GOOGLE_URL', f"{web_server}/search")
+    # A consent or captcha page that carries no parsable results
+    PageHandler.routes['/search'] = (200, {'Content-Type': 'text/html'}, b'<html><body>Before you continue</body></html>', 0)
+    assert lambda_search.search_google('volte drop rate', 10, time.monotonic() + 5) == []
+    assert len(PageHandler.requests) == 1
+
+
+def test_google_search_reads_pages_until_enough_results(monkeypatch, web_server):
+    monkeypatch.setattr(lambda_search, 'SEARCH_GOOGLE_URL', f"{web_server}/search")
+    monkeypatch.setattr(lambda_search, 'SEARCH_GOOGLE_PAGE_INTERVAL_SECONDS', 0)
+    PageHandler.routes['/search'] = (200, {'Content-Type': 'text/html'}, google_page(['https://a.example', 'https://b.example']), 0)
+    # The second page repeats the first one, which ends the search like an empty page
+    assert lambda_search.search_google('volte drop rate', 5) == ['https://a.example', 'https://b.example']
+    assert len(PageHandler.requests) == 2
+    assert lambda_search.search_google('volte drop rate', 1) == ['https://a.example']
+    assert len(PageHandler.requests) == 3
+
+
+def test_google_search_does_not_start_past_the_deadline(monkeypatch, web_server):
+    monkeypatch.setattr(lambda_search, 'SEARCH_GOOGLE_URL', f"{web_server}/search")
+    assert lambda_search.search_google('volte drop rate', 10, time.monotonic() - 1) == []
+    assert PageHandler.requests == []
+
+
+def test_fetch_returns_the_pages_that_finished_before_the_deadline(web_server):
+    PageHandler.routes['/fast'] = html_page('Fast page')
+    PageHandler.routes['/slow'] = html_page('Slow page')[:3] + (3,)
+    urls = [f"{web_server}/fast", f"{web_server}/slow", f"{web_server}/missing"]
+
+    start = time.monotonic()
+    contents = lambda_search.fetch_pages(urls, time.monotonic() + 1)
+    assert time.monotonic() - start < 2
+    assert contents == {f"{web_server}/fast": 'Fast page', f"{web_server}/missing": None}
+
+
+def test_search_reports_pages_that_timed_out(monkeypatch, web_server):
+    PageHandler.routes['/fast'] = html_page('Fast page about volte')
+    PageHandler.routes['/slow'] = html_page('Slow page')[:3] + (5,)
+    monkeypatch.setattr(lambda_search, 'SEARCH_PROVIDER_NAMES', ['stub'])
+    monkeypatch.setattr(lambda_search, 'SEARCH_STUB_URLS', f"{web_server}/fast,{web_server}/slow")
+    monkeypatch.setattr(lambda_search, 'search_cache', lambda_search.OrderedDict())
+
+    # One second of the invocation is left for the search after the safety margin
+    context = FakeContext(lambda_search.DEADLINE_SAFETY_MARGIN_SECONDS + 1)
+    result = lambda_search.handle_search({'inputText': 'volte'}, context)
+    assert result['results'][:2] == [
+        {'url': f"{web_server}/fast", 'status': 'Content aggregated'},
+        {'url': f"{web_server}/slow", 'error': 'Timed out fetching content'},
+    ]
+    assert [passage['url'] for passage in result['passages']] == [f"{web_server}/fast"]
+    assert context.get_remaining_time_in_millis() > 0
+
+
+def versioned_page(versions):
+    # Serves the last entry of versions as (etag, text) and answers 304 when the client already has it
+    def route(headers):
+        etag, text = versions[-1]
+        if headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, b'', 0)
+        status, page_headers, body, delay = html_page(text)
+        return (status, dict(page_headers, ETag=etag, **{'Last-Modified': 'Mon, 05 Feb 2024 10:00:00 GMT'}), body, delay)
+    return route
+
+
+def test_unchanged_pages_are_revalidated_with_their_etag(web_server):
+    versions = [('"v1"', 'First version')]
+    PageHandler.routes['/page'] = versioned_page(versions)
+    url = f"{web_server}/page"
+
+    assert lambda_search.get_page_content(url) == 'First version'
+    assert 'If-None-Match' not in PageHandler.requests[-1][1]
+    # The second request is conditional and the 304 returns the cached text
+    assert lambda_search.get_page_content(url) == 'First version'
+    assert PageHandler.requests[-1][1]['If-None-Match'] == '"v1"'
+    assert PageHandler.requests[-1][1]['If-Modified-Since'] == 'Mon, 05 Feb 2024 10:00:00 GMT'
+
+    # A changed page is downloaded again and replaces the cached text
+    versions.append(('"v2"', 'Second version'))
+    assert lambda_search.get_page_content(url) == 'Second version'
+    assert lambda_search.get_page_content(url) == 'Second version'
+    assert PageHandler.requests[-1][1]['If-None-Match'] == '"v2"'
+
+
+def test_cold_containers_revalidate_pages_cached_in_s3(monkeypatch, tmp_path, web_server):
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='page-cache-bucket')
+        monkeypatch.setattr(lambda_search, 's3_client', s3)
+        monkeypatch.setattr(lambda_search, 'PAGE_CACHE_BUCKET', 'page-cache-bucket')
+        PageHandler.routes['/page'] = versioned_page([('"v1"', 'First version')])
+        url = f"{web_server}/page"
+        assert lambda_search.get_page_content(url) == 'First version'
+
+        # A new container starts with an empty /tmp cache
+        monkeypatch.setattr(lambda_search, 'PAGE_CACHE_DIR', str(tmp_path / 'cold'))
+        monkeypatch.setattr(lambda_search, 'page_cache_index', lambda_search.OrderedDict())
+        assert lambda_search.get_page_content(url) == 'First version'
+        assert PageHandler.requests[-1][1]['If-None-Match'] == '"v1"'
+        assert len(lambda_search.page_cache_index) == 1
+
+
+def test_pages_without_validators_are_not_cached(web_server):
+    PageHandler.routes['/page'] = html_page('No validators')
+    url = f"{web_server}/page"
+    assert lambda_search.get_page_content(url) == 'No validators'
+    assert lambda_search.get_page_content(url) == 'No validators'
+    assert 'If-None-Match' not in PageHandler.requests[-1][1]
+    assert 'If-Modified-Since' not in PageHandler.requests[-1][1]
+    assert len(lambda_search.page_cache_index) == 0
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    # Providers by name with the calls they received as (query, num_results, deadline)
+    calls = []
+    monkeypatch.setattr(lambda_search, 'search_cache', lambda_search.OrderedDict())
+    monkeypatch.setattr(lambda_search, 'SEARCH_PROVIDERS', dict(lambda_search.SEARCH_PROVIDERS))
+    monkeypatch.setattr(lambda_search, 'SEARCH_NUM_RESULTS', 3)
+
+    def register(name, provider):
+        def record(query, num_results, deadline):
+            calls.append((name, query, num_results, deadline))
+            return provider(query, num_results, deadline)
+        lambda_search.SEARCH_PROVIDERS[name] = record
+    return register, calls
+
+
+def test_search_fans_out_to_the_configured_providers(monkeypatch, providers):
+    register, calls = providers
+    monkeypatch.setattr(lambda_search, 'SEARCH_STUB_URLS', 'https://a.example,https://b.example')
+    register('stub', lambda_search.search_stub)
+    register('other', lambda query, num_results, deadline: ['https://b.example', 'https://c.example', 'https://d.example'])
+    register('broken', lambda query, num_results, deadline: 1 / 0)
+    register('slow', lambda query, num_results, deadline: time.sleep(3) or ['https://slow.example'])
+    monkeypatch.setattr(lambda_search, 'SEARCH_PROVIDER_NAMES', ['broken', 'stub', 'unknown', 'slow', 'other'])
+
+    deadline = time.monotonic() + 1
+    start = time.monotonic()
+    urls = lambda_search.search_web('volte drop rate', deadline)
+    # Failed and unknown providers are skipped and the slow one is not waited for
+    assert time.monotonic() - start < 2
+    assert len(urls) == 3
+    assert len(set(urls)) == 3
+    assert set(urls) <= {'https://a.example', 'https://b.example', 'https://c.example', 'https://d.example'}
+    assert sorted(name for name, *_ in calls) == ['broken', 'other', 'slow', 'stub']
+    assert all(call[1:] == ('volte drop rate', 3, deadline) for call in calls)
+
+
+def test_search_results_are_cached_by_normalised_query(monkeypatch, providers):
+    register, calls = providers
+    monkeypatch.setattr(lambda_search, 'SEARCH_STUB_URLS', 'https://a.example')
+    register('stub', lambda_search.search_stub)
+    monkeypatch.setattr(lambda_search, 'SEARCH_PROVIDER_NAMES', ['stub'])
+
+    assert lambda_search.search_web('VoLTE  drop rate') == ['https://a.example']
+    assert lambda_search.search_web(' volte drop RATE ') == ['https://a.example']
+    assert len(calls) == 1
+
+    # Expired entries are searched again
+    monkeypatch.setattr(lambda_search, 'search_cache', lambda_search.OrderedDict())
+    monkeypatch.setattr(lambda_search, 'SEARCH_CACHE_TTL_SECONDS', 0)
+    lambda_search.search_web('volte drop rate')
+    lambda_search.search_web('volte drop rate')
+    assert len(calls) == 3
+
+
+def test_empty_results_are_not_cached(monkeypatch, providers):
+    register, calls = providers
+    monkeypatch.setattr(lambda_search, 'SEARCH_STUB_URLS', '')
+    register('stub', lambda_search.search_stub)
+    monkeypatch.setattr(lambda_search, 'SEARCH_PROVIDER_NAMES', ['stub'])
+    assert lambda_search.search_web('volte') == []
+    assert lambda_search.search_web('volte') == []
+    assert len(calls) == 2
+
+
+def test_http_session_retries_throttled_and_failed_requests():
+    retry = lambda_search.http_session.get_adapter('https://example.com').max_retries
+    assert {429, 500, 502, 503, 504} <= set(retry.status_forcelist)
+    assert retry.total == lambda_search.HTTP_MAX_RETRIES
+    assert retry.respect_retry_after_header
+
+
+def flaky_page(failures, text):
+    # Answers with the given (status, headers) pairs first and with the page once they are used up
+    def route(headers):
+        if failures:
+            status, failure_headers = failures.pop(0)
+            return (status, failure_headers, b'', 0)
+        return html_page(text)
+    return route
+
+
+def test_retry_after_is_honoured_up_to_the_cap(monkeypatch, web_server):
+    monkeypatch.setattr(lambda_search, 'HTTP_RETRY_AFTER_MAX_SECONDS', 1.5)
+    PageHandler.routes['/busy'] = flaky_page([(503, {'Retry-After': '1'}), (429, {'Retry-After': '60'})], 'Busy page')
+    start = time.monotonic()
+    assert lambda_search.get_page_content(f"{web_server}/busy") == 'Busy page'
+    # One second as asked and the cap instead of a minute
+    assert 2.5 <= time.monotonic() - start < 5
+    assert len(PageHandler.requests) == 3
+
+    # A malformed header falls back to the backoff
+    PageHandler.routes['/odd'] = flaky_page([(503, {'Retry-After': 'soon'})], 'Odd page')
+    assert lambda_search.get_page_content(f"{web_server}/odd") == 'Odd page'
+
+
+def test_retries_are_bounded(web_server):
+    PageHandler.routes['/down'] = (500, {}, b'', 0)
+    assert lambda_search.get_page_content(f"{web_server}/down") is None
+    assert len(PageHandler.requests) == lambda_search.HTTP_MAX_RETRIES + 1
+
+
+def test_connections_are_reused_across_pages(web_server):
+    for index in range(3):
+        PageHandler.routes[f'/page{index}'] = html_page(f'Page {index}')
+    for index in range(3):
+        assert lambda_search.get_page_content(f"{web_server}/page{index}") == f'Page {index}'
+    assert len({port for *_, port in PageHandler.requests}) == 1
+
+
+def test_pages_larger_than_the_cap_are_dropped(monkeypatch, web_server):
+    monkeypatch.setattr(lambda_search, 'PAGE_MAX_BYTES', 1000)
+    PageHandler.routes['/large'] = html_page('x' * 2000)
+    PageHandler.routes['/small'] = html_page('Small page')
+    assert lambda_search.get_page_content(f"{web_server}/large") is None
+    assert lambda_search.get_page_content(f"{web_server}/small") == 'Small page'
+
+
+class StreamedResponse:
+    # A response without Content-Length that counts the chunks read from it
+    def __init__(self, chunk, count):
+        self.headers = {}
+        self.chunk = chunk
+        self.count = count
+        self.chunks_read = 0
+
+    def iter_content(self, chunk_size):
+        for _ in range(self.count):
+            self.chunks_read += 1
+            yield self.chunk
+
+
+def test_page_download_stops_at_the_cap(monkeypatch):
+    monkeypatch.setattr(lambda_search, 'PAGE_MAX_BYTES', 1000)
+    response = StreamedResponse(b'x' * 300, 100)
+    with pytest.raises(Exception, match='larger than 1000 bytes'):
+        lambda_search.read_page_body(response)
+    assert response.chunks_read == 4
+    assert lambda_search.read_page_body(StreamedResponse(b'x' * 300, 3)) == b'x' * 900
+
+
+def test_only_html_and_text_pages_are_extracted(web_server):
+    PageHandler.routes['/report.pdf'] = (200, {'Content-Type': 'application/pdf'}, b'%PDF-1.7', 0)
+    PageHandler.routes['/notes.txt'] = (200, {'Content-Type': 'text/plain; charset=utf-8'}, b'  First line \n\n Second line', 0)
+    assert lambda_search.get_page_content(f"{web_server}/report.pdf") is None
+    assert lambda_search.get_page_content(f"{web_server}/notes.txt") == 'First line\nSecond line'
+
+
+def test_extraction_falls_back_to_the_installed_engines(monkeypatch):
+    engines = lambda_search.EXTRACTION_ENGINES
+    monkeypatch.setattr(lambda_search, 'EXTRACTION_ENGINES', lambda_search.OrderedDict(engines))
+    lambda_search.EXTRACTION_ENGINES['selectolax'] = (engines['selectolax'][0], None)
+    assert lambda_search.get_extraction_engine() is lambda_search.extract_text_lxml
+    lambda_search.EXTRACTION_ENGINES['lxml'] = (engines['lxml'][0], None)
+    assert lambda_search.get_extraction_engine() is lambda_search.extract_text_html_parser
+    with pytest.raises(Exception, match='lxml is not installed'):
+        lambda_search.get_extraction_engine('lxml')
+
+
+@pytest.mark.parametrize('engine', ['selectolax', 'lxml', 'html.parser'])
+def test_extraction_engines_agree(engine):
+    extract, module = lambda_search.EXTRACTION_ENGINES[engine]
+    if module is None:
+        pytest.skip(f"{engine} is not installed")
+    html = html_page('Drop rate  of the cell')[2].decode()
+    assert extract(html) == 'Drop rate\nof the cell'
+
+
+def test_passages_follow_lines_and_cut_overlong_ones(monkeypatch):
+    monkeypatch.setattr(lambda_search, 'PASSAGE_MAX_WORDS', 5)
+    passages = lambda_search.split_passages('https://a.example', 'a b c\nd e f\n\ng h i j k l m n o p q\nr')
+    assert [passage['text'] for passage in passages] == ['a b c', 'd e f', 'g h i j k', 'l m n o p', 'q r']
+    assert {passage['url'] for passage in passages} == {'https://a.example'}
+    assert lambda_search.split_passages('https://a.example', 'a b c\nd e') == [{'url': 'https://a.example', 'text': 'a b c d e'}]
+
+
+def test_bm25_ranks_passages_by_query_terms():
+    passages = [{'url': 'https://a.example', 'text': text} for text in (
+        'The weather is sunny today',
+        'Volte drop rate per cell',
+        'Volte drop rate and volte drop causes',
+        'Drop of the packet traffic',
+    )]
+    ranked = lambda_search.rank_passages_bm25('What is the volte drop rate?', passages)
+    assert [passage['text'] for _, passage in ranked] == [
+        'Volte drop rate and volte drop causes', 'Volte drop rate per cell', 'Drop of the packet traffic']
+    assert ranked[0][0] > ranked[1][0] > ranked[2][0] > 0
+    # Stopwords alone match nothing
+    assert lambda_search.rank_passages_bm25('what is the', passages) == []
+
+
+def test_selection_keeps_the_budget_and_the_per_url_cap(monkeypatch):
+    monkeypatch.setattr(lambda_search, 'PASSAGE_TOP_K', 4)
+    monkeypatch.setattr(lambda_search, 'PASSAGE_TOKEN_BUDGET', 10)
+    ranked = [(5.0, {'url': 'https://a.example', 'text': 'a' * 8}),
+              (4.0, {'url': 'https://a.example', 'text': 'b' * 8}),
+              (3.0, {'url': 'https://a.example', 'text': 'c' * 8}),
+              # A fourth passage of the same page is over the cap
+              (2.5, {'url': 'https://a.example', 'text': 'd'}),
+              # 5 tokens do not fit in the 4 left, the shorter passage after it does
+              (2.0, {'url': 'https://b.example', 'text': 'e' * 20}),
+              (1.0, {'url': 'https://b.example', 'text': 'f' * 16})]
+    selected = lambda_search.select_passages(ranked)
+    assert [passage['text'][0] for passage in selected] == ['a', 'b', 'c', 'f']
+    assert sum(len(passage['text']) for passage in selected) / lambda_search.CHARS_PER_TOKEN <= 10
+
+    monkeypatch.setattr(lambda_search, 'PASSAGE_TOP_K', 2)
+    assert len(lambda_search.select_passages(ranked)) == 2
+
+
+class FakeBedrockRuntime:
+    # Titan embeddings that point the same way for texts mentioning erab, calls fail or hang when asked to
+    def __init__(self, error=None, delay=0):
+        self.error = error
+        self.delay = delay
+
+    def invoke_model(self, modelId, body, contentType, accept):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        text = json.loads(body)['inputText'].lower()
+        embedding = [1.0, 0.0] if 'erab' in text else [0.0, 1.0]
+        return {'body': io.BytesIO(json.dumps({'embedding': embedding}).encode())}
+
+
+PASSAGE_PAGES = [
+    ('https://a.example', 'Volte drop rate volte drop rate of every cell'),
+    ('https://b.example', 'The erab setup failures cause a volte drop'),
+]
+
+
+def test_embeddings_rerank_the_bm25_candidates(monkeypatch):
+    monkeypatch.setattr(lambda_search, 'EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+    monkeypatch.setattr(lambda_search, 'bedrock_runtime', FakeBedrockRuntime())
+    assert [passage['url'] for passage in lambda_search.rank_passages('erab volte drop', PASSAGE_PAGES)] == [
+        'https://b.example', 'https://a.example']
+
+
+@pytest.mark.parametrize('runtime', [FakeBedrockRuntime(error=Exception('ThrottlingException')), FakeBedrockRuntime(delay=2)])
+def test_failed_rerank_keeps_the_bm25_order(monkeypatch, runtime):
+    monkeypatch.setattr(lambda_search, 'EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+    monkeypatch.setattr(lambda_search, 'bedrock_runtime', runtime)
+    start = time.monotonic()
+    selected = lambda_search.rank_passages('volte drop rate', PASSAGE_PAGES, time.monotonic() + 0.5)
+    assert time.monotonic() - start < 1.5
+    assert [passage['url'] for passage in selected] == ['https://a.example', 'https://b.example']
+    monkeypatch.setattr(lambda_search, 'EMBEDDING_MODEL_ID', None)
+    assert lambda_search.rank_passages('volte drop rate', PASSAGE_PAGES) == selected